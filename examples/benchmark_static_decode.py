@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description: Per-token CPU decode latency of `generate` against `StaticDecoder`, eager and compiled.
+
+usage:
+    python benchmark_static_decode.py --num_layers 4 --hidden_size 1024
+    python benchmark_static_decode.py --model_name THUDM/chatglm-6b --new_tokens 32
+"""
+import argparse
+import sys
+import time
+
+import torch
+
+sys.path.append('..')
+from lmft.chatglm_decode import StaticDecoder
+from lmft.chatglm_utils import ChatGLMConfig, ChatGLMForConditionalGeneration
+
+
+def load_model(args):
+    if args.model_name:
+        return ChatGLMForConditionalGeneration.from_pretrained(args.model_name, trust_remote_code=True).float().eval()
+    # random weights of a chosen size, the latency does not depend on them
+    config = ChatGLMConfig(
+        hidden_size=args.hidden_size,
+        num_layers=args.num_layers,
+        num_attention_heads=args.hidden_size // 64,
+        inner_hidden_size=4 * args.hidden_size,
+        max_sequence_length=2048,
+        use_cache=True,
+    )
+    torch.manual_seed(0)
+    model = ChatGLMForConditionalGeneration(config).float()
+    with torch.no_grad():
+        for param in model.parameters():
+            param.normal_(0, 0.02)
+    return model.eval()
+
+
+def timed(fn, repeats):
+    fn()  # warmup, compiles the static step
+    start = time.perf_counter()
+    for _ in range(repeats):
+        outputs = fn()
+    return (time.perf_counter() - start) / repeats, outputs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_name', default=None, type=str, help='Pretrained model, random weights if not set')
+    parser.add_argument('--hidden_size', default=1024, type=int)
+    parser.add_argument('--num_layers', default=4, type=int)
+    parser.add_argument('--prompt_length', default=64, type=int)
+    parser.add_argument('--new_tokens', default=64, type=int)
+    parser.add_argument('--repeats', default=3, type=int)
+    parser.add_argument('--threads', default=None, type=int)
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    model = load_model(args)
+    generator = torch.Generator().manual_seed(0)
+    prompt = torch.randint(5, 20000, (1, args.prompt_length), generator=generator)
+    input_ids = torch.cat((prompt, torch.tensor([[150001, 150004]])), dim=1)
+    max_length = input_ids.size(1) + args.new_tokens
+
+    def run_generate():
+        # an eos id that never occurs, every run decodes the same number of tokens
+        return model.generate(input_ids=input_ids, max_length=max_length, do_sample=False, eos_token_id=-1)
+
+    def prefill():
+        return model(input_ids=input_ids, use_cache=True)
+
+    results = {}
+    with torch.no_grad():
+        prefill_latency, _ = timed(prefill, args.repeats)
+        results['generate'] = timed(run_generate, args.repeats)
+        for name, compile in (('static', False), ('static+compile', True)):
+            decoder = StaticDecoder(model, max_length=max_length, eos_token_id=-1, compile=compile)
+            results[name] = timed(lambda: decoder.generate(input_ids), args.repeats)
+
+    expected = results['generate'][1]
+    for name, (latency, outputs) in results.items():
+        per_token = (latency - prefill_latency) / args.new_tokens
+        print(f"{name:16s} {per_token * 1000:8.2f} ms/token  matches generate: {torch.equal(outputs, expected)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,548 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description: Key/value cache stores for ChatGLM attention.
+"""
+import bisect
+import math
+from collections import OrderedDict
+from typing import List, Optional
+
+import torch
+import torch.nn.functional as F
+
+
+class LayerCache:
+    """View of one layer of a `KVCache`, passed to `attention_fn` as `layer_past`."""
+
+    def __init__(self, cache, layer_id: int):
+        self.cache = cache
+        self.layer_id = layer_id
+
+    def update(self, key_layer: torch.Tensor, value_layer: torch.Tensor):
+        """Write the new [sq, b, np, hn] keys/values to the cache, returns the full [sk, b, np, hn] ones."""
+        return self.cache.write_and_read(self.layer_id, key_layer, value_layer)
+
+
+class KVCache:
+    """
+    Key/value store written in place by the attention layers, used as `past_key_values` instead of tuples.
+
+    `ChatGLMModel.forward` calls `begin_forward` once, then every layer reads and writes through `layer(i)`.
+    """
+    # size of the rotary table to gather positions from, None to size it from the positions of every forward
+    max_length: Optional[int] = None
+
+    def layer(self, layer_id: int) -> LayerCache:
+        return LayerCache(self, layer_id)
+
+    def get_seq_length(self) -> int:
+        raise NotImplementedError
+
+    def begin_forward(self, batch_size: int, num_tokens: int):
+        """Reserve room for `num_tokens` new tokens of every row, called once per model forward."""
+        raise NotImplementedError
+
+    def write_and_read(self, layer_id: int, key_layer: torch.Tensor, value_layer: torch.Tensor):
+        raise NotImplementedError
+
+    def get_attention_mask(self, attention_mask: torch.Tensor) -> torch.Tensor:
+        """Extend the [b, 1, sq, sk] mask of a forward to all the keys read back from the cache."""
+        return attention_mask
+
+    def reorder(self, beam_idx: torch.LongTensor):
+        raise NotImplementedError
+
+    def reorder_cache(self, beam_idx: torch.LongTensor):
+        """In place `reorder`, transformers>=4.38 calls it on cache objects instead of `_reorder_cache`."""
+        self.reorder(beam_idx)
+
+
+class PagedLayerCache(LayerCache):
+    """View of one layer of a `PagedKVCache`, passed to `attention_fn` as `layer_past`."""
+
+    def attention(self, query_layer: torch.Tensor, key_layer: torch.Tensor, value_layer: torch.Tensor,
+                  attention_mask: Optional[torch.Tensor], query_key_layer_scaling_coeff: float) -> torch.Tensor:
+        """Write the new keys/values and attend over the cached ones in place, returns the [sq, b, np, hn] context"""
+        self.cache.write(self.layer_id, key_layer, value_layer)
+        return self.cache.attention(self.layer_id, query_layer, attention_mask, query_key_layer_scaling_coeff)
+
+
+class PagedKVCache(KVCache):
+    """
+    Block-paged key/value store shared by all layers of a ChatGLM model.
+
+    Fixed-size blocks of `block_size` token slots are handed out from a preallocated pool, every sequence
+    (batch row) owns a page table of blocks. A decode step writes one slot per row and never reallocates the
+    history. `attention` reads every row through its block table, the [b, sk] slots are gathered once per
+    forward and shared by all layers, a single row held in consecutive blocks is read as a view of the pool.
+    Rows may share blocks (beam search), a shared block is copied before a row writes to it.
+    Block 0 is reserved: padded positions of shorter rows read from it and are masked out.
+    """
+
+    def __init__(self, num_layers: int, num_blocks: int, block_size: int = 16, dtype=None, device=None):
+        self.num_layers = num_layers
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.dtype = dtype
+        self.device = device
+        # pools are allocated on the first write, when heads, head size and dtype are known
+        self.key_pool = None
+        self.value_pool = None
+        self.free_blocks = list(range(1, num_blocks))  # kept sorted
+        self.block_refs = [0] * num_blocks  # number of rows using every block
+        self.block_tables: List[List[int]] = []
+        self.seq_lens: List[int] = []
+        # [b, capacity] slot index of every position of every row, padded with the null slot 0
+        self.row_slots = torch.zeros(0, 0, dtype=torch.long)
+        self._slot_mapping = None
+        self._read_slots = None
+
+    @classmethod
+    def from_config(cls, config, batch_size: int, max_length: int, block_size: int = 16, **kwargs):
+        max_length = min(max_length, config.max_sequence_length)
+        num_blocks = batch_size * math.ceil(max_length / block_size) + 1
+        return cls(config.num_layers, num_blocks, block_size=block_size, **kwargs)
+
+    def __len__(self):
+        return len(self.block_tables)
+
+    def layer(self, layer_id: int) -> PagedLayerCache:
+        return PagedLayerCache(self, layer_id)
+
+    def get_seq_length(self) -> int:
+        return max(self.seq_lens) if self.seq_lens else 0
+
+    def padding_mask(self) -> Optional[torch.Tensor]:
+        """[b, 1, 1, sk] mask of the slots past the end of shorter rows, None if all rows have the same length."""
+        if len(set(self.seq_lens)) <= 1:
+            return None
+        seq_lens = torch.tensor(self.seq_lens, dtype=torch.long)
+        mask = torch.arange(self.get_seq_length())[None, :] >= seq_lens[:, None]
+        return mask[:, None, None, :]
+
+    def get_attention_mask(self, attention_mask: torch.Tensor) -> torch.Tensor:
+        # rows of different lengths read padded slots
+        padding_mask = self.padding_mask()
+        if padding_mask is None:
+            return attention_mask
+        return attention_mask | padding_mask.to(attention_mask.device)
+
+    def _new_run_block(self) -> int:
+        """
+        First block of a new run: the middle of the largest run of free blocks (its start at the start of the
+        pool), so that the row before it and the new one can both keep growing into consecutive blocks.
+        """
+        free = self.free_blocks
+        best_start, best_length = free[0], 0
+        run_start = free[0]
+        for block, next_block in zip(free, free[1:] + [None]):
+            if next_block != block + 1:
+                if block + 1 - run_start > best_length:
+                    best_start, best_length = run_start, block + 1 - run_start
+                run_start = next_block
+        return best_start if best_start == 1 else best_start + best_length // 2
+
+    def _take_block(self, prefer: Optional[int] = None) -> int:
+        if not self.free_blocks:
+            raise RuntimeError("PagedKVCache is out of blocks, increase `num_blocks`.")
+        index = bisect.bisect_left(self.free_blocks, prefer) if prefer is not None else len(self.free_blocks)
+        if index == len(self.free_blocks) or self.free_blocks[index] != prefer:
+            index = bisect.bisect_left(self.free_blocks, self._new_run_block())
+        block = self.free_blocks.pop(index)
+        self.block_refs[block] = 1
+        return block
+
+    def _release_block(self, block: int):
+        self.block_refs[block] -= 1
+        if self.block_refs[block] == 0:
+            bisect.insort(self.free_blocks, block)
+
+    def _set_block(self, row: int, index: int, block: int):
+        """Make `block` the `index`-th block of `row`."""
+        table = self.block_tables[row]
+        if index == len(table):
+            table.append(block)
+        else:
+            table[index] = block
+        start = index * self.block_size
+        if start + self.block_size > self.row_slots.size(1):
+            capacity = max(2 * self.row_slots.size(1), start + self.block_size)
+            row_slots = self.row_slots.new_zeros(self.row_slots.size(0), capacity)
+            row_slots[:, :self.row_slots.size(1)] = self.row_slots
+            self.row_slots = row_slots
+        self.row_slots[row, start:start + self.block_size] = torch.arange(
+            block * self.block_size, (block + 1) * self.block_size
+        )
+
+    def _allocate_block(self, row: int):
+        table = self.block_tables[row]
+        # prefer the next block so that the row stays contiguous and is read in one piece
+        block = self._take_block(table[-1] + 1 if table else None)
+        self._set_block(row, len(table), block)
+
+    def _copy_on_write(self, row: int):
+        """Give `row` its own copy of the shared blocks it is about to write to."""
+        table = self.block_tables[row]
+        for index in range(self.seq_lens[row] // self.block_size, len(table)):
+            block = table[index]
+            if self.block_refs[block] > 1:
+                new_block = self._take_block(table[index - 1] + 1 if index else None)
+                if self.key_pool is not None:
+                    device = self.key_pool.device
+                    slots = torch.arange(block * self.block_size, (block + 1) * self.block_size, device=device)
+                    new_slots = slots + (new_block - block) * self.block_size
+                    for pool in self._pools():
+                        pool.index_copy_(1, new_slots, pool.index_select(1, slots))
+                self._release_block(block)
+                self._set_block(row, index, new_block)
+
+    def _add_rows(self, num_rows: int):
+        self.block_tables.extend([] for _ in range(num_rows))
+        self.seq_lens.extend(0 for _ in range(num_rows))
+        self.row_slots = torch.cat((self.row_slots, self.row_slots.new_zeros(num_rows, self.row_slots.size(1))))
+
+    def begin_forward(self, batch_size: int, num_tokens: int):
+        """Reserve slots for `num_tokens` new tokens of every row, called once per model forward."""
+        if not self.block_tables:
+            self._add_rows(batch_size)
+        if batch_size != len(self.block_tables):
+            raise ValueError(
+                "Batch size {} does not match the {} sequences of the cache.".format(batch_size, len(self))
+            )
+        for row, seq_len in enumerate(self.seq_lens):
+            self._copy_on_write(row)
+            while len(self.block_tables[row]) * self.block_size < seq_len + num_tokens:
+                self._allocate_block(row)
+        new_positions = torch.tensor(self.seq_lens, dtype=torch.long)[None, :] + torch.arange(num_tokens)[:, None]
+        # [sq * b] slot of every new token, in the [sq, b] order of the key/value layers
+        self._slot_mapping = self.row_slots.gather(1, new_positions.t()).t().reshape(-1)
+        self.seq_lens = [seq_len + num_tokens for seq_len in self.seq_lens]
+        self._prepare_read()
+
+    def _prepare_read(self):
+        # the rows changed, the read slots are built again by the first layer that reads
+        self._read_slots = None
+
+    def _get_read_slots(self, device) -> tuple:
+        """
+        Index of the [b, sk] history in the pool of a layer, built once per forward and shared by all layers:
+        a slice (a view of the pool) for a single row in consecutive blocks, else the [b, sk] slots to gather.
+        """
+        if self._read_slots is None:
+            table = self.block_tables[0] if len(self.block_tables) == 1 else None
+            if table and table == list(range(table[0], table[0] + len(table))):
+                start = table[0] * self.block_size
+                self._read_slots = (None, slice(start, start + self.seq_lens[0]))
+            else:
+                self._read_slots = (self.row_slots[:, :self.get_seq_length()].to(device),)
+        return self._read_slots
+
+    def _read(self, pool: torch.Tensor):
+        """Gather the [sk, b, ...] history of all rows, only used when attention needs the full keys/values."""
+        read_slots = self._get_read_slots(pool.device)
+        if read_slots[0] is None:
+            return pool[read_slots[1]].unsqueeze(1)
+        # [sk, b] slots in the order attention_fn expects
+        return pool[read_slots[0].t()]
+
+    def _allocate_pools(self, key_layer: torch.Tensor):
+        shape = (self.num_layers, self.num_blocks * self.block_size) + tuple(key_layer.shape[2:])
+        dtype = self.dtype or key_layer.dtype
+        device = self.device or key_layer.device
+        self.key_pool = torch.zeros(shape, dtype=dtype, device=device)
+        self.value_pool = torch.zeros(shape, dtype=dtype, device=device)
+
+    def _pools(self) -> List[torch.Tensor]:
+        """Every [num_layers, slots, ...] pool, rows are moved in all of them"""
+        return [self.key_pool, self.value_pool]
+
+    def _write(self, layer_id: int, slots: torch.Tensor, key_layer: torch.Tensor, value_layer: torch.Tensor):
+        """Write the [n, np, hn] keys/values of `n` tokens to their `slots` of layer `layer_id`."""
+        key_pool, value_pool = self.key_pool[layer_id], self.value_pool[layer_id]
+        key_pool.index_copy_(0, slots, key_layer.to(key_pool.dtype))
+        value_pool.index_copy_(0, slots, value_layer.to(value_pool.dtype))
+
+    def _read_layer(self, layer_id: int):
+        return self._read(self.key_pool[layer_id]), self._read(self.value_pool[layer_id])
+
+    def write(self, layer_id: int, key_layer: torch.Tensor, value_layer: torch.Tensor):
+        """Write the new [sq, b, np, hn] keys/values to the slots reserved by `begin_forward`."""
+        if self.key_pool is None:
+            self._allocate_pools(key_layer)
+        slot_mapping = self._slot_mapping.to(self.key_pool.device)
+        key_layer = key_layer.reshape(-1, *key_layer.shape[2:])
+        value_layer = value_layer.reshape(-1, *value_layer.shape[2:])
+        self._write(layer_id, slot_mapping, key_layer, value_layer)
+
+    def write_and_read(self, layer_id: int, key_layer: torch.Tensor, value_layer: torch.Tensor):
+        self.write(layer_id, key_layer, value_layer)
+        return self._read_layer(layer_id)
+
+    def _scores(self, layer_id: int, query: torch.Tensor, read_slots: tuple) -> torch.Tensor:
+        """[b, np, sq, hn] queries times the keys at `read_slots`, returns [b, np, sq, sk] scores."""
+        keys = self.key_pool[layer_id][read_slots].to(query.dtype)
+        return torch.matmul(query, keys.permute(0, 2, 3, 1))
+
+    def _context(self, layer_id: int, probs: torch.Tensor, read_slots: tuple) -> torch.Tensor:
+        """[b, np, sq, sk] probabilities times the values at `read_slots`, returns [b, np, sq, hn]."""
+        values = self.value_pool[layer_id][read_slots].to(probs.dtype)
+        return torch.matmul(probs, values.transpose(1, 2))
+
+    def attention(self, layer_id: int, query_layer: torch.Tensor, attention_mask: Optional[torch.Tensor],
+                  query_key_layer_scaling_coeff: float) -> torch.Tensor:
+        """
+        Attention of the [sq, b, np, hn] queries over the cached keys/values of every row, with the masking and
+        softmax of the eager `attention_fn`. attention_mask: True for masked, broadcast to [b, 1, sq, sk].
+        returns: [sq, b, np, hn]
+        """
+        query_layer = query_layer / (math.sqrt(query_layer.size(-1)) * query_key_layer_scaling_coeff)
+        read_slots = self._get_read_slots(self.key_pool.device)
+        query = query_layer.permute(1, 2, 0, 3)  # [b, np, sq, hn]
+        scores = self._scores(layer_id, query, read_slots)
+        if attention_mask is not None:
+            scores = scores.masked_fill(attention_mask, -10000.0)
+        scores = scores.float() * query_key_layer_scaling_coeff
+        probs = F.softmax(scores, dim=-1).to(query.dtype)
+        # [b, np, sq, hn] -> [sq, b, np, hn]
+        return self._context(layer_id, probs, read_slots).permute(2, 0, 1, 3)
+
+    def add_sequence(self, past_key_values=None) -> int:
+        """Append a row, optionally filled from a tuple cache of a single sequence, returns its row index."""
+        self._add_rows(1)
+        row = len(self.block_tables) - 1
+        if past_key_values is not None:
+            seq_len = past_key_values[0][0].size(0)
+            while len(self.block_tables[row]) * self.block_size < seq_len:
+                self._allocate_block(row)
+            if self.key_pool is None:
+                self._allocate_pools(past_key_values[0][0])
+            slots = self.row_slots[row, :seq_len].to(self.key_pool.device)
+            for layer_id, (key_layer, value_layer) in enumerate(past_key_values):
+                self._write(layer_id, slots, key_layer[:, 0], value_layer[:, 0])
+            self.seq_lens[row] = seq_len
+        return row
+
+    def keep_sequences(self, rows: List[int]):
+        """
+        Keep only `rows` (in this order) and return the blocks nobody uses to the pool. A row kept several
+        times shares its blocks, they are copied on write.
+        """
+        block_tables = [list(self.block_tables[row]) for row in rows]
+        for table in block_tables:
+            for block in table:
+                self.block_refs[block] += 1
+        for table in self.block_tables:
+            for block in table:
+                self._release_block(block)
+        self.block_tables = block_tables
+        self.seq_lens = [self.seq_lens[row] for row in rows]
+        self.row_slots = self.row_slots[torch.tensor(rows, dtype=torch.long)]
+
+    def reorder(self, beam_idx: torch.LongTensor):
+        """Reorder rows for beam search by swapping block tables, no key/value is copied."""
+        self.keep_sequences(beam_idx.tolist())
+        self._prepare_read()
+        return self
+
+
+class Int8PagedKVCache(PagedKVCache):
+    """
+    `PagedKVCache` with int8 keys/values, every token has one scale per head (absmax / 127), so appending
+    never requantizes the history. Attention applies the scales inside the matmuls: the scores of the int8
+    keys are multiplied by the key scales and the value scales are folded into the probabilities. The int8
+    history is still cast to the compute dtype for the matmul (there is no int8 x float matmul), that
+    transient copy is one layer, and `output_attentions` falls back to dequantizing the layer. The cache itself takes about half (fp16) or a quarter (fp32) of the memory.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.key_scale_pool = None
+        self.value_scale_pool = None
+
+    def _allocate_pools(self, key_layer: torch.Tensor):
+        shape = (self.num_layers, self.num_blocks * self.block_size) + tuple(key_layer.shape[2:])
+        device = self.device or key_layer.device
+        self.scale_dtype = self.dtype or key_layer.dtype
+        self.key_pool = torch.zeros(shape, dtype=torch.int8, device=device)
+        self.value_pool = torch.zeros(shape, dtype=torch.int8, device=device)
+        self.key_scale_pool = torch.zeros(shape[:-1] + (1,), dtype=self.scale_dtype, device=device)
+        self.value_scale_pool = torch.zeros(shape[:-1] + (1,), dtype=self.scale_dtype, device=device)
+
+    def _pools(self) -> List[torch.Tensor]:
+        return [self.key_pool, self.value_pool, self.key_scale_pool, self.value_scale_pool]
+
+    @staticmethod
+    def quantize(x: torch.Tensor):
+        """Symmetric int8 of [..., hn] with a scale per vector"""
+        scale = x.abs().amax(dim=-1, keepdim=True).float().clamp(min=1e-8) / 127
+        return torch.round(x.float() / scale).to(torch.int8), scale
+
+    def _write(self, layer_id: int, slots: torch.Tensor, key_layer: torch.Tensor, value_layer: torch.Tensor):
+        for pool, scale_pool, x in (
+                (self.key_pool, self.key_scale_pool, key_layer), (self.value_pool, self.value_scale_pool, value_layer)
+        ):
+            quantized, scale = self.quantize(x)
+            pool[layer_id].index_copy_(0, slots, quantized)
+            scale_pool[layer_id].index_copy_(0, slots, scale.to(self.scale_dtype))
+
+    def _scores(self, layer_id: int, query: torch.Tensor, read_slots: tuple) -> torch.Tensor:
+        # (q . k_int8) * key scale, the keys are only cast, never rebuilt in full precision
+        scores = super()._scores(layer_id, query, read_slots)
+        return scores * self.key_scale_pool[layer_id][read_slots].permute(0, 2, 3, 1).to(scores.dtype)
+
+    def _context(self, layer_id: int, probs: torch.Tensor, read_slots: tuple) -> torch.Tensor:
+        # the value scales are folded into the probabilities of their keys
+        probs = probs * self.value_scale_pool[layer_id][read_slots].permute(0, 2, 3, 1).to(probs.dtype)
+        return super()._context(layer_id, probs, read_slots)
+
+    def _read_layer(self, layer_id: int):
+        key_layer = self._read(self.key_pool[layer_id]).to(self.scale_dtype)
+        value_layer = self._read(self.value_pool[layer_id]).to(self.scale_dtype)
+        return (
+            key_layer.mul_(self._read(self.key_scale_pool[layer_id])),
+            value_layer.mul_(self._read(self.value_scale_pool[layer_id])),
+        )
+
+
+class StaticKVCache(KVCache):
+    """
+    Preallocated [max_length, b, np, hn] key/value buffers for static-shape decoding.
+
+    The write position is kept in a tensor and attention always reads the whole buffer with the slots past
+    the current length masked out, so a decode step has the same shapes and no host synchronization at every
+    length and can be captured once by `torch.compile`.
+    """
+
+    def __init__(self, num_layers: int, batch_size: int, max_length: int, dtype=None, device=None):
+        self.num_layers = num_layers
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.dtype = dtype
+        self.device = device
+        # buffers are allocated on the first write, when heads, head size and dtype are known
+        self.key_cache = None
+        self.value_cache = None
+        self.seq_length = torch.zeros((), dtype=torch.long, device=device)
+        self._write_index = None
+
+    @classmethod
+    def from_config(cls, config, batch_size: int, max_length: int, **kwargs):
+        return cls(config.num_layers, batch_size, min(max_length, config.max_sequence_length), **kwargs)
+
+    def __len__(self):
+        return self.batch_size
+
+    def get_seq_length(self) -> int:
+        return int(self.seq_length)
+
+    def reset(self):
+        self.seq_length.zero_()
+
+    def begin_forward(self, batch_size: int, num_tokens: int):
+        if batch_size != self.batch_size:
+            raise ValueError(
+                "Batch size {} does not match the {} sequences of the cache.".format(batch_size, self.batch_size)
+            )
+        self._write_index = self.seq_length + torch.arange(num_tokens, device=self.seq_length.device)
+        self.seq_length.add_(num_tokens)
+
+    def get_attention_mask(self, attention_mask: torch.Tensor) -> torch.Tensor:
+        # a mask over the first keys is padded, a single column broadcasts, the unwritten slots are masked below
+        if 1 < attention_mask.size(-1) < self.max_length:
+            attention_mask = F.pad(attention_mask, (0, self.max_length - attention_mask.size(-1)), value=False)
+        positions = torch.arange(self.max_length, device=attention_mask.device)
+        return attention_mask | (positions >= self.seq_length.to(attention_mask.device))
+
+    def _allocate_buffers(self, key_layer: torch.Tensor):
+        shape = (self.num_layers, self.max_length, self.batch_size) + tuple(key_layer.shape[2:])
+        dtype = self.dtype or key_layer.dtype
+        device = self.device or key_layer.device
+        self.key_cache = torch.zeros(shape, dtype=dtype, device=device)
+        self.value_cache = torch.zeros(shape, dtype=dtype, device=device)
+
+    def write_and_read(self, layer_id: int, key_layer: torch.Tensor, value_layer: torch.Tensor):
+        if self.key_cache is None:
+            self._allocate_buffers(key_layer)
+        key_cache, value_cache = self.key_cache[layer_id], self.value_cache[layer_id]
+        write_index = self._write_index.to(key_cache.device)
+        key_cache.index_copy_(0, write_index, key_layer.to(key_cache.dtype))
+        value_cache.index_copy_(0, write_index, value_layer.to(value_cache.dtype))
+        return key_cache, value_cache
+
+    def reorder(self, beam_idx: torch.LongTensor):
+        if self.key_cache is not None:
+            beam_idx = beam_idx.to(self.key_cache.device)
+            self.key_cache.copy_(self.key_cache.index_select(2, beam_idx))
+            self.value_cache.copy_(self.value_cache.index_select(2, beam_idx))
+        return self
+
+
+class PrefixCache:
+    """
+    Session keyed cache of the last prompt `past_key_values`, to resample the same round of a session.
+
+    A request of a session only prefills the tokens after the longest common prefix with the cached prompt.
+    Entries are evicted least recently used once their size exceeds `max_memory` bytes.
+    The first `context_length` tokens of a ChatGLM prompt (up to its bos token) attend to each other, their
+    keys/values depend on the whole context, so they are only reused by a prompt with the same context, e.g.
+    a round that is asked again or resampled. It does not speed up multi-turn chat: a new round changes the
+    context and is encoded in full.
+    """
+
+    def __init__(self, max_memory: int = 2 * 1024 ** 3):
+        self.max_memory = max_memory
+        self.memory = 0
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, session_id):
+        return session_id in self.entries
+
+    @staticmethod
+    def get_memory_size(past_key_values) -> int:
+        return sum(t.numel() * t.element_size() for layer_past in past_key_values for t in layer_past)
+
+    def get(self, session_id, input_ids: List[int], context_length: Optional[int] = None):
+        """
+        Returns the length of the reusable prefix of `input_ids` and its `past_key_values`.
+        `context_length` is the number of leading tokens attended bidirectionally, None for a causal prompt.
+        """
+        entry = self.entries.get(session_id)
+        if entry is None:
+            return 0, None
+        self.entries.move_to_end(session_id)
+        cached_ids, past_key_values, cached_context_length, _ = entry
+        # keep at least one token to prefill, its logits give the first generated token
+        max_prefix_length = min(len(cached_ids), len(input_ids) - 1)
+        prefix_length = 0
+        while prefix_length < max_prefix_length and cached_ids[prefix_length] == input_ids[prefix_length]:
+            prefix_length += 1
+        if prefix_length == 0:
+            return 0, None
+        if cached_context_length != context_length or prefix_length < (context_length or 0):
+            # the cached keys/values attended to a different context
+            return 0, None
+        return prefix_length, tuple((k[:prefix_length], v[:prefix_length]) for k, v in past_key_values)
+
+    def put(self, session_id, input_ids: List[int], past_key_values, context_length: Optional[int] = None):
+        self.pop(session_id)
+        memory_size = self.get_memory_size(past_key_values)
+        if memory_size > self.max_memory:
+            return
+        while self.entries and self.memory + memory_size > self.max_memory:
+            self.pop(next(iter(self.entries)))
+        self.entries[session_id] = (list(input_ids), past_key_values, context_length, memory_size)
+        self.memory += memory_size
+
+    def pop(self, session_id):
+        entry = self.entries.pop(session_id, None)
+        if entry is not None:
+            self.memory -= entry[-1]
+        return entry
+
+    def clear(self):
+        self.entries.clear()
+        self.memory = 0
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description: Static-shape decoding for ChatGLM on CPU.
+
+The decode loop runs outside of `generate`: keys/values go to a preallocated `StaticKVCache`
+and the 2D position ids of the next token are advanced on tensors, so a step never converts
+the sequence to a list and always has the same shapes, which lets `torch.compile` capture it once.
+"""
+from typing import List, Optional, Union
+
+import torch
+import torch.nn as nn
+from transformers.generation.logits_process import (
+    LogitsProcessorList,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+from .chatglm_cache import StaticKVCache
+from .chatglm_utils import get_mask_positions
+
+
+class StaticDecoder:
+    """
+    Decode loop of `ChatGLMForConditionalGeneration` with a preallocated key/value buffer.
+
+    Args:
+        model: A ChatGLMForConditionalGeneration model.
+        max_length: Longest sequence, prompt included, the key/value buffer is sized for it.
+        batch_size: Number of prompts decoded together, they must have the same length.
+        compile: Wrap the decode step in `torch.compile`.
+        compile_kwargs: Passed to `torch.compile`.
+    """
+
+    def __init__(
+            self,
+            model,
+            max_length: int = 2048,
+            batch_size: int = 1,
+            do_sample: bool = False,
+            top_p: float = 0.7,
+            top_k: Optional[int] = None,
+            temperature: float = 0.95,
+            logits_processor: Optional[LogitsProcessorList] = None,
+            eos_token_id=None,
+            compile: bool = False,
+            compile_kwargs: Optional[dict] = None,
+    ):
+        self.model = model
+        self.batch_size = batch_size
+        self.do_sample = do_sample
+        self.logits_processor = logits_processor if logits_processor is not None else LogitsProcessorList()
+        self.logits_warper = LogitsProcessorList()
+        if do_sample:
+            if temperature is not None and temperature != 1.0:
+                self.logits_warper.append(TemperatureLogitsWarper(temperature))
+            if top_k is not None and top_k != 0:
+                self.logits_warper.append(TopKLogitsWarper(top_k=int(top_k)))
+            if top_p is not None and top_p < 1.0:
+                self.logits_warper.append(TopPLogitsWarper(top_p=top_p))
+        if eos_token_id is None:
+            eos_token_id = model.config.eos_token_id
+        eos_token_id = [eos_token_id] if isinstance(eos_token_id, int) else list(eos_token_id)
+
+        device = self.device
+        self.kv_cache = StaticKVCache.from_config(model.config, batch_size, max_length, device=device)
+        self.max_length = self.kv_cache.max_length
+        self.eos_token_id = torch.tensor(eos_token_id, dtype=torch.long, device=device)
+        # the decode token sees every written slot, the cache masks the rest of the buffer
+        self._attention_mask = torch.zeros(1, 1, 1, 1, dtype=torch.bool, device=device)
+        self._ids_buffer = torch.zeros(batch_size, self.max_length, dtype=torch.long, device=device)
+        self.decode_step = self._decode_step
+        if compile:
+            self.decode_step = torch.compile(self._decode_step, **(compile_kwargs or {}))
+
+    @property
+    def device(self):
+        return next(self.model.parameters()).device
+
+    def _decode_step(self, input_ids: torch.LongTensor, position_ids: torch.LongTensor) -> torch.Tensor:
+        """One token per row, input_ids: [b, 1], position_ids: [b, 2, 1], returns the [b, vocab] logits."""
+        outputs = self.model(
+            input_ids=input_ids,
+            position_ids=position_ids,
+            attention_mask=self._attention_mask,
+            past_key_values=self.kv_cache,
+            use_cache=True,
+            return_dict=True,
+        )
+        return outputs.logits[:, -1]
+
+    def _sample(self, input_ids: torch.LongTensor, next_token_logits: torch.Tensor) -> torch.LongTensor:
+        scores = next_token_logits.float()
+        scores = self.logits_processor(input_ids, scores)
+        scores = self.logits_warper(input_ids, scores)
+        if self.do_sample:
+            probs = nn.functional.softmax(scores, dim=-1)
+            return torch.multinomial(probs, num_samples=1).squeeze(1)
+        return torch.argmax(scores, dim=-1)
+
+    @torch.no_grad()
+    def generate(
+            self,
+            input_ids: Union[torch.LongTensor, List[List[int]]],
+            max_new_tokens: Optional[int] = None,
+            callback=None,
+    ) -> torch.LongTensor:
+        """
+        Generates for [b, L] prompt ids, returns the [b, L + n] sequences, rows that stopped early are
+        padded with their eos token. `callback(next_tokens)` is called with the [b] tokens of every step.
+        """
+        device = self.device
+        input_ids = torch.as_tensor(input_ids, dtype=torch.long, device=device)
+        batch_size, prompt_length = input_ids.shape
+        if batch_size != self.batch_size:
+            raise ValueError(f"Batch size {batch_size} does not match the decoder batch size {self.batch_size}.")
+        max_length = self.max_length
+        if max_new_tokens is not None:
+            max_length = min(max_length, prompt_length + max_new_tokens)
+        if prompt_length >= max_length:
+            raise ValueError(f"Prompt of {prompt_length} tokens leaves no room to generate in {max_length}.")
+
+        ids = self._ids_buffer
+        ids[:, :prompt_length] = input_ids
+        mask_positions, context_lengths, use_gmasks = get_mask_positions(input_ids)
+        # block position of the first generated token, advanced on the tensor at every step
+        block_positions = prompt_length + 1 - context_lengths
+        finished = torch.zeros(batch_size, dtype=torch.bool, device=device)
+
+        # prefill with the prompt masks and positions `generate` would use
+        self.kv_cache.reset()
+        inputs = self.model.prepare_inputs_for_generation(
+            input_ids,
+            past_key_values=self.kv_cache,
+            mask_positions=mask_positions,
+            context_lengths=context_lengths,
+            use_gmasks=use_gmasks,
+        )
+        outputs = self.model(**inputs, use_cache=True, return_dict=True)
+        next_token_logits = outputs.logits[:, -1]
+        length = prompt_length
+        while True:
+            next_tokens = self._sample(ids[:, :length], next_token_logits)
+            next_tokens = torch.where(finished, self.eos_token_id[0], next_tokens)
+            ids[:, length] = next_tokens
+            length += 1
+            finished |= torch.isin(next_tokens, self.eos_token_id)
+            if callback is not None:
+                callback(next_tokens)
+            if length >= max_length or bool(finished.all()):
+                break
+            position_ids = torch.stack((mask_positions, block_positions), dim=1).unsqueeze(-1)
+            block_positions = block_positions + 1
+            next_token_logits = self.decode_step(next_tokens.unsqueeze(-1), position_ids)
+        return ids[:, :length].clone()
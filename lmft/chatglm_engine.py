@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description: Continuous batching inference engine for ChatGLM.
+
+New prompts join the running decode batch as soon as a slot is free, and finished
+sequences leave it after every step, so one long answer never holds up the others.
+Generated tokens can be streamed as text with `IncrementalDetokenizer`.
+"""
+import itertools
+from collections import deque
+from typing import List, Optional
+
+import torch
+import torch.nn as nn
+from transformers.generation.logits_process import (
+    LogitsProcessorList,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+from .chatglm_cache import PagedKVCache, PrefixCache
+
+MASK, gMASK, BOS = 150000, 150001, 150004
+
+
+class GenerationRequest:
+    """State of one sequence handled by the engine."""
+
+    def __init__(self, request_id, input_ids: List[int], max_length: int, session_id=None):
+        self.request_id = request_id
+        self.session_id = session_id
+        self.prompt_ids = list(input_ids)
+        self.output_ids = []
+        self.max_length = max_length
+        self.finished = False
+
+        mask_token = MASK if MASK in self.prompt_ids else gMASK
+        if mask_token not in self.prompt_ids:
+            raise ValueError("You have to add either [MASK] or [gMASK] in your input")
+        self.mask_position = self.prompt_ids.index(mask_token)
+        self.context_length = self.prompt_ids.index(BOS)
+
+        # preallocated ids buffer, logits processors read a view of it without re-building a tensor each step
+        self._ids_buffer = torch.zeros(1, max(max_length, len(self.prompt_ids)) + 1, dtype=torch.long)
+        self._ids_buffer[0, :len(self.prompt_ids)] = torch.tensor(self.prompt_ids, dtype=torch.long)
+        self.length = len(self.prompt_ids)
+
+    @property
+    def input_ids(self):
+        return self._ids_buffer[:, :self.length]
+
+    def append(self, token_id: int):
+        self._ids_buffer[0, self.length] = token_id
+        self.length += 1
+        self.output_ids.append(token_id)
+
+
+class ContinuousBatchingEngine:
+    """
+    Iteration-level scheduler on top of `ChatGLMForConditionalGeneration`.
+
+    Prompts are prefilled one by one with `prepare_inputs_for_generation`, then their per-layer
+    `past_key_values` are merged into the running batch. Caches of different lengths are left padded
+    and the padding is hidden with a per-row attention mask, so every row decodes one token per step.
+    With a `PagedKVCache` the prompt cache is copied into pages instead, and rows join and leave
+    without re-padding the others. With a `PrefixCache`, a request that repeats the prompt of its
+    session (e.g. to resample a round) only prefills what is not cached yet.
+    """
+    # generation arguments of `generate` the engine implements, other ones are not supported
+    generation_kwargs = (
+        "max_length", "max_new_tokens", "do_sample", "top_p", "top_k", "temperature", "logits_processor",
+        "eos_token_id",
+    )
+
+    def __init__(
+            self,
+            model,
+            max_batch_size: int = 8,
+            max_length: int = 2048,
+            max_new_tokens: Optional[int] = None,
+            do_sample: bool = True,
+            top_p: float = 0.7,
+            top_k: Optional[int] = None,
+            temperature: float = 0.95,
+            logits_processor: Optional[LogitsProcessorList] = None,
+            eos_token_id=None,
+            kv_cache: Optional[PagedKVCache] = None,
+            prefix_cache: Optional[PrefixCache] = None,
+    ):
+        self.model = model
+        self.kv_cache = kv_cache
+        self.prefix_cache = prefix_cache
+        self.max_batch_size = max_batch_size
+        self.max_length = max_length
+        self.max_new_tokens = max_new_tokens
+        self.do_sample = do_sample
+        self.logits_processor = logits_processor if logits_processor is not None else LogitsProcessorList()
+        self.logits_warper = LogitsProcessorList()
+        if do_sample:
+            if temperature is not None and temperature != 1.0:
+                self.logits_warper.append(TemperatureLogitsWarper(temperature))
+            if top_k is not None and top_k != 0:
+                self.logits_warper.append(TopKLogitsWarper(top_k=int(top_k)))
+            if top_p is not None and top_p < 1.0:
+                self.logits_warper.append(TopPLogitsWarper(top_p=top_p))
+        if eos_token_id is None:
+            eos_token_id = model.config.eos_token_id
+        self.eos_token_id = [eos_token_id] if isinstance(eos_token_id, int) else list(eos_token_id)
+
+        self.waiting = deque()
+        self.running: List[GenerationRequest] = []
+        self.past_key_values = None
+        # number of leading padded cache slots of every running row
+        self.pad_lengths = torch.zeros(0, dtype=torch.long)
+        self._counter = itertools.count()
+
+    @property
+    def device(self):
+        return next(self.model.parameters()).device
+
+    def add_request(self, input_ids: List[int], request_id=None, session_id=None):
+        if request_id is None:
+            request_id = next(self._counter)
+        max_length = self.max_length
+        if self.max_new_tokens is not None:
+            max_length = len(input_ids) + self.max_new_tokens
+        self.waiting.append(GenerationRequest(request_id, input_ids, max_length, session_id=session_id))
+        return request_id
+
+    def has_unfinished_requests(self):
+        return bool(self.waiting or self.running)
+
+    def _sample(self, requests: List[GenerationRequest], next_token_logits: torch.Tensor):
+        scores = next_token_logits.float()
+        if len(self.logits_processor) > 0:
+            scores = torch.cat([
+                self.logits_processor(req.input_ids.to(scores.device), scores[i:i + 1])
+                for i, req in enumerate(requests)
+            ])
+        scores = self.logits_warper(None, scores)
+        probs = nn.functional.softmax(scores, dim=-1)
+        if self.do_sample:
+            next_tokens = torch.multinomial(probs, num_samples=1).squeeze(1)
+        else:
+            next_tokens = torch.argmax(probs, dim=-1)
+        return next_tokens.tolist()
+
+    def _is_finished(self, req: GenerationRequest):
+        return req.output_ids[-1] in self.eos_token_id or req.length >= req.max_length
+
+    def _prefill(self, req: GenerationRequest):
+        use_prefix_cache = self.prefix_cache is not None and req.session_id is not None
+        prefix_length = 0
+        if use_prefix_cache:
+            # tokens before the bos token attend to each other, they are only reused with the same context
+            bos_token_id = self.model.config.bos_token_id
+            context_length = (
+                req.prompt_ids.index(bos_token_id) if bos_token_id in req.prompt_ids else len(req.prompt_ids)
+            )
+            prefix_length, past_key_values = self.prefix_cache.get(req.session_id, req.prompt_ids, context_length)
+        input_ids = torch.tensor([req.prompt_ids], dtype=torch.long, device=self.device)
+        model_inputs = self.model.prepare_inputs_for_generation(input_ids)
+        if prefix_length > 0:
+            # only the uncached part of the prompt goes through the model
+            model_inputs = {
+                "input_ids": input_ids[:, prefix_length:],
+                "position_ids": model_inputs["position_ids"][..., prefix_length:],
+                "attention_mask": model_inputs["attention_mask"][:, :, prefix_length:, :],
+                "past_key_values": past_key_values,
+            }
+        outputs = self.model(**model_inputs, use_cache=True, return_dict=True)
+        if use_prefix_cache:
+            self.prefix_cache.put(req.session_id, req.prompt_ids, outputs.past_key_values, context_length)
+        req.append(self._sample([req], outputs.logits[:, -1, :])[0])
+        return outputs.past_key_values
+
+    def _merge(self, past_key_values):
+        """Left pad the running cache and the new cache to a common length and stack them along batch."""
+        if self.kv_cache is not None:
+            self.kv_cache.add_sequence(past_key_values)
+            return
+        new_len = past_key_values[0][0].size(0)
+        if self.past_key_values is None:
+            self.past_key_values = past_key_values
+            self.pad_lengths = torch.zeros(1, dtype=torch.long)
+            return
+        run_len = self.past_key_values[0][0].size(0)
+        total = max(run_len, new_len)
+
+        def pad(t, length):
+            if length == total:
+                return t
+            return torch.cat((t.new_zeros((total - length,) + t.shape[1:]), t), dim=0)
+
+        self.past_key_values = tuple(
+            (
+                torch.cat((pad(run_k, run_len), pad(new_k, new_len)), dim=1),
+                torch.cat((pad(run_v, run_len), pad(new_v, new_len)), dim=1),
+            )
+            for (run_k, run_v), (new_k, new_v) in zip(self.past_key_values, past_key_values)
+        )
+        self.pad_lengths = torch.cat((
+            self.pad_lengths + (total - run_len),
+            torch.tensor([total - new_len], dtype=torch.long),
+        ))
+
+    def _evict(self, keep: List[int]):
+        """Drop finished rows from the running batch and trim padding columns shared by all rows."""
+        if self.kv_cache is not None:
+            self.kv_cache.keep_sequences(keep)
+            return
+        if not keep:
+            self.past_key_values = None
+            self.pad_lengths = torch.zeros(0, dtype=torch.long)
+            return
+        index = torch.tensor(keep, dtype=torch.long)
+        self.pad_lengths = self.pad_lengths.index_select(0, index)
+        trim = int(self.pad_lengths.min())
+        self.pad_lengths -= trim
+        self.past_key_values = tuple(
+            (
+                k[trim:].index_select(1, index.to(k.device)),
+                v[trim:].index_select(1, index.to(v.device)),
+            )
+            for k, v in self.past_key_values
+        )
+
+    def _decode(self):
+        device = self.device
+        input_ids = torch.tensor([[req.output_ids[-1]] for req in self.running], dtype=torch.long, device=device)
+        if self.model.config.position_encoding_2d:
+            position_ids = torch.tensor(
+                [[[req.mask_position], [req.length - req.context_length]] for req in self.running],
+                dtype=torch.long, device=device,
+            )
+        else:
+            position_ids = torch.tensor([[req.mask_position] for req in self.running], dtype=torch.long,
+                                        device=device)
+        if self.kv_cache is not None:
+            # the cache masks the unused slots of shorter rows itself
+            past_key_values, attention_mask = self.kv_cache, None
+        else:
+            seq_len = self.past_key_values[0][0].size(0) + 1
+            # [b, 1, 1, sk], True for padded slots
+            attention_mask = torch.arange(seq_len)[None, :] < self.pad_lengths[:, None]
+            attention_mask = attention_mask[:, None, None, :].to(device)
+            past_key_values = self.past_key_values
+        outputs = self.model(
+            input_ids=input_ids,
+            position_ids=position_ids,
+            attention_mask=attention_mask,
+            past_key_values=past_key_values,
+            use_cache=True,
+            return_dict=True,
+        )
+        if self.kv_cache is None:
+            self.past_key_values = outputs.past_key_values
+        for req, token in zip(self.running, self._sample(self.running, outputs.logits[:, -1, :])):
+            req.append(token)
+
+    def _admit(self) -> List[GenerationRequest]:
+        """Prefill waiting requests into the free slots of the running batch, returns the ones already finished."""
+        finished = []
+        while self.waiting and len(self.running) < self.max_batch_size:
+            req = self.waiting.popleft()
+            past_key_values = self._prefill(req)
+            if self._is_finished(req):
+                req.finished = True
+                finished.append(req)
+                continue
+            self._merge(past_key_values)
+            self.running.append(req)
+        return finished
+
+    def _advance(self) -> List[GenerationRequest]:
+        """Decode one token for every running request, returns the ones finished by it."""
+        finished = []
+        self._decode()
+        keep = []
+        for i, req in enumerate(self.running):
+            if self._is_finished(req):
+                req.finished = True
+                finished.append(req)
+            else:
+                keep.append(i)
+        if len(keep) < len(self.running):
+            self.running = [self.running[i] for i in keep]
+            self._evict(keep)
+        return finished
+
+    @torch.no_grad()
+    def step(self) -> List[GenerationRequest]:
+        """Run one scheduling iteration, returns the requests finished in it."""
+        finished = self._admit()
+        if self.running:
+            finished.extend(self._advance())
+        return finished
+
+    def generate(self, batch_input_ids: List[List[int]], callback=None, session_ids=None) -> List[List[int]]:
+        """Run all prompts to completion, returns the generated token ids in input order."""
+        if session_ids is None:
+            session_ids = [None] * len(batch_input_ids)
+        request_ids = [
+            self.add_request(input_ids, session_id=session_id)
+            for input_ids, session_id in zip(batch_input_ids, session_ids)
+        ]
+        results = {}
+        while self.has_unfinished_requests():
+            for req in self.step():
+                results[req.request_id] = req.output_ids
+                if callback is not None:
+                    callback(req)
+        return [results[request_id] for request_id in request_ids]
+
+    @torch.no_grad()
+    def stream(self, batch_input_ids: List[List[int]], session_ids=None):
+        """
+        Run all prompts to completion, yields the token ids generated for every prompt since the last yield,
+        in input order. The first tokens are yielded right after the prefill.
+        """
+        if session_ids is None:
+            session_ids = [None] * len(batch_input_ids)
+        requests = []
+        for input_ids, session_id in zip(batch_input_ids, session_ids):
+            self.add_request(input_ids, session_id=session_id)
+            requests.append(self.waiting[-1])
+        num_yielded = [0] * len(requests)
+
+        def new_token_ids():
+            outputs = [req.output_ids[n:] for req, n in zip(requests, num_yielded)]
+            for i, req in enumerate(requests):
+                num_yielded[i] = len(req.output_ids)
+            return outputs
+
+        while self.has_unfinished_requests():
+            self._admit()
+            outputs = new_token_ids()
+            if any(outputs):
+                yield outputs
+            if self.running:
+                self._advance()
+                yield new_token_ids()
+
+
+class IncrementalDetokenizer:
+    """
+    Turns the token ids of one sequence into text deltas.
+
+    Every step only decodes a window from the previously emitted tokens to the end instead of the whole
+    sequence. The window text is held back while it ends with an incomplete multi-byte character, which
+    the tokenizer decodes as U+FFFD, e.g. a CJK character split over several byte tokens.
+    """
+
+    def __init__(self, tokenizer, skip_special_tokens: bool = True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.token_ids = []
+        # token_ids[prefix_offset:read_offset] is the last emitted window, it gives the decoding context
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def _decode(self, token_ids: List[int]) -> str:
+        return self.tokenizer.decode(token_ids, skip_special_tokens=self.skip_special_tokens)
+
+    def _delta(self, hold_incomplete: bool = True) -> str:
+        prefix_text = self._decode(self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.token_ids[self.prefix_offset:])
+        if len(new_text) <= len(prefix_text) or (hold_incomplete and new_text.endswith("\ufffd")):
+            return ""
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.token_ids)
+        return new_text[len(prefix_text):]
+
+    def add_tokens(self, token_ids: List[int]) -> str:
+        """Append generated token ids, returns the text they complete."""
+        self.token_ids.extend(token_ids)
+        return self._delta()
+
+    def flush(self) -> str:
+        """Returns the text still held back at the end of the sequence."""
+        return self._delta(hold_incomplete=False)
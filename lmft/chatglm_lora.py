@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description: Multi-adapter LoRA serving on one base model.
+
+Adapters are `save_tunable_parameters` checkpoints (`lora.pt`) registered by name, loaded on first use
+and evicted least recently used. The target linears of the base model are wrapped once, a batch can mix
+adapters: every row gathers its own `lora_A`/`lora_B` and the deltas are applied with batched matmuls.
+"""
+import re
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import torch
+import torch.nn as nn
+from loguru import logger
+
+# `...query_key_value.lora_A.weight` (older peft) or `...query_key_value.lora_A.default.weight`
+LORA_KEY_PATTERN = re.compile(r"^(?:base_model\.model\.)?(.+)\.lora_([AB])(?:\.[^.]+)?\.weight$")
+
+
+class MultiLoraLinear(nn.Module):
+    """
+    Linear layer with a per-row LoRA delta, `lora_A`: [b, r, in] and `lora_B`: [b, out, r] (scaling folded
+    in) are set for the running batch, rows without an adapter have zero weights.
+    """
+
+    def __init__(self, base_layer: nn.Module, batch_dim: int = 1):
+        super().__init__()
+        self.base_layer = base_layer
+        self.batch_dim = batch_dim
+        self.lora_A = None
+        self.lora_B = None
+
+    def forward(self, x):
+        result = self.base_layer(x)
+        if self.lora_A is None:
+            return result
+        lora_A, lora_B = self.lora_A, self.lora_B
+        batch_size = x.size(self.batch_dim)
+        if batch_size != lora_A.size(0):
+            # `generate` expands every row for beam search and multiple return sequences
+            lora_A = lora_A.repeat_interleave(batch_size // lora_A.size(0), dim=0)
+            lora_B = lora_B.repeat_interleave(batch_size // lora_B.size(0), dim=0)
+        h = x.movedim(self.batch_dim, 0)
+        shape = h.shape
+        h = h.reshape(batch_size, -1, shape[-1]).to(lora_A.dtype)
+        delta = torch.bmm(torch.bmm(h, lora_A.transpose(1, 2)), lora_B.transpose(1, 2))
+        delta = delta.reshape(*shape[:-1], -1).movedim(0, self.batch_dim)
+        return result + delta.to(result.dtype)
+
+
+class LoraAdapterRegistry:
+    """
+    Named LoRA adapters over one base model.
+
+    Args:
+        model: The base ChatGLMForConditionalGeneration (or a peft model, its base model is used).
+        max_loaded_adapters: Adapters kept in memory, the least recently used one is evicted beyond it and
+            reloaded from its checkpoint when requested again.
+        lora_alpha: Default LoRA alpha, the scaling of an adapter is `lora_alpha / r`.
+        batch_dim: Batch dimension of the inputs of the wrapped linears, ChatGLM layers are [seq, b, hidden].
+    """
+
+    def __init__(self, model, max_loaded_adapters: int = 8, lora_alpha: float = 32, batch_dim: int = 1):
+        if hasattr(model, "get_base_model"):
+            model = model.get_base_model()
+        self.model = model
+        self.max_loaded_adapters = max_loaded_adapters
+        self.lora_alpha = lora_alpha
+        self.batch_dim = batch_dim
+        self.adapters = {}  # name -> (path, lora_alpha)
+        self.loaded = OrderedDict()  # name -> {module name: (lora_A, lora_B)}
+        self.layers = {}  # module name -> MultiLoraLinear
+
+    def __len__(self):
+        return len(self.adapters)
+
+    def __contains__(self, name):
+        return name in self.adapters
+
+    @property
+    def loaded_adapters(self) -> List[str]:
+        return list(self.loaded)
+
+    def register(self, name: str, path: str, lora_alpha: Optional[float] = None):
+        """Registers the checkpoint at `path` as adapter `name`, it is loaded on first use."""
+        self.unregister(name)
+        self.adapters[name] = (path, self.lora_alpha if lora_alpha is None else lora_alpha)
+
+    def unregister(self, name: str):
+        self.adapters.pop(name, None)
+        self.loaded.pop(name, None)
+
+    def _wrap(self, module_name: str) -> MultiLoraLinear:
+        layer = self.layers.get(module_name)
+        if layer is None:
+            parent_name, _, child_name = module_name.rpartition(".")
+            parent = self.model.get_submodule(parent_name)
+            layer = MultiLoraLinear(getattr(parent, child_name), batch_dim=self.batch_dim)
+            setattr(parent, child_name, layer)
+            self.layers[module_name] = layer
+        return layer
+
+    def get(self, name: str) -> Dict[str, tuple]:
+        """Weights of adapter `name`, loaded from its checkpoint if it is not in memory."""
+        if name not in self.adapters:
+            raise ValueError(f"Unknown LoRA adapter: {name}")
+        weights = self.loaded.get(name)
+        if weights is not None:
+            self.loaded.move_to_end(name)
+            return weights
+        path, lora_alpha = self.adapters[name]
+        state_dict = torch.load(path, map_location="cpu")
+        pairs = {}
+        for key, value in state_dict.items():
+            match = LORA_KEY_PATTERN.match(key)
+            if match is None:
+                continue
+            module_name, kind = match.groups()
+            pairs.setdefault(module_name, {})[kind] = value
+        if not pairs:
+            raise ValueError(f"No LoRA weights found in {path}")
+        weights = {}
+        for module_name, pair in pairs.items():
+            if len(pair) != 2:
+                raise ValueError(f"Incomplete LoRA weights of {module_name} in {path}")
+            base_layer = self._wrap(module_name).base_layer
+            param = next(base_layer.parameters())
+            dtype = param.dtype if param.is_floating_point() else torch.float16
+            lora_A, lora_B = pair["A"], pair["B"]
+            scaling = lora_alpha / lora_A.size(0)
+            weights[module_name] = (
+                lora_A.to(device=param.device, dtype=dtype),
+                (lora_B * scaling).to(device=param.device, dtype=dtype),
+            )
+        while len(self.loaded) >= self.max_loaded_adapters:
+            evicted, _ = self.loaded.popitem(last=False)
+            logger.debug(f"Evicted LoRA adapter {evicted}")
+        self.loaded[name] = weights
+        logger.debug(f"Loaded LoRA adapter {name} from {path}")
+        return weights
+
+    def _set_batch(self, adapter_names: List[Optional[str]]):
+        names = list(dict.fromkeys(name for name in adapter_names if name is not None))
+        if len(names) > self.max_loaded_adapters:
+            raise ValueError(
+                f"A batch uses {len(names)} adapters, more than `max_loaded_adapters={self.max_loaded_adapters}`."
+            )
+        adapter_weights = [self.get(name) for name in names]
+        # slot 0 holds zeros for rows without an adapter
+        slots = {name: i + 1 for i, name in enumerate(names)}
+        indices = torch.tensor([slots.get(name, 0) for name in adapter_names], dtype=torch.long)
+        for module_name, layer in self.layers.items():
+            pairs = [weights.get(module_name) for weights in adapter_weights]
+            present = [pair for pair in pairs if pair is not None]
+            if not present:
+                layer.lora_A = layer.lora_B = None
+                continue
+            # adapters of different ranks are padded with zeros to the largest one
+            rank = max(lora_A.size(0) for lora_A, _ in present)
+            lora_A, lora_B = present[0]
+            stacked_A = lora_A.new_zeros(len(pairs) + 1, rank, lora_A.size(1))
+            stacked_B = lora_B.new_zeros(len(pairs) + 1, lora_B.size(0), rank)
+            for i, pair in enumerate(pairs):
+                if pair is not None:
+                    stacked_A[i + 1, :pair[0].size(0)] = pair[0]
+                    stacked_B[i + 1, :, :pair[1].size(1)] = pair[1]
+            row_indices = indices.to(stacked_A.device)
+            layer.lora_A = stacked_A.index_select(0, row_indices)
+            layer.lora_B = stacked_B.index_select(0, row_indices)
+
+    def _clear_batch(self):
+        for layer in self.layers.values():
+            layer.lora_A = layer.lora_B = None
+
+    @contextmanager
+    def activate(self, adapter_names: List[Optional[str]]):
+        """
+        Runs the model with adapter `adapter_names[i]` on row `i` of the batch, `None` for the base model.
+        """
+        self._set_batch(adapter_names)
+        try:
+            yield self.model
+        finally:
+            self._clear_batch()
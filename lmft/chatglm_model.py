@@ -3,8 +3,11 @@
 @author:XuMing(xuming624@qq.com)
 @description:
 """
+import copy
 import os
 import random
+import time
+from contextlib import nullcontext
 from typing import Tuple, List
 
 import numpy as np
@@ -12,18 +15,28 @@ import torch
 import torch.nn as nn
 from loguru import logger
 from peft import get_peft_model, LoraConfig, TaskType
+from torch.utils.data import DataLoader
 from tqdm.auto import tqdm
-from transformers import AutoConfig, AutoTokenizer, Trainer
+from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer, Trainer, TrainerCallback
 from transformers import TrainingArguments
 from transformers.generation.utils import LogitsProcessorList
 from transformers.trainer import TRAINING_ARGS_NAME
 
+from .chatglm_cache import Int8PagedKVCache, PagedKVCache, PrefixCache
+from .chatglm_engine import ContinuousBatchingEngine, IncrementalDetokenizer
+from .chatglm_lora import LoraAdapterRegistry
+from .chatglm_speculative import SpeculativeDecoder, get_truncated_draft_model
 from .chatglm_utils import (
     ChatGLMForConditionalGeneration,
     ChatGLMArgs,
     InvalidScoreLogitsProcessor,
+    QUANTIZED_WEIGHTS_NAME,
+    get_prefix_lm_masks,
     load_hf_dataset,
     ChatGLMDataset,
+    PackedDataset,
+    LengthGroupedBatchSampler,
+    get_example_lengths,
 )
 
 try:
@@ -49,15 +62,67 @@ def save_tunable_parameters(model, path):
     torch.save(saved_params, path)
 
 
+class SetEpochCallback(TrainerCallback):
+    """Sets the epoch of a batch sampler with `set_epoch`, so that every epoch is shuffled differently."""
+
+    def on_epoch_begin(self, args, state, control, train_dataloader=None, **kwargs):
+        batch_sampler = getattr(train_dataloader, "batch_sampler", None)
+        if hasattr(batch_sampler, "set_epoch"):
+            batch_sampler.set_epoch(int(state.epoch or 0))
+
+
 class FinetuneTrainer(Trainer):
+    def __init__(self, *args, train_lengths=None, max_tokens_per_batch=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.train_lengths = train_lengths
+        self.max_tokens_per_batch = max_tokens_per_batch
+        if train_lengths is not None:
+            self.add_callback(SetEpochCallback)
+
+    def get_train_dataloader(self):
+        """With `train_lengths`, batches examples of similar length, or up to `max_tokens_per_batch` tokens."""
+        if self.train_lengths is None:
+            return super().get_train_dataloader()
+        max_tokens = self.max_tokens_per_batch
+        if max_tokens is not None:
+            # `auto_find_batch_size` lowers `_train_batch_size` after an OOM, shrink the token budget alike
+            max_tokens = max(1, max_tokens * self._train_batch_size // self.args.train_batch_size)
+        batch_sampler = LengthGroupedBatchSampler(
+            self.train_lengths,
+            batch_size=self._train_batch_size,
+            max_tokens=max_tokens,
+            seed=self.args.seed,
+            num_replicas=self.args.world_size,
+            rank=self.args.process_index,
+        )
+        return DataLoader(
+            self.train_dataset,
+            batch_sampler=batch_sampler,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+        )
+
     def compute_loss(self, model, inputs, return_outputs=False):
+        if model.training and self.tokenizer is not None:
+            # tokens that are not padding, logged as effective tokens/sec
+            if getattr(self, "_num_tokens", None) is None:
+                self._num_tokens, self._num_tokens_start = 0, time.time()
+            self._num_tokens += int((inputs["input_ids"] != self.tokenizer.pad_token_id).sum())
         return model(
             input_ids=inputs["input_ids"],
-            attention_mask=inputs["attention_mask"],
+            attention_mask=inputs.get("attention_mask"),
             position_ids=inputs["position_ids"],
             labels=inputs["labels"],
+            prefix_lengths=inputs.get("prefix_lengths"),
         ).loss
 
+    def log(self, logs, *args, **kwargs):
+        if getattr(self, "_num_tokens", None) and "loss" in logs:
+            logs["effective_tokens_per_second"] = round(self._num_tokens / (time.time() - self._num_tokens_start), 2)
+            self._num_tokens = None
+        super().log(logs, *args, **kwargs)
+
     def save_model(self, output_dir=None, _internal_call=False, lora_name='lora.pt'):
         os.makedirs(output_dir, exist_ok=True)
         torch.save(self.args, os.path.join(output_dir, TRAINING_ARGS_NAME))
@@ -126,10 +191,17 @@ class ChatGLMTune:
         config_class, model_class, tokenizer_class = MODEL_CLASSES[model_type]
         if model_name is None:
             model_name = "THUDM/chatglm-6b"
+        if os.path.isfile(os.path.join(model_name, QUANTIZED_WEIGHTS_NAME)):
+            # packed quantized weights, loaded as they are without re-quantizing
+            model = model_class.from_quantized(model_name)
+        else:
+            model = model_class.from_pretrained(model_name, trust_remote_code=True, **self.args.config)
         if use_cuda and torch.cuda.is_available():
-            self.model = model_class.from_pretrained(model_name, trust_remote_code=True).half().cuda()
+            self.model = model.half().cuda()
         else:
-            self.model = model_class.from_pretrained(model_name, trust_remote_code=True).float()
+            self.model = model.float()
+        self.weight_cache = None
+        self._set_dequantized_weight_cache()
 
         self.tokenizer_class = tokenizer_class
         if self.args.tokenizer_name:
@@ -147,6 +219,10 @@ class ChatGLMTune:
         else:
             self.args.model_name = model_name
         self.lora_loaded = False
+        self.prefix_cache = None
+        self.draft_model = None
+        self.speculative_metrics = None
+        self.lora_registry = None
 
     @staticmethod
     def get_masks_and_position_ids(seq_len, context_length, device, gmask=False, position_encoding_2d=True):
@@ -179,35 +255,107 @@ class ChatGLMTune:
                 position_ids[context_length - 1:] = mask_position
         return attention_mask, position_ids
 
+    @staticmethod
+    def get_batch_masks_and_position_ids(input_ids, bos_token_id, compact_mask=False):
+        """
+        Batched `get_masks_and_position_ids` with gmask=False, for right padded input_ids of shape [b, L].
+        Returns the [b, 1, L, L] attention mask (or the [b] prefix lengths it is built from if `compact_mask`)
+        and the [b, 2, L] position ids.
+        """
+        seq_length = input_ids.size(1)
+        positions = torch.arange(seq_length, device=input_ids.device)
+        if not (input_ids == bos_token_id).any(dim=-1).all():
+            raise ValueError(f"bos_token_id {bos_token_id} is not in every row of input_ids.")
+        context_lengths = (input_ids == bos_token_id).int().argmax(dim=-1)  # is equal to `seq.index(150004)`
+        mask_positions = context_lengths - 1
+        # columns `[:mask_position - 1]` are visible to every query, a negative end counts from the back
+        prefix_lengths = mask_positions - 1
+        prefix_lengths = torch.where(prefix_lengths < 0, prefix_lengths + seq_length, prefix_lengths)
+        attention_mask = prefix_lengths if compact_mask else get_prefix_lm_masks(prefix_lengths, seq_length)
+
+        in_block = positions[None, :] >= context_lengths[:, None]
+        position_ids = torch.where(in_block, mask_positions[:, None], positions[None, :])
+        block_position_ids = torch.where(in_block, positions[None, :] - context_lengths[:, None] + 1, 0)
+        position_ids = torch.stack((position_ids, block_position_ids), dim=1)
+        return attention_mask, position_ids, context_lengths
+
     def data_collator(self, batch):
-        len_ids = [len(example) for example in batch]
-        longest = max(len_ids)
-        input_ids = []
-        attention_mask_list = []
-        position_ids_list = []
-        labels_list = []
-        for ids_l, feature in sorted(zip(len_ids, batch), key=lambda x: -x[0]):
-            ids = list(feature)
-            seq_len = ids.index(self.tokenizer.bos_token_id) + 1  # is equal to `seq_len = seq.index(150004) + 1`
-            label_pad_token_id = -100
-            labels = (
-                    [label_pad_token_id] * (seq_len - 1)
-                    + ids[(seq_len - 1):]
-                    + [label_pad_token_id] * (longest - ids_l)
-            )
-            ids = ids + [self.tokenizer.pad_token_id] * (longest - ids_l)
-            _ids = torch.LongTensor(ids)
-            attention_mask, position_ids = self.get_masks_and_position_ids(
-                seq_len, longest, _ids.device, gmask=False
-            )
-            labels_list.append(torch.LongTensor(labels))
-            input_ids.append(_ids)
-            attention_mask_list.append(attention_mask)
-            position_ids_list.append(position_ids)
-        input_ids = torch.stack(input_ids)
-        labels = torch.stack(labels_list)
-        attention_mask = torch.stack(attention_mask_list)
-        position_ids = torch.stack(position_ids_list)
+        if self.args.use_packing:
+            return self.packed_data_collator(batch)
+        return self.padded_data_collator(batch)
+
+    def padded_data_collator(self, batch):
+        """Collate examples into right padded rows, longest first."""
+        batch = sorted(batch, key=lambda x: -len(x))
+        len_ids = torch.tensor([len(example) for example in batch], dtype=torch.long)
+        longest = int(len_ids[0])
+        input_ids = torch.full((len(batch), longest), self.tokenizer.pad_token_id, dtype=torch.long)
+        for i, example in enumerate(batch):
+            input_ids[i, :len(example)] = torch.from_numpy(np.asarray(example, dtype=np.int64))
+
+        compact_mask = self.args.use_compact_attention_mask
+        attention_mask, position_ids, context_lengths = self.get_batch_masks_and_position_ids(
+            input_ids, self.tokenizer.bos_token_id, compact_mask=compact_mask
+        )
+        # labels start at the bos token, prompt and padding are ignored
+        positions = torch.arange(longest)
+        label_pad_token_id = -100
+        labels = input_ids.masked_fill(
+            (positions[None, :] < context_lengths[:, None]) | (positions[None, :] >= len_ids[:, None]),
+            label_pad_token_id,
+        )
+        return {
+            "input_ids": input_ids,
+            "labels": labels,
+            "prefix_lengths" if compact_mask else "attention_mask": attention_mask,
+            "position_ids": position_ids,
+        }
+
+    def packed_data_collator(self, batch):
+        """
+        Collate rows of packed examples (see `PackedDataset`) into fixed-length rows, every example is a segment
+        with its own prefix-LM block on the diagonal of the attention mask and its own 2D position ids.
+        """
+        row_lengths = [sum(len(example) for example in row) for row in batch]
+        seq_length = max(self.args.packing_length or 0, max(row_lengths))
+        input_ids = torch.full((len(batch), seq_length), self.tokenizer.pad_token_id, dtype=torch.long)
+        # padding positions get their own negative segment id, they only attend to themselves
+        segment_ids = -torch.arange(1, seq_length + 1).repeat(len(batch), 1)
+        segment_starts = torch.zeros(len(batch), seq_length, dtype=torch.long)
+        segment_lengths = torch.ones(len(batch), seq_length, dtype=torch.long)
+        context_lengths = torch.zeros(len(batch), seq_length, dtype=torch.long)
+        for i, row in enumerate(batch):
+            start = 0
+            for j, example in enumerate(row):
+                example = np.asarray(example, dtype=np.int64)
+                end = start + len(example)
+                input_ids[i, start:end] = torch.from_numpy(example)
+                segment_ids[i, start:end] = j
+                segment_starts[i, start:end] = start
+                segment_lengths[i, start:end] = len(example)
+                context_lengths[i, start:end] = int(np.argmax(example == self.tokenizer.bos_token_id))
+                start = end
+
+        is_pad = segment_ids < 0
+        positions = torch.arange(seq_length)
+        relative_positions = positions[None, :] - segment_starts
+        # same logic as `get_batch_masks_and_position_ids`, relative to the start of every segment
+        mask_positions = context_lengths - 1
+        prefix_lengths = mask_positions - 1
+        prefix_lengths = torch.where(prefix_lengths < 0, prefix_lengths + segment_lengths, prefix_lengths)
+        visible = (
+                (segment_ids[:, :, None] == segment_ids[:, None, :])
+                & ((positions[None, None, :] <= positions[None, :, None])
+                   | (relative_positions[:, None, :] < prefix_lengths[:, :, None]))
+        )
+        attention_mask = ~visible.unsqueeze(1)
+
+        in_block = relative_positions >= context_lengths
+        position_ids = torch.where(in_block, mask_positions, relative_positions).masked_fill(is_pad, 0)
+        block_position_ids = torch.where(in_block, relative_positions - context_lengths + 1, 0).masked_fill(is_pad, 0)
+        position_ids = torch.stack((position_ids, block_position_ids), dim=1)
+        # the prompt of every segment is ignored, so the last token of a segment never predicts the next one
+        labels = input_ids.masked_fill(~in_block | is_pad, -100)
         return {
             "input_ids": input_ids,
             "labels": labels,
@@ -287,6 +435,14 @@ class ChatGLMTune:
         self._move_model_to_device()
         # load dataset
         train_dataset = self.load_and_cache_examples(train_data, verbose=verbose)
+        if self.args.use_packing:
+            packing_length = self.args.packing_length or self.args.max_seq_length + self.args.max_length + 1
+            self.args.packing_length = packing_length
+            train_dataset = PackedDataset(train_dataset, packing_length)
+        train_lengths = None
+        if self.args.group_by_length or self.args.max_tokens_per_batch:
+            # read from the feature cache index when available
+            train_lengths = get_example_lengths(train_dataset)
         os.makedirs(output_dir, exist_ok=True)
         logger.debug(f"dataset: {train_dataset} first row: {next(iter(train_dataset))}")
 
@@ -317,6 +473,8 @@ class ChatGLMTune:
             args=training_args,
             tokenizer=self.tokenizer,
             data_collator=self.data_collator,
+            train_lengths=train_lengths,
+            max_tokens_per_batch=self.args.max_tokens_per_batch,
         )
         (global_step, training_loss, metrics) = trainer.train()
 
@@ -347,13 +505,159 @@ class ChatGLMTune:
                 logger.info(f"Loaded lora model from {lora_path}")
                 self.lora_loaded = True
 
+    def merge_lora(self, output_dir=None, quantization_bit=0, quantization_group_size=0):
+        """
+        Folds the LoRA weights into the base weights (`W + lora_B @ lora_A * scaling`) and removes the
+        LoRA wrappers, inference then runs at the speed of the base model.
+
+        Args:
+            output_dir (optional): Directory to save the merged ChatGLMForConditionalGeneration, tokenizer
+                and model args to, it loads with `ChatGLMTune('chatglm', output_dir, args={'use_lora': False})`.
+            quantization_bit (optional): Quantize the merged model to 8 or 4 bits before saving.
+            quantization_group_size (optional): Input channels sharing a quantization scale, 0 for one scale per row.
+
+        Returns:
+            model: The merged model.
+        """  # noqa: ignore flake8"
+        if not self.lora_loaded:
+            self.load_lora()
+        if not hasattr(self.model, "merge_and_unload"):
+            raise ValueError("No LoRA weights to merge, train a LoRA model or set `use_lora` with a saved lora.")
+        model = self.model.merge_and_unload()
+        if isinstance(model.lm_head, CastOutputToFloat):
+            model.lm_head = model.lm_head[0]
+        model.config.use_cache = True
+        self.model = model
+        # the LoRA weights are part of the model now, they must not be loaded again
+        self.lora_loaded = True
+        logger.info("Merged lora weights into the model")
+        if quantization_bit:
+            self.model = self.model.quantize(quantization_bit, group_size=quantization_group_size)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+            if quantization_bit:
+                self.model.save_quantized(output_dir)
+            else:
+                self.model.save_pretrained(output_dir)
+            self.tokenizer.save_pretrained(output_dir)
+            args = copy.deepcopy(self.args)
+            args.use_lora = False
+            args.save(output_dir)
+            logger.info(f"Saved merged model to {output_dir}")
+        return self.model
+
     @torch.no_grad()
-    def chat(self, query: str, history: List[Tuple[str, str]] = None, logits_processor=None, **kwargs):
+    def get_perplexity(self, eval_data):
+        """
+        Perplexity of the model on the responses of `eval_data`, the prompts are not scored.
+
+        Args:
+            eval_data: Pandas DataFrame containing the 3 columns - `instruction`, `input`, `output`.
+        """  # noqa: ignore flake8"
+        dataset = self.load_and_cache_examples(eval_data, evaluate=True, verbose=False)
+        dataloader = DataLoader(dataset, batch_size=self.args.eval_batch_size, collate_fn=self.padded_data_collator)
+        total_loss, total_tokens = 0.0, 0
+        for batch in dataloader:
+            batch = {k: v.to(self.device) for k, v in batch.items()}
+            loss = self.model(**batch).loss
+            # the loss is the mean over the shifted labels
+            num_tokens = int((batch["labels"][:, 1:] != -100).sum())
+            total_loss += float(loss) * num_tokens
+            total_tokens += num_tokens
+        return float(np.exp(total_loss / max(total_tokens, 1)))
+
+    def quantize(self, bits: int, group_size=0, calibration_data=None, eval_data=None, grid_size=20,
+                 max_calibration_rows=512):
+        """
+        Quantizes the linears of the model to `bits` (8 or 4) bits. With `calibration_data` the rounding is
+        activation-aware: the examples run through the float model first and the input channels with the
+        largest activations are scaled up before rounding, which mostly helps int4.
+
+        Args:
+            bits: 8 or 4.
+            group_size (optional): Input channels sharing a quantization scale, 0 for one scale per row.
+            calibration_data (optional): Pandas DataFrame containing the 3 columns - `instruction`, `input`,
+                `output`, a few hundred of the prompts to be served are enough.
+            eval_data (optional): Held out examples to report the perplexity on, defaults to `calibration_data`
+                with a warning, as the scales are fit on it.
+            grid_size (optional): Number of exponents tried for the activation-aware scales.
+            max_calibration_rows (optional): Input rows kept per linear to search its scale.
+
+        Returns:
+            results: `perplexity` of the float model, `quantized_perplexity` and `perplexity_delta`, empty
+                without evaluation data.
+        """  # noqa: ignore flake8"
+        from .quantization import get_activation_aware_scales
+
+        if not isinstance(self.model, ChatGLMForConditionalGeneration):
+            raise ValueError("Only a ChatGLM model without LoRA wrappers can be quantized, call `merge_lora` first.")
+        if eval_data is None and calibration_data is not None:
+            logger.warning("No `eval_data`, the perplexity is measured on the calibration data the scales are fit on, "
+                           "which underestimates the perplexity delta, pass held out examples as `eval_data`.")
+            eval_data = calibration_data
+        self.model.eval()
+        results = {}
+        if eval_data is not None:
+            results["perplexity"] = self.get_perplexity(eval_data)
+        input_scales = None
+        if calibration_data is not None:
+            dataset = self.load_and_cache_examples(calibration_data, evaluate=True, verbose=False)
+            dataloader = DataLoader(dataset, batch_size=self.args.eval_batch_size,
+                                    collate_fn=self.padded_data_collator)
+            batches = []
+            for batch in dataloader:
+                batch.pop("labels")
+                batches.append({k: v.to(self.device) for k, v in batch.items()})
+            input_scales = get_activation_aware_scales(
+                self.model, batches, bits, group_size=group_size, grid_size=grid_size,
+                max_rows=max_calibration_rows,
+            )
+            logger.info(f"Calibrated {len(input_scales)} linears on {len(dataset)} examples")
+        self.model = self.model.quantize(bits, group_size=group_size, input_scales=input_scales)
+        self._set_dequantized_weight_cache()
+        if eval_data is not None:
+            results["quantized_perplexity"] = self.get_perplexity(eval_data)
+            results["perplexity_delta"] = results["quantized_perplexity"] - results["perplexity"]
+            logger.info(f"Perplexity {results['perplexity']:.4f} -> {results['quantized_perplexity']:.4f} "
+                        f"after {bits}-bit quantization")
+        return results
+
+    def _set_dequantized_weight_cache(self):
+        """Budgeted float weight cache of a quantized model on cpu, see `dequantized_weight_cache_memory`"""
+        if self.args.dequantized_weight_cache_memory and getattr(self.model, "quantized", False) \
+                and self.device == "cpu":
+            self.weight_cache = self.model.set_dequantized_weight_cache(self.args.dequantized_weight_cache_memory)
+            logger.debug(f"{self.weight_cache.num_resident_linears}/{len(self.weight_cache.linears)} "
+                         f"quantized linears keep their float weights")
+
+    def add_lora_adapter(self, name: str, lora_path: str, lora_alpha=None):
+        """
+        Registers a LoRA checkpoint saved by `save_tunable_parameters` as adapter `name`, to be selected
+        per sentence with `predict(..., adapter_names=...)`. All adapters share the base model, at most
+        `max_lora_adapters` are kept in memory.
+        """
+        if not self.lora_loaded:
+            self.load_lora()
+        if hasattr(self.model, "merge_and_unload"):
+            raise ValueError("A peft LoRA is loaded, call `merge_lora()` or set `use_lora=False` before "
+                             "`add_lora_adapter`.")
+        if self.lora_registry is None:
+            self.lora_registry = LoraAdapterRegistry(
+                self.model,
+                max_loaded_adapters=self.args.max_lora_adapters,
+                lora_alpha=self.args.lora_alpha,
+            )
+        self.lora_registry.register(name, lora_path, lora_alpha=lora_alpha)
+
+    @torch.no_grad()
+    def chat(self, query: str, history: List[Tuple[str, str]] = None, logits_processor=None, session_id=None,
+             **kwargs):
         """
         Chat with the model
         :param query:
         :param history:
         :param logits_processor:
+        :param session_id: with `use_prefix_cache`, resampling the same round of the session reuses its prompt cache
         :param kwargs:
         :return: response, history
         """
@@ -361,26 +665,58 @@ class ChatGLMTune:
         self.model.eval()
         if history is None:
             history = []
-        if not history:
-            prompt = query
-        else:
-            prompt = ""
-            for i, (old_query, response) in enumerate(history):
-                prompt += "[Round {}]\n问：{}\n答：{}\n".format(i, old_query, response)
-            prompt += "[Round {}]\n问：{}\n答：".format(len(history), query)
-        response = self.predict([prompt], logits_processor=logits_processor, **kwargs)[0]
+        prompt = self.build_chat_prompt(query, history)
+        session_ids = [session_id] if session_id is not None else None
+        response = self.predict([prompt], logits_processor=logits_processor, session_ids=session_ids, **kwargs)[0]
         response = response.strip()
         history = history + [(query, response)]
         return response, history
 
+    @staticmethod
+    def build_chat_prompt(query: str, history: List[Tuple[str, str]] = None):
+        if not history:
+            return query
+        prompt = ""
+        for i, (old_query, response) in enumerate(history):
+            prompt += "[Round {}]\n问：{}\n答：{}\n".format(i, old_query, response)
+        prompt += "[Round {}]\n问：{}\n答：".format(len(history), query)
+        return prompt
+
+    def stream_chat(self, query: str, history: List[Tuple[str, str]] = None, logits_processor=None,
+                    session_id=None, **kwargs):
+        """
+        Chat with the model, streaming the response
+        :param query:
+        :param history:
+        :param logits_processor:
+        :param session_id: with `use_prefix_cache`, resampling the same round of the session reuses its prompt cache
+        :param kwargs:
+        :return: generator of (delta, history), delta is the new text, history ends with the response so far
+        """
+        if history is None:
+            history = []
+        prompt = self.build_chat_prompt(query, history)
+        session_ids = [session_id] if session_id is not None else None
+        response = ""
+        for deltas in self.stream_predict([prompt], logits_processor=logits_processor, session_ids=session_ids,
+                                          **kwargs):
+            delta = deltas[0] if response else deltas[0].lstrip()
+            if not delta:
+                continue
+            response += delta
+            yield delta, history + [(query, response)]
+
     @torch.no_grad()
-    def predict(self, sentences, logits_processor=None, keep_prompt=False, **kwargs):
+    def predict(self, sentences, logits_processor=None, keep_prompt=False, session_ids=None, adapter_names=None,
+                **kwargs):
         """
         Performs predictions on a list of text.
 
         Args:
             sentences: A python list of text (str) to be sent to the model for prediction. 
             logits_processor: A LogitsProcessor object that will be applied to the model's
+            session_ids (optional): Chat session of each sentence, used to resample a prompt with `use_prefix_cache`.
+            adapter_names (optional): LoRA adapter of each sentence added with `add_lora_adapter`, None for the base model.
 
         Returns:
             preds: A python list of the generated sequences.
@@ -397,16 +733,37 @@ class ChatGLMTune:
         if logits_processor is None:
             logits_processor = LogitsProcessorList()
         logits_processor.append(InvalidScoreLogitsProcessor())
+        if adapter_names is not None:
+            if self.lora_registry is None:
+                raise ValueError("`adapter_names` needs adapters added with `add_lora_adapter`.")
+            if len(adapter_names) != len(sentences):
+                raise ValueError("`adapter_names` must have one adapter per sentence.")
+            if (self.args.use_speculative_decoding or self.args.use_continuous_batching
+                    or (session_ids is not None and self.args.use_prefix_cache)):
+                raise ValueError("`adapter_names` is not supported with speculative decoding or continuous batching.")
+        if self.args.use_speculative_decoding:
+            return self._predict_speculative(sentences, logits_processor, keep_prompt, **kwargs)
+        if self.args.use_continuous_batching or (session_ids is not None and self.args.use_prefix_cache):
+            unsupported = self._get_unsupported_engine_kwargs(kwargs)
+            if not unsupported:
+                return self._predict_continuous_batching(
+                    sentences, logits_processor, keep_prompt, session_ids=session_ids, **kwargs
+                )
+            logger.warning(f"{unsupported} not supported by continuous batching, generating with `generate`")
         # Batching
-        for batch in tqdm(
-                [
-                    sentences[i: i + self.args.eval_batch_size]
-                    for i in range(0, len(sentences), self.args.eval_batch_size)
-                ],
+        for start in tqdm(
+                range(0, len(sentences), self.args.eval_batch_size),
                 desc="Generating outputs",
                 disable=self.args.silent,
         ):
-            inputs = self.tokenizer(batch, padding=True, return_tensors='pt').to(self.device)
+            batch = sentences[start: start + self.args.eval_batch_size]
+            # rows are left padded, the model masks the padding and counts positions from the first token
+            padding_side = self.tokenizer.padding_side
+            self.tokenizer.padding_side = "left"
+            try:
+                inputs = self.tokenizer(batch, padding=True, return_tensors='pt').to(self.device)
+            finally:
+                self.tokenizer.padding_side = padding_side
             gen_kwargs = {
                 "max_length": self.args.max_length,
                 "num_beams": self.args.num_beams,
@@ -416,12 +773,18 @@ class ChatGLMTune:
                 "logits_processor": logits_processor,
                 **kwargs
             }
-            outputs = self.model.generate(**inputs, **gen_kwargs)
+            kv_cache = self._get_kv_cache(len(batch) * gen_kwargs["num_beams"], gen_kwargs["max_length"])
+            if kv_cache is not None:
+                gen_kwargs["past_key_values"] = kv_cache
+            adapters = nullcontext()
+            if adapter_names is not None:
+                adapters = self.lora_registry.activate(adapter_names[start: start + self.args.eval_batch_size])
+            with adapters:
+                outputs = self.model.generate(**inputs, **gen_kwargs)
+            prompt_length = inputs["input_ids"].size(1)
             for idx, (prompt_text, generated_sequence) in enumerate(zip(batch, outputs)):
                 # Decode text
-                text = self.tokenizer.decode(generated_sequence, skip_special_tokens=True)
-                prompt_len = len(prompt_text)
-                gen_text = text[prompt_len:]
+                gen_text = self.tokenizer.decode(generated_sequence[prompt_length:], skip_special_tokens=True)
                 if keep_prompt:
                     total_sequence = prompt_text + gen_text
                 else:
@@ -429,6 +792,145 @@ class ChatGLMTune:
                 all_outputs.append(total_sequence)
         return all_outputs
 
+    @torch.no_grad()
+    def stream_predict(self, sentences, logits_processor=None, session_ids=None, **kwargs):
+        """
+        Performs predictions on a list of text, streaming the generated text.
+        All sentences are generated together with the continuous batching engine.
+
+        Args:
+            sentences: A python list of text (str) to be sent to the model for prediction.
+            logits_processor: A LogitsProcessor object that will be applied to the model's
+            session_ids (optional): Chat session of each sentence, used to resample a prompt with `use_prefix_cache`.
+
+        Yields:
+            deltas: A python list with the new text of every sentence, "" for sentences without new text.
+        """  # noqa: ignore flake8"
+
+        if not self.lora_loaded:
+            self.load_lora()
+        self._move_model_to_device()
+        if torch.cuda.is_available() and self.args.fp16:
+            self.model = self.model.half().cuda()
+        self.model.eval()
+
+        if logits_processor is None:
+            logits_processor = LogitsProcessorList()
+        logits_processor.append(InvalidScoreLogitsProcessor())
+        engine = self._get_engine(logits_processor, **kwargs)
+        batch_input_ids = [self.tokenizer(sentence)["input_ids"] for sentence in sentences]
+        detokenizers = [IncrementalDetokenizer(self.tokenizer) for _ in sentences]
+        for new_token_ids in engine.stream(batch_input_ids, session_ids=session_ids):
+            yield [
+                detokenizer.add_tokens(token_ids) if token_ids else ""
+                for detokenizer, token_ids in zip(detokenizers, new_token_ids)
+            ]
+        deltas = [detokenizer.flush() for detokenizer in detokenizers]
+        if any(deltas):
+            yield deltas
+
+    @staticmethod
+    def _get_unsupported_engine_kwargs(kwargs):
+        return sorted(k for k in kwargs if k not in ContinuousBatchingEngine.generation_kwargs and k != "num_beams")
+
+    def _get_engine(self, logits_processor, **kwargs):
+        """Continuous batching engine over the model, `eval_batch_size` is the running batch size."""
+        unsupported = self._get_unsupported_engine_kwargs(kwargs)
+        if unsupported:
+            raise ValueError("Continuous batching does not support the generation arguments {}.".format(unsupported))
+        gen_kwargs = {
+            "max_length": self.args.max_length,
+            "do_sample": self.args.do_sample,
+            "top_p": self.args.top_p,
+            "top_k": self.args.top_k,
+            "temperature": self.args.temperature,
+            **kwargs
+        }
+        num_beams = gen_kwargs.pop("num_beams", self.args.num_beams)
+        if num_beams != 1:
+            raise ValueError("Continuous batching only supports `num_beams=1`, got {}.".format(num_beams))
+        kv_cache = self._get_kv_cache(self.args.eval_batch_size, gen_kwargs["max_length"])
+        if self.args.use_prefix_cache and self.prefix_cache is None:
+            self.prefix_cache = PrefixCache(max_memory=self.args.prefix_cache_max_memory)
+        return ContinuousBatchingEngine(
+            self.model,
+            max_batch_size=self.args.eval_batch_size,
+            logits_processor=logits_processor,
+            eos_token_id=self.tokenizer.eos_token_id,
+            kv_cache=kv_cache,
+            prefix_cache=self.prefix_cache if self.args.use_prefix_cache else None,
+            **gen_kwargs
+        )
+
+    def _get_kv_cache(self, batch_size, max_length):
+        """Paged key/value cache with `use_paged_kv_cache`, int8 with `use_int8_kv_cache`, else None"""
+        if self.args.use_int8_kv_cache:
+            cache_class = Int8PagedKVCache
+        elif self.args.use_paged_kv_cache:
+            cache_class = PagedKVCache
+        else:
+            return None
+        return cache_class.from_config(
+            self.model.config,
+            batch_size=batch_size,
+            max_length=max_length,
+            block_size=self.args.kv_cache_block_size,
+        )
+
+    def _predict_continuous_batching(self, sentences, logits_processor, keep_prompt=False, session_ids=None, **kwargs):
+        """Generate with the continuous batching engine."""
+        engine = self._get_engine(logits_processor, **kwargs)
+        batch_input_ids = [self.tokenizer(sentence)["input_ids"] for sentence in sentences]
+        with tqdm(total=len(sentences), desc="Generating outputs", disable=self.args.silent) as pbar:
+            outputs = engine.generate(batch_input_ids, callback=lambda req: pbar.update(1), session_ids=session_ids)
+        all_outputs = []
+        for prompt_text, output_ids in zip(sentences, outputs):
+            gen_text = self.tokenizer.decode(output_ids, skip_special_tokens=True)
+            all_outputs.append(prompt_text + gen_text if keep_prompt else gen_text)
+        return all_outputs
+
+    def _get_draft_model(self):
+        if self.draft_model is None:
+            if self.args.draft_model_name:
+                self.draft_model = AutoModelForCausalLM.from_pretrained(
+                    self.args.draft_model_name, trust_remote_code=True
+                ).to(next(self.model.parameters()).dtype).to(self.device)
+            else:
+                self.draft_model = get_truncated_draft_model(self.model, self.args.draft_num_layers)
+            self.draft_model.eval()
+        return self.draft_model
+
+    def _predict_speculative(self, sentences, logits_processor, keep_prompt=False, **kwargs):
+        """Generate one sentence at a time with speculative decoding, the draft proposes `num_speculative_tokens`."""
+        gen_kwargs = {
+            "max_length": self.args.max_length,
+            "do_sample": self.args.do_sample,
+            "top_p": self.args.top_p,
+            "top_k": self.args.top_k,
+            "temperature": self.args.temperature,
+            **kwargs
+        }
+        num_beams = gen_kwargs.pop("num_beams", self.args.num_beams)
+        if num_beams != 1:
+            raise ValueError("Speculative decoding only supports `num_beams=1`, got {}.".format(num_beams))
+        decoder = SpeculativeDecoder(
+            self.model,
+            self._get_draft_model(),
+            num_speculative_tokens=self.args.num_speculative_tokens,
+            logits_processor=logits_processor,
+            eos_token_id=self.tokenizer.eos_token_id,
+            **gen_kwargs
+        )
+        all_outputs = []
+        for prompt_text in tqdm(sentences, desc="Generating outputs", disable=self.args.silent):
+            output_ids = decoder.generate(self.tokenizer(prompt_text)["input_ids"])
+            gen_text = self.tokenizer.decode(output_ids, skip_special_tokens=True)
+            all_outputs.append(prompt_text + gen_text if keep_prompt else gen_text)
+        self.speculative_metrics = decoder.get_metrics()
+        if not self.args.silent:
+            logger.info(f"Speculative decoding: {self.speculative_metrics}")
+        return all_outputs
+
     def _move_model_to_device(self):
         self.model.to(self.device)
 
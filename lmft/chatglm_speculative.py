@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description: Speculative decoding for ChatGLM.
+
+A small draft model proposes `k` tokens one by one, the target model scores all of them in one
+forward and keeps the longest prefix the speculative sampling rule accepts, plus one token of its
+own. The output has exactly the distribution of sampling from the target model alone, greedy
+decoding gives the same tokens as greedy `generate`.
+"""
+import copy
+import time
+from typing import List, Optional
+
+import torch
+import torch.nn as nn
+from transformers.generation.logits_process import (
+    LogitsProcessorList,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+from .chatglm_utils import get_mask_positions
+
+
+def is_chatglm(model) -> bool:
+    return getattr(model.config, "model_type", None) == "chatglm"
+
+
+def get_truncated_draft_model(model, num_layers: int):
+    """
+    Draft model made of the first `num_layers` layers of a ChatGLM `model`, with its embeddings, final
+    layer norm and lm head. All weights (LoRA included) are shared with `model`, no memory is copied.
+    """
+    if hasattr(model, "get_base_model"):
+        model = model.get_base_model()
+    if not 0 < num_layers < model.config.num_layers:
+        raise ValueError(f"`num_layers` must be in [1, {model.config.num_layers}), got {num_layers}.")
+    # shallow copies with their own module dicts, so that the layer list can be replaced
+    transformer = copy.copy(model.transformer)
+    transformer._modules = copy.copy(model.transformer._modules)
+    transformer.layers = nn.ModuleList(model.transformer.layers[:num_layers])
+    transformer.num_layers = num_layers
+    draft = copy.copy(model)
+    draft._modules = copy.copy(model._modules)
+    draft.transformer = transformer
+    draft.config = copy.deepcopy(model.config)
+    draft.config.num_layers = num_layers
+    return draft
+
+
+def accept_draft_tokens(target_probs: torch.Tensor, draft_probs: torch.Tensor, draft_tokens: List[int],
+                        do_sample: bool = True):
+    """
+    Speculative sampling rule.
+    target_probs: [k + 1, V] target distributions after the prompt and after every draft token
+    draft_probs: [k, V] draft distributions the `k` draft tokens were sampled from
+    returns: number of accepted draft tokens and the next token, sampled from the residual
+    distribution `max(0, p - q)` at the first rejection or from the last target distribution.
+    """
+    for i, token in enumerate(draft_tokens):
+        p, q = target_probs[i], draft_probs[i]
+        if not do_sample:
+            next_token = int(p.argmax())
+            if next_token != token:
+                return i, next_token
+            continue
+        if float(torch.rand(())) * float(q[token]) < float(p[token]):
+            continue
+        residual = (p - q).clamp(min=0)
+        if float(residual.sum()) <= 0:
+            residual = p
+        return i, int(torch.multinomial(residual / residual.sum(), num_samples=1))
+    p = target_probs[len(draft_tokens)]
+    if not do_sample:
+        return len(draft_tokens), int(p.argmax())
+    return len(draft_tokens), int(torch.multinomial(p, num_samples=1))
+
+
+class _ModelState:
+    """Key/value cache of one model over the first `length` tokens of the sequence."""
+
+    def __init__(self, model):
+        self.model = model
+        self.is_chatglm = is_chatglm(model)
+        self.past_key_values = None
+        self.length = 0
+        # logits after the last cached token, None once the cache is behind the sequence
+        self.next_logits = None
+
+    def crop(self, length: int):
+        if length >= self.length:
+            return
+        past_key_values = self.past_key_values
+        if hasattr(past_key_values, "crop"):
+            past_key_values.crop(length)
+        else:
+            # ChatGLM caches are [seq, b, np, hn], the legacy HF ones [b, np, seq, hn]
+            seq_dim = 0 if self.is_chatglm else 2
+            self.past_key_values = tuple(
+                tuple(t.narrow(seq_dim, 0, length) for t in layer_past) for layer_past in past_key_values
+            )
+        self.length = length
+        self.next_logits = None
+
+
+class SpeculativeDecoder:
+    """
+    Speculative decoding of a ChatGLM target model with a draft model of the same vocabulary.
+
+    Args:
+        model: The target ChatGLMForConditionalGeneration (or a peft model around it).
+        draft_model: A smaller causal LM with the same token ids, e.g. `get_truncated_draft_model(model, 2)`
+            or any HF causal LM.
+        num_speculative_tokens: Number of draft tokens `k` verified by one target forward.
+        max_length: Longest sequence, prompt included.
+        max_new_tokens: Most tokens generated per prompt, overrides `max_length`.
+    """
+
+    def __init__(
+            self,
+            model,
+            draft_model,
+            num_speculative_tokens: int = 4,
+            max_length: int = 2048,
+            max_new_tokens: Optional[int] = None,
+            do_sample: bool = True,
+            top_p: float = 0.7,
+            top_k: Optional[int] = None,
+            temperature: float = 0.95,
+            logits_processor: Optional[LogitsProcessorList] = None,
+            eos_token_id=None,
+    ):
+        if not is_chatglm(model):
+            raise ValueError("The target model of `SpeculativeDecoder` must be a ChatGLM model.")
+        self.model = model
+        self.draft_model = draft_model
+        self.num_speculative_tokens = num_speculative_tokens
+        self.max_length = max_length
+        self.max_new_tokens = max_new_tokens
+        self.do_sample = do_sample
+        self.logits_processor = logits_processor if logits_processor is not None else LogitsProcessorList()
+        self.logits_warper = LogitsProcessorList()
+        if do_sample:
+            if temperature is not None and temperature != 1.0:
+                self.logits_warper.append(TemperatureLogitsWarper(temperature))
+            if top_k is not None and top_k != 0:
+                self.logits_warper.append(TopKLogitsWarper(top_k=int(top_k)))
+            if top_p is not None and top_p < 1.0:
+                self.logits_warper.append(TopPLogitsWarper(top_p=top_p))
+        if eos_token_id is None:
+            eos_token_id = model.config.eos_token_id
+        self.eos_token_id = {eos_token_id} if isinstance(eos_token_id, int) else set(eos_token_id)
+        self.vocab_size = model.config.vocab_size
+        self.reset_metrics()
+
+    @property
+    def device(self):
+        return next(self.model.parameters()).device
+
+    def reset_metrics(self):
+        self.num_steps = 0
+        self.num_draft_tokens = 0
+        self.num_accepted_tokens = 0
+        self.num_generated_tokens = 0
+        self.target_time = 0.0
+        self.draft_time = 0.0
+
+    def get_metrics(self):
+        """
+        Acceptance rate of the draft tokens, tokens generated per target forward, and the speedup over
+        one target forward per token. The latter assumes that a target forward over `k + 1` tokens costs
+        about as much as over one token, which holds while decoding is memory bound.
+        """
+        target_forward_time = self.target_time / self.num_steps if self.num_steps else 0.0
+        total_time = self.target_time + self.draft_time
+        return {
+            "acceptance_rate": self.num_accepted_tokens / self.num_draft_tokens if self.num_draft_tokens else 0.0,
+            "tokens_per_target_forward": self.num_generated_tokens / self.num_steps if self.num_steps else 0.0,
+            "num_generated_tokens": self.num_generated_tokens,
+            "target_time": self.target_time,
+            "draft_time": self.draft_time,
+            "speedup": self.num_generated_tokens * target_forward_time / total_time if total_time else 0.0,
+        }
+
+    def _forward(self, state: _ModelState, sequence: torch.LongTensor, end: int, timed: bool = True):
+        """Feed `sequence[:, state.length:end]` to the model, returns their [s, V] logits."""
+        start = state.length
+        input_ids = sequence[:, start:end]
+        model = state.model
+        if state.past_key_values is None:
+            # prefill of the prompt
+            inputs = model.prepare_inputs_for_generation(input_ids) if state.is_chatglm else {"input_ids": input_ids}
+        elif state.is_chatglm:
+            # decode tokens see the whole cache and the new tokens before them
+            block_positions = torch.arange(start, end, device=input_ids.device) + 1 - self._context_length
+            position_ids = torch.full_like(block_positions, self._mask_position)
+            if model.config.position_encoding_2d:
+                position_ids = torch.stack((position_ids, block_positions))
+            key_positions = torch.arange(end, device=input_ids.device)
+            attention_mask = key_positions[None, :] > key_positions[start:, None]
+            inputs = {
+                "input_ids": input_ids,
+                "position_ids": position_ids.unsqueeze(0),
+                "attention_mask": attention_mask[None, None],
+            }
+        else:
+            inputs = {"input_ids": input_ids}
+        inputs["past_key_values"] = state.past_key_values
+        begin = time.perf_counter()
+        outputs = model(**inputs, use_cache=True, return_dict=True)
+        if timed:
+            elapsed = time.perf_counter() - begin
+            if state.model is self.model:
+                self.target_time += elapsed
+            else:
+                self.draft_time += elapsed
+        state.past_key_values = outputs.past_key_values
+        state.length = end
+        logits = outputs.logits[0].float()
+        # a draft with another vocabulary size is aligned to the target one
+        if logits.size(-1) > self.vocab_size:
+            logits = logits[:, :self.vocab_size]
+        elif logits.size(-1) < self.vocab_size:
+            logits = nn.functional.pad(logits, (0, self.vocab_size - logits.size(-1)), value=-float("inf"))
+        state.next_logits = logits[-1]
+        return logits
+
+    def _probs(self, logits: torch.Tensor, sequence: torch.LongTensor, length: int):
+        """Sampling distribution from the logits of the token after `sequence[:, :length]`."""
+        scores = logits[None]
+        scores = self.logits_processor(sequence[:, :length], scores)
+        scores = self.logits_warper(sequence[:, :length], scores)
+        return nn.functional.softmax(scores, dim=-1)[0]
+
+    def _sample(self, probs: torch.Tensor) -> int:
+        if self.do_sample:
+            return int(torch.multinomial(probs, num_samples=1))
+        return int(probs.argmax())
+
+    @torch.no_grad()
+    def generate(self, input_ids: List[int]) -> List[int]:
+        """Generates for one prompt, returns the new token ids."""
+        prompt_length = len(input_ids)
+        max_length = self.max_length
+        if self.max_new_tokens is not None:
+            max_length = prompt_length + self.max_new_tokens
+        sequence = torch.zeros(1, max_length + self.num_speculative_tokens + 1, dtype=torch.long, device=self.device)
+        sequence[0, :prompt_length] = torch.tensor(input_ids, dtype=torch.long)
+        mask_positions, context_lengths, _ = get_mask_positions(sequence[:, :prompt_length])
+        self._mask_position, self._context_length = int(mask_positions[0]), int(context_lengths[0])
+
+        target, draft = _ModelState(self.model), _ModelState(self.draft_model)
+        self._forward(target, sequence, prompt_length, timed=False)
+        self._forward(draft, sequence, prompt_length, timed=False)
+        length = prompt_length
+        while length < max_length:
+            k = min(self.num_speculative_tokens, max_length - length - 1)
+            # the draft catches up with the sequence, then proposes k tokens one by one
+            draft_probs = []
+            for i in range(k):
+                if draft.length < length + i:
+                    self._forward(draft, sequence, length + i)
+                probs = self._probs(draft.next_logits, sequence, length + i)
+                sequence[0, length + i] = self._sample(probs)
+                draft_probs.append(probs)
+
+            # one target forward scores the last accepted token and all draft tokens
+            num_pending = length - target.length
+            if num_pending == 0:
+                logits = target.next_logits[None]
+                if k:
+                    logits = torch.cat((logits, self._forward(target, sequence, length + k)))
+            else:
+                logits = self._forward(target, sequence, length + k)[num_pending - 1:]
+            target_probs = torch.stack([self._probs(logits[i], sequence, length + i) for i in range(k + 1)])
+
+            draft_tokens = sequence[0, length:length + k].tolist()
+            num_accepted, next_token = accept_draft_tokens(
+                target_probs, torch.stack(draft_probs) if draft_probs else None, draft_tokens, self.do_sample
+            )
+            self.num_steps += 1
+            self.num_draft_tokens += k
+            self.num_accepted_tokens += num_accepted
+
+            # roll the caches back to the accepted tokens, the next token is fed with the next draft
+            target.crop(length + num_accepted)
+            draft.crop(length + num_accepted)
+            sequence[0, length + num_accepted] = next_token
+            new_tokens = draft_tokens[:num_accepted] + [next_token]
+            stop = [i for i, token in enumerate(new_tokens) if token in self.eos_token_id]
+            if stop:
+                new_tokens = new_tokens[:stop[0] + 1]
+            length += len(new_tokens)
+            self.num_generated_tokens += len(new_tokens)
+            if stop:
+                break
+        return sequence[0, prompt_length:length].tolist()
@@ -4,7 +4,11 @@
 @description: 
 """
 
+import bisect
 import copy
+import hashlib
+import inspect
+import itertools
 import json
 import math
 import os
@@ -13,7 +17,7 @@ from multiprocessing import Pool
 from tqdm.auto import tqdm
 from dataclasses import asdict, dataclass, field
 from typing import Optional, Tuple, Union, List, Callable
-import pickle
+import numpy as np
 import torch
 import torch.nn.functional as F
 import torch.utils.checkpoint
@@ -21,7 +25,7 @@ from loguru import logger
 from torch import nn
 from torch.nn import CrossEntropyLoss, LayerNorm
 from torch.nn.utils import skip_init
-from torch.utils.data import Dataset
+from torch.utils.data import ConcatDataset, Dataset
 from datasets import Dataset as HFDataset
 from datasets import load_dataset
 from transformers.configuration_utils import PretrainedConfig
@@ -39,6 +43,9 @@ from transformers.utils import (
     add_start_docstrings_to_model_forward,
 )
 
+from .chatglm_cache import KVCache, LayerCache, PagedLayerCache, PrefixCache
+from .chatglm_engine import ContinuousBatchingEngine
+
 # flags required to enable jit fusion kernels
 torch._C._jit_set_profiling_mode(False)
 torch._C._jit_set_profiling_executor(False)
@@ -47,6 +54,7 @@ torch._C._jit_override_can_fuse_on_gpu(True)
 
 _CHECKPOINT_FOR_DOC = "THUDM/ChatGLM-6B"
 _CONFIG_FOR_DOC = "ChatGLM6BConfig"
+QUANTIZED_WEIGHTS_NAME = "quantized_model.pt"
 
 CHATGLM_6B_PRETRAINED_MODEL_ARCHIVE_LIST = [
     "THUDM/chatglm-6b",
@@ -185,6 +193,24 @@ class ChatGLMArgs(ModelArgs):
     special_tokens_list: list = field(default_factory=list)
     top_k: float = None
     top_p: float = 0.7
+    use_continuous_batching: bool = False
+    use_paged_kv_cache: bool = False
+    kv_cache_block_size: int = 16
+    use_int8_kv_cache: bool = False  # paged cache with int8 keys/values and per-token, per-head scales
+    use_prefix_cache: bool = False
+    prefix_cache_max_memory: int = 2 * 1024 ** 3  # bytes, last prompt cache of every session
+    use_compact_attention_mask: bool = False
+    cache_shard_size: int = 10000  # average rows per feature cache shard
+    use_packing: bool = False
+    packing_length: Optional[int] = None  # defaults to max_seq_length + max_length + 1
+    group_by_length: bool = False
+    max_tokens_per_batch: Optional[int] = None  # token budget per batch, instead of a fixed batch size
+    use_speculative_decoding: bool = False
+    draft_model_name: Optional[str] = None  # causal LM with the same vocabulary as the model
+    draft_num_layers: int = 2  # without a draft model, the first layers of the model are the draft
+    num_speculative_tokens: int = 4
+    max_lora_adapters: int = 8  # LoRA adapters kept in memory by the adapter registry
+    dequantized_weight_cache_memory: int = 0  # bytes of float weights kept resident by quantized layers on cpu
     model_name_or_path: Optional[str] = field(default="THUDM/chatglm-6b")
     dataset_name_or_path: Optional[str] = field(default="shibing624/alpaca-zh")
     use_lora: bool = True
@@ -201,26 +227,76 @@ class ChatGLMArgs(ModelArgs):
     logging_steps = 50
 
 
+PROMPT_TEMPLATE = "问：{instruction}\n{input}答："
+
+
 def preprocess_data(data):
     instruction, input_text, target_text, tokenizer, args = data
+    return preprocess_batch([instruction], [input_text], [target_text], tokenizer, args)[0].tolist()
+
+
+def preprocess_batch(instructions, input_texts, target_texts, tokenizer, args):
+    """
+    Tokenizes a batch of examples with one tokenizer call for the prompts and one for the targets,
+    returns a list of `prompt_ids + target_ids + [eos]` arrays.
+    """
+    prompts = [
+        PROMPT_TEMPLATE.format(instruction=instruction, input=f"{input_text}\n" if input_text else "")
+        for instruction, input_text in zip(instructions, input_texts)
+    ]
+    prompt_ids = tokenizer(prompts, max_length=args.max_seq_length, truncation=True)["input_ids"]
+    target_ids = tokenizer(list(target_texts), max_length=args.max_length, truncation=True,
+                           add_special_tokens=False)["input_ids"]
+
+    def flatten(batch_ids):
+        lengths = np.array([len(ids) for ids in batch_ids], dtype=np.int64)
+        tokens = np.fromiter(itertools.chain.from_iterable(batch_ids), dtype=np.int64, count=int(lengths.sum()))
+        # index of every token inside its own row
+        starts = np.cumsum(lengths) - lengths
+        return tokens, lengths, np.arange(len(tokens)) - np.repeat(starts, lengths)
+
+    prompt_tokens, prompt_lengths, prompt_pos = flatten(prompt_ids)
+    target_tokens, target_lengths, target_pos = flatten(target_ids)
+    max_total = args.max_seq_length + args.max_length
+    prompt_keep = np.minimum(prompt_lengths, max_total)
+    target_keep = np.clip(np.minimum(target_lengths, max_total - prompt_keep), 0, None)
+    lengths = prompt_keep + target_keep + 1
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    input_ids = np.empty(offsets[-1], dtype=np.int64)
+    keep = prompt_pos < np.repeat(prompt_keep, prompt_lengths)
+    input_ids[np.repeat(offsets[:-1], prompt_lengths)[keep] + prompt_pos[keep]] = prompt_tokens[keep]
+    keep = target_pos < np.repeat(target_keep, target_lengths)
+    target_starts = offsets[:-1] + prompt_keep
+    input_ids[np.repeat(target_starts, target_lengths)[keep] + target_pos[keep]] = target_tokens[keep]
+    input_ids[offsets[1:] - 1] = tokenizer.eos_token_id
+    return np.split(input_ids, offsets[1:-1])
+
 
-    prompt = f"问：{instruction}\n"
-    if input_text:
-        prompt += f"{input_text}\n"
-    prompt += "答："
+def preprocess_rows(rows, tokenizer, args):
+    instructions, input_texts, target_texts = zip(*rows)
+    return preprocess_batch(instructions, input_texts, target_texts, tokenizer, args)
 
-    prompt_ids = tokenizer.encode(prompt, max_length=args.max_seq_length, truncation=True)
-    target_ids = tokenizer.encode(target_text, max_length=args.max_length, truncation=True,
-                                  add_special_tokens=False)
-    input_ids = prompt_ids + target_ids
-    input_ids = input_ids[:(args.max_seq_length + args.max_length)] + [tokenizer.eos_token_id]
 
-    return input_ids
+_worker_tokenizer = None
+_worker_args = None
+
+
+def _init_preprocess_worker(tokenizer, args):
+    # the tokenizer is sent to every worker once instead of with every task
+    global _worker_tokenizer, _worker_args
+    _worker_tokenizer = tokenizer
+    _worker_args = args
+
+
+def _preprocess_rows_in_worker(rows):
+    return preprocess_rows(rows, _worker_tokenizer, _worker_args)
 
 
 def preprocess_batch_for_hf_dataset(dataset, tokenizer, args):
-    data = (dataset["instruction"], dataset["input"], dataset["output"], tokenizer, args)
-    dataset['input_ids'] = preprocess_data(data)
+    dataset['input_ids'] = preprocess_batch(dataset["instruction"], dataset["input"], dataset["output"], tokenizer,
+                                            args)
     return dataset
 
 
@@ -238,8 +314,10 @@ def load_hf_dataset(data, tokenizer, args):
         dataset = HFDataset.from_pandas(data)
 
     dataset = dataset.map(
-        lambda x: preprocess_batch_for_hf_dataset(x, tokenizer=tokenizer, args=args),
-        batched=False,
+        preprocess_batch_for_hf_dataset,
+        fn_kwargs={"tokenizer": tokenizer, "args": args},
+        batched=True,
+        num_proc=args.process_count if args.use_multiprocessing and args.process_count > 1 else None,
     )
 
     dataset.set_format(type="np", columns=["input_ids"])
@@ -247,55 +325,180 @@ def load_hf_dataset(data, tokenizer, args):
     return dataset["input_ids"]
 
 
+class MemmapTokens:
+    """
+    Token id sequences stored as one flat uint32 array (`<path>.bin`) and an int64 offsets index (`<path>.idx`).
+
+    The files are opened with `np.memmap` on first access in each process, so loading takes constant time
+    and items are zero-copy slices. Forked DataLoader workers share the read-only pages instead of
+    touching the refcounts of boxed Python ints, and pickling only carries the path.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._tokens = None
+        self._offsets = None
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(path + ".bin") and os.path.exists(path + ".idx")
+
+    @classmethod
+    def write(cls, path, examples):
+        offsets = np.zeros(len(examples) + 1, dtype=np.int64)
+        np.cumsum([len(example) for example in examples], out=offsets[1:])
+        # write to temporary files first, an interrupted run never leaves a truncated cache behind
+        with open(path + ".bin.tmp", "wb") as f:
+            for example in examples:
+                f.write(np.asarray(example, dtype=np.uint32).tobytes())
+        offsets.tofile(path + ".idx.tmp")
+        os.replace(path + ".bin.tmp", path + ".bin")
+        os.replace(path + ".idx.tmp", path + ".idx")
+        return cls(path)
+
+    def _open(self):
+        self._offsets = np.memmap(self.path + ".idx", dtype=np.int64, mode="r")
+        if self._offsets[-1] > 0:
+            self._tokens = np.memmap(self.path + ".bin", dtype=np.uint32, mode="r")
+        else:
+            self._tokens = np.zeros(0, dtype=np.uint32)
+
+    def __getstate__(self):
+        return {"path": self.path, "_tokens": None, "_offsets": None}
+
+    def __len__(self):
+        if self._offsets is None:
+            self._open()
+        return len(self._offsets) - 1
+
+    @property
+    def lengths(self):
+        if self._offsets is None:
+            self._open()
+        return np.diff(self._offsets)
+
+    def __getitem__(self, index):
+        if self._offsets is None:
+            self._open()
+        return self._tokens[self._offsets[index]:self._offsets[index + 1]]
+
+
+def get_tokenizer_hash(tokenizer):
+    """Digest of the tokenizer class and vocab, computed once per tokenizer."""
+    digest = getattr(tokenizer, "_lmft_vocab_hash", None)
+    if digest is None:
+        hasher = hashlib.blake2b(type(tokenizer).__name__.encode("utf-8"), digest_size=16)
+        for token, token_id in sorted(tokenizer.get_vocab().items(), key=lambda x: x[1]):
+            hasher.update(f"{token_id}\t{token}\n".encode("utf-8", "surrogatepass"))
+        digest = hasher.hexdigest()
+        try:
+            tokenizer._lmft_vocab_hash = digest
+        except AttributeError:
+            pass
+    return digest
+
+
+def get_features_hash(tokenizer, args):
+    """Digest of everything besides the data rows that the cached features depend on."""
+    settings = json.dumps({
+        "tokenizer": get_tokenizer_hash(tokenizer),
+        "template": PROMPT_TEMPLATE,
+        "max_seq_length": args.max_seq_length,
+        "max_length": args.max_length,
+    }, sort_keys=True)
+    return hashlib.blake2b(settings.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def get_cache_shards(rows, shard_size):
+    """
+    Split rows into content-defined shards, returns a list of (row indices, shard digest).
+
+    A shard ends after a row whose digest is 0 modulo `shard_size`, so inserting or appending rows only
+    changes the shards around them, and the other shards keep their digests and cached features.
+    """
+    shards = []
+    indices = []
+    hasher = hashlib.blake2b(digest_size=16)
+    for i, row in enumerate(rows):
+        row_digest = hashlib.blake2b(json.dumps(row, ensure_ascii=False, default=str).encode("utf-8"), digest_size=16).digest()
+        hasher.update(row_digest)
+        indices.append(i)
+        if int.from_bytes(row_digest[:8], "little") % shard_size == 0 or len(indices) >= 4 * shard_size:
+            shards.append((indices, hasher.hexdigest()))
+            indices = []
+            hasher = hashlib.blake2b(digest_size=16)
+    if indices:
+        shards.append((indices, hasher.hexdigest()))
+    return shards
+
+
 class ChatGLMDataset(Dataset):
     def __init__(self, tokenizer, args, data, mode):
-        cached_features_file = os.path.join(
-            args.cache_dir,
-            args.model_name.replace("/", "_")
-            + "_cached_"
-            + str(args.max_seq_length)
-            + str(len(data)),
+        use_cache = (not args.reprocess_input_data and not args.no_cache) or (
+                mode == "dev" and args.use_cached_eval_features and not args.no_cache
         )
+        rows = list(zip(data["instruction"], data["input"], data["output"]))
+        # features are cached per content-defined shard, keyed by the data and the tokenization settings
+        features_hash = get_features_hash(tokenizer, args)
+        shard_files = []
+        missing_shards = []
+        for indices, shard_hash in get_cache_shards(rows, args.cache_shard_size):
+            cached_features_file = os.path.join(
+                args.cache_dir,
+                args.model_name.replace("/", "_")
+                + "_cached_"
+                + hashlib.blake2b((features_hash + shard_hash).encode("utf-8"), digest_size=16).hexdigest(),
+            )
+            shard_files.append(cached_features_file)
+            if not (use_cache and MemmapTokens.exists(cached_features_file)):
+                missing_shards.append((indices, cached_features_file))
 
-        if os.path.exists(cached_features_file) and (
-                (not args.reprocess_input_data and not args.no_cache)
-                or (mode == "dev" and args.use_cached_eval_features and not args.no_cache)
-        ):
-            logger.info(" Loading features from cached file %s" % cached_features_file)
-            with open(cached_features_file, "rb") as handle:
-                self.examples = pickle.load(handle)
+        if not missing_shards:
+            logger.info(" Loading features from {} cached shards in {}".format(len(shard_files), args.cache_dir))
         else:
-            logger.info(" Creating features from dataset file at %s" % args.cache_dir)
+            num_missing_rows = sum(len(indices) for indices, _ in missing_shards)
+            logger.info(" Creating features of {}/{} rows from dataset, {}/{} shards are cached in {}".format(
+                num_missing_rows, len(rows), len(shard_files) - len(missing_shards), len(shard_files),
+                args.cache_dir))
 
-            data = [
-                (instruction, input_text, target_text, tokenizer, args)
-                for instruction, input_text, target_text in zip(
-                    data["instruction"], data["input"], data["output"]
-                )
-            ]
-
-            if (mode == "train" and args.use_multiprocessing) or (
+            data = [rows[i] for indices, _ in missing_shards for i in indices]
+            use_multiprocessing = (mode == "train" and args.use_multiprocessing) or (
                     mode == "dev" and args.use_multiprocessing_for_evaluation
-            ):
-                if args.multiprocessing_chunksize == -1:
-                    chunksize = max(len(data) // (args.process_count * 2), 500)
-                else:
-                    chunksize = args.multiprocessing_chunksize
-
-                with Pool(args.process_count) as p:
-                    self.examples = list(
-                        tqdm(
-                            p.imap(preprocess_data, data, chunksize=chunksize),
-                            total=len(data),
-                            disable=args.silent,
-                        )
-                    )
+            )
+            if args.multiprocessing_chunksize != -1:
+                chunksize = args.multiprocessing_chunksize
+            elif use_multiprocessing:
+                chunksize = max(len(data) // (args.process_count * 2), 500)
+            else:
+                chunksize = 1000
+            # examples are tokenized in batches of `chunksize` rows
+            chunks = [data[i:i + chunksize] for i in range(0, len(data), chunksize)]
+
+            if use_multiprocessing:
+                with Pool(args.process_count, initializer=_init_preprocess_worker, initargs=(tokenizer, args)) as p:
+                    self.examples = [
+                        example
+                        for chunk in tqdm(p.imap(_preprocess_rows_in_worker, chunks), total=len(chunks),
+                                          disable=args.silent)
+                        for example in chunk
+                    ]
             else:
-                self.examples = [preprocess_data(d) for d in tqdm(data, disable=args.silent)]
-            if not args.no_cache:
-                logger.info(" Saving features into cached file %s" % cached_features_file)
-                with open(cached_features_file, "wb") as handle:
-                    pickle.dump(self.examples, handle, protocol=pickle.HIGHEST_PROTOCOL)
+                self.examples = [
+                    example
+                    for chunk in tqdm(chunks, disable=args.silent)
+                    for example in preprocess_rows(chunk, tokenizer, args)
+                ]
+            if args.no_cache:
+                return
+            start = 0
+            for indices, cached_features_file in missing_shards:
+                MemmapTokens.write(cached_features_file, self.examples[start:start + len(indices)])
+                start += len(indices)
+            logger.info(" Saved features of {} shards into {}".format(len(missing_shards), args.cache_dir))
+        if not shard_files:
+            self.examples = []
+            return
+        self.examples = ConcatDataset([MemmapTokens(cached_features_file) for cached_features_file in shard_files])
 
     def __len__(self):
         return len(self.examples)
@@ -303,6 +506,136 @@ class ChatGLMDataset(Dataset):
     def __getitem__(self, index):
         return self.examples[index]
 
+    @property
+    def lengths(self):
+        """Token count of every example, read from the cache index without loading the tokens."""
+        if isinstance(self.examples, ConcatDataset):
+            return np.concatenate([shard.lengths for shard in self.examples.datasets])
+        return np.array([len(example) for example in self.examples], dtype=np.int64)
+
+
+def get_example_lengths(dataset):
+    if hasattr(dataset, "lengths"):
+        return np.asarray(dataset.lengths)
+    return np.array([len(dataset[i]) for i in range(len(dataset))], dtype=np.int64)
+
+
+class PackedDataset(Dataset):
+    """
+    Packs the examples of a dataset into rows of at most `packing_length` tokens, every item is the list
+    of examples of one row. Rows are filled best-fit, longest examples first.
+    """
+
+    def __init__(self, dataset, packing_length: int):
+        self.dataset = dataset
+        self.packing_length = packing_length
+        lengths = get_example_lengths(dataset).tolist()
+        self.rows = []
+        # sorted (remaining space, row index) of the open rows
+        remaining = []
+        for index in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+            pos = bisect.bisect_left(remaining, (lengths[index], -1))
+            if pos == len(remaining):
+                self.rows.append([index])
+                space, row = packing_length - lengths[index], len(self.rows) - 1
+            else:
+                space, row = remaining.pop(pos)
+                self.rows[row].append(index)
+                space -= lengths[index]
+            if space > 0:
+                bisect.insort(remaining, (space, row))
+        self.lengths = np.array([sum(lengths[i] for i in row) for row in self.rows], dtype=np.int64)
+        logger.info(" Packed {} examples into {} rows of {} tokens, {:.1%} of the tokens are padding".format(
+            len(lengths), len(self.rows), packing_length,
+            1 - sum(lengths) / max(1, sum(max(packing_length, sum(lengths[i] for i in row)) for row in self.rows))))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        return [self.dataset[i] for i in self.rows[index]]
+
+
+class LengthGroupedBatchSampler:
+    """
+    Shuffled batches of examples of similar length.
+
+    Every epoch the indices are shuffled and split into chunks of `bucket_size` examples, every chunk is
+    sorted by length and cut into batches, then the batches are shuffled. Batches hold `batch_size` examples,
+    or with `max_tokens` as many as fit in `max_tokens` padded tokens.
+
+    Args:
+        lengths: Token count of every example.
+        batch_size: Examples per batch, if `max_tokens` is not set.
+        max_tokens: Token budget of a batch, the batch size times its longest example.
+        bucket_size: Examples sorted together, defaults to 100 batches worth of examples.
+        shuffle: Whether to shuffle, otherwise examples are batched in order.
+        seed: Seed of the shuffling, the epoch set by `set_epoch` is added to it.
+        num_replicas: Number of distributed processes, each one iterates over every `num_replicas`-th batch.
+            Like `DistributedSampler`, the first batches are repeated so that every process gets as many.
+        rank: Rank of the current process.
+    """
+
+    def __init__(self, lengths, batch_size: int = 8, max_tokens: Optional[int] = None, bucket_size: int = None,
+                 shuffle: bool = True, seed: int = 0, num_replicas: int = 1, rank: int = 0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        if bucket_size is None:
+            if max_tokens is not None:
+                batch_size = max(1, max_tokens // max(1, int(self.lengths.mean())) if len(self.lengths) else 1)
+            bucket_size = 100 * batch_size
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self._cached_batches = None
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def _split(self, indices):
+        if self.max_tokens is None:
+            return [indices[i:i + self.batch_size] for i in range(0, len(indices), self.batch_size)]
+        batches = []
+        start = 0
+        for end in range(1, len(indices) + 1):
+            # indices are sorted longest first, the first example gives the padded length
+            if end - start > 1 and (end - start) * self.lengths[indices[start]] > self.max_tokens:
+                batches.append(indices[start:end - 1])
+                start = end - 1
+        if start < len(indices):
+            batches.append(indices[start:])
+        return batches
+
+    def _batches(self):
+        if self._cached_batches is not None and self._cached_batches[0] == self.epoch:
+            return self._cached_batches[1]
+        rng = np.random.default_rng(self.seed + self.epoch)
+        indices = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        batches = []
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = indices[start:start + self.bucket_size]
+            bucket = bucket[np.argsort(-self.lengths[bucket], kind="stable")]
+            batches.extend(self._split(bucket.tolist()))
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        if self.num_replicas > 1 and batches:
+            # a process with fewer batches would leave the others waiting in the gradient all-reduce
+            total = math.ceil(len(batches) / self.num_replicas) * self.num_replicas
+            batches = (batches * math.ceil(total / len(batches)))[:total]
+        batches = batches[self.rank::self.num_replicas]
+        self._cached_batches = (self.epoch, batches)
+        return batches
+
+    def __iter__(self):
+        return iter(self._batches())
+
+    def __len__(self):
+        return len(self._batches())
+
 
 class ChatGLMConfig(PretrainedConfig):
     r"""
@@ -336,6 +669,15 @@ class ChatGLMConfig(PretrainedConfig):
             The epsilon used by the layer normalization layers.
         use_cache (`bool`, *optional*, defaults to `True`):
             Whether the model should return the last key/values attentions (not used by all models).
+        quantization_group_size (`int`, *optional*, defaults to 0):
+            Input channels sharing a scale in the quantized linears, 0 for one scale per output row.
+        attention_implementation (`str`, *optional*, defaults to `"eager"`):
+            Attention kernel, `"eager"` materializes the full score matrix, `"sdpa"` dispatches to
+            `torch.nn.functional.scaled_dot_product_attention` and `"chunked"` tiles queries and keys with an
+            online softmax (running max and sum), so only the scores of one tile exist at a time and peak memory
+            grows linearly with the sequence length, in backward too.
+        attention_chunk_size (`int`, *optional*, defaults to 512):
+            Query and key tile size of the `"chunked"` attention.
     """
     model_type = "chatglm"
 
@@ -355,6 +697,9 @@ class ChatGLMConfig(PretrainedConfig):
             position_encoding_2d=True,
             quantization_bit=0,
             quantization_embeddings=False,
+            quantization_group_size=0,
+            attention_implementation="eager",
+            attention_chunk_size=512,
             **kwargs
     ):
         self.num_layers = num_layers
@@ -371,6 +716,9 @@ class ChatGLMConfig(PretrainedConfig):
         self.position_encoding_2d = position_encoding_2d
         self.quantization_bit = quantization_bit
         self.quantization_embeddings = quantization_embeddings
+        self.quantization_group_size = quantization_group_size
+        self.attention_implementation = attention_implementation
+        self.attention_chunk_size = attention_chunk_size
         super().__init__(
             pad_token_id=pad_token_id,
             bos_token_id=bos_token_id,
@@ -461,6 +809,70 @@ def load_tf_weights_in_chatglm_6b(model, config, tf_checkpoint_path):
     return model
 
 
+def get_prefix_lm_masks(prefix_lengths: torch.Tensor, seq_length: int):
+    """
+    Batched prefix-LM attention mask, True for masked positions.
+    prefix_lengths: [b], number of leading positions every query attends to
+    returns: [b, 1, seq_length, seq_length]
+    """
+    positions = torch.arange(seq_length, device=prefix_lengths.device)
+    causal = positions[None, :] <= positions[:, None]
+    prefix = positions[None, None, :] < prefix_lengths[:, None, None]
+    return ~(causal[None, :, :] | prefix).unsqueeze(1)
+
+
+def get_mask_positions(input_ids: torch.LongTensor, check: bool = True):
+    """
+    Batched `seq.index(...)` scans of the prompt ids, run once per sequence.
+    input_ids: [b, L]
+    returns: [b] position of the first [MASK] (of the first [gMASK] in rows without one),
+    [b] context lengths (position of the bos token) and [b] whether the row uses [gMASK]
+    """
+    is_mask = input_ids == 150000
+    is_gmask = input_ids == 150001
+    if check and not bool((is_mask | is_gmask).any(dim=-1).all()):
+        raise ValueError("You have to add either [MASK] or [gMASK] in your input")
+    use_gmasks = ~is_mask.any(dim=-1)
+    mask_positions = torch.where(use_gmasks, is_gmask.int().argmax(dim=-1), is_mask.int().argmax(dim=-1))
+    context_lengths = (input_ids == 150004).int().argmax(dim=-1)
+    return mask_positions, context_lengths, use_gmasks
+
+
+def get_pad_lengths(attention_mask: torch.Tensor) -> Optional[torch.LongTensor]:
+    """
+    [b] number of leading padding tokens from a [b, L] tokenizer attention mask (0 for padding),
+    None if no row is padded. Generation supports left padding only.
+    """
+    if bool(attention_mask.all()):
+        return None
+    if not bool(attention_mask[:, -1].all()):
+        raise ValueError("Batched generation needs left padded inputs, set `tokenizer.padding_side = 'left'`.")
+    return attention_mask.int().argmax(dim=-1)
+
+
+def get_batch_position_ids(
+        seq_length: int, mask_positions, context_lengths, use_gmasks, position_encoding_2d=True, pad_lengths=None
+):
+    """
+    Batched prompt position ids, [b, 2, seq_length] with 2D rotary, else [b, seq_length].
+    In rows with [MASK] the tokens from the bos on are at the mask position, 2D block positions count from 1 at the bos.
+    Positions of left padded rows count from their first token, `mask_positions` and `context_lengths` are indices
+    into the padded ids.
+    """
+    positions = torch.arange(seq_length, device=mask_positions.device)[None, :]
+    keep_positions = use_gmasks[:, None]
+    row_positions = positions
+    if pad_lengths is not None:
+        row_positions = (positions - pad_lengths[:, None]).clamp(min=0)
+        mask_positions = mask_positions - pad_lengths
+    if position_encoding_2d:
+        in_block = positions >= context_lengths[:, None]
+        position_ids = torch.where(in_block & ~keep_positions, mask_positions[:, None], row_positions)
+        block_position_ids = torch.where(in_block, positions - context_lengths[:, None] + 1, 0)
+        return torch.stack((position_ids, block_position_ids), dim=1)
+    return torch.where((positions == seq_length - 1) & ~keep_positions, mask_positions[:, None], row_positions)
+
+
 @torch.jit.script
 def gelu_impl(x):
     """OpenAI's gelu implementation."""
@@ -537,6 +949,128 @@ def apply_rotary_pos_emb_index(q, k, cos, sin, position_id):
     return q, k
 
 
+def get_rotary_pos_emb(rotary_emb, position_ids, position_encoding_2d=True, max_length=None):
+    """
+    Gathers the cos/sin rows of every position once per forward, shared by all layers.
+    position_ids: [b, 2, sq] with 2D rotary, else [b, sq]
+    max_length: size of the table to gather from, by default read from the positions (a host sync)
+    returns: cos, sin of shape [sq, b, 1, hn], both position streams side by side and the sign of
+    `rotate_half` folded into sin, for `apply_rotary_pos_emb_fused`
+    """
+    cos, sin = rotary_emb(position_ids, seq_len=max_length or int(position_ids.max()) + 1)
+    cos, sin = cos.squeeze(1), sin.squeeze(1)
+    half = cos.size(-1) // 2
+    sin = torch.cat((-sin[:, :half], sin[:, half:]), dim=-1)
+    if position_encoding_2d:
+        # [b, 2, sq] -> [sq, b, 2] -> [sq, b, 2, rot_dim] -> [sq, b, 1, 2 * rot_dim]
+        position_ids = position_ids.permute(2, 0, 1)
+    else:
+        position_ids = position_ids.transpose(0, 1).unsqueeze(-1)
+    cos, sin = F.embedding(position_ids, cos), F.embedding(position_ids, sin)
+    return cos.flatten(2).unsqueeze(2), sin.flatten(2).unsqueeze(2)
+
+
+def apply_rotary_pos_emb_fused(q, k, cos, sin, num_streams: int = 2):
+    """
+    Rotates q and k for all `num_streams` position streams in one pass, the same result as
+    `apply_rotary_pos_emb_index` on every stream. q, k: [sq, b, np, hn], cos, sin: [sq, b, 1, hn]
+    from `get_rotary_pos_emb`.
+    """
+
+    def swap_halves(x):
+        # rotate_half without the sign, which is folded into sin
+        return x.unflatten(-1, (num_streams, 2, -1)).flip(-2).flatten(-3)
+
+    return q * cos + swap_halves(q) * sin, k * cos + swap_halves(k) * sin
+
+
+def _attention_tile(query_layer, key_layer, value_layer, attention_mask, query_key_layer_scaling_coeff: float):
+    """
+    Scores of a query tile against a key tile, with the masking and scaling of the eager path.
+    query_layer: [b, np, sq, hn] already scaled, key_layer, value_layer: [b, np, sk, hn]
+    returns: the [b, np, sq, 1] float max and sum of the exponentiated scores and their [b, np, sq, hn] float
+    context, unnormalized
+    """
+    attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
+    if attention_mask is not None:
+        attention_scores = attention_scores.masked_fill(attention_mask, -10000.0)
+    attention_scores = attention_scores.float() * query_key_layer_scaling_coeff
+    tile_max = attention_scores.amax(dim=-1, keepdim=True)
+    attention_probs = torch.exp(attention_scores - tile_max)
+    context = torch.matmul(attention_probs.to(value_layer.dtype), value_layer).float()
+    return tile_max, attention_probs.sum(dim=-1, keepdim=True), context
+
+
+def memory_efficient_attention_fn(
+        query_layer,
+        key_layer,
+        value_layer,
+        attention_mask,
+        query_key_layer_scaling_coeff,
+        implementation="sdpa",
+        chunk_size=512,
+):
+    """
+    Attention without a persistent [b, np, sq, sk] probability matrix.
+    query_layer: [sq, b, np, hn], key_layer, value_layer: [sk, b, np, hn], attention_mask: True for masked
+    returns: [sq, b, np, hn]
+    """
+    hidden_size = query_layer.size(-1)
+    # [s, b, np, hn] -> [b, np, s, hn]
+    query_layer, key_layer, value_layer = [t.permute(1, 2, 0, 3) for t in (query_layer, key_layer, value_layer)]
+
+    if implementation == "sdpa" and hasattr(F, "scaled_dot_product_attention"):
+        attn_mask = None
+        if attention_mask is not None and attention_mask.size(-2) * attention_mask.size(-1) > 1:
+            # a bool mask (True to attend) instead of an additive float one, so it is not expanded per layer.
+            # The [1, 1] mask of an unpadded decode step masks nothing and is dropped without reading its value.
+            # Every query must see at least one key, a fully masked row would give NaN.
+            attn_mask = ~attention_mask
+        # the default scale 1 / sqrt(hn) is the one of the eager path, whose layer coefficient cancels out
+        context_layer = F.scaled_dot_product_attention(query_layer, key_layer, value_layer, attn_mask=attn_mask)
+    else:
+        query_layer = query_layer / (math.sqrt(hidden_size) * query_key_layer_scaling_coeff)
+        use_checkpoint = torch.is_grad_enabled() and (query_layer.requires_grad or key_layer.requires_grad)
+        key_length = key_layer.size(2)
+        context_chunks = []
+        for start in range(0, query_layer.size(2), chunk_size):
+            query_chunk = query_layer[:, :, start:start + chunk_size]
+            mask_chunk = attention_mask
+            if attention_mask is not None and attention_mask.size(-2) > 1:
+                mask_chunk = attention_mask[..., start:start + chunk_size, :]
+            context, running_max, running_sum = None, None, None
+            # online softmax over the key tiles, only the scores of one [chunk, chunk] tile exist at a time
+            for key_start in range(0, key_length, chunk_size):
+                key_end = min(key_start + chunk_size, key_length)
+                mask_tile = mask_chunk
+                if mask_chunk is not None and mask_chunk.size(-1) > 1:
+                    mask_tile = mask_chunk[..., key_start:key_end]
+                tile_inputs = (
+                    query_chunk, key_layer[:, :, key_start:key_end], value_layer[:, :, key_start:key_end], mask_tile,
+                    query_key_layer_scaling_coeff,
+                )
+                if use_checkpoint:
+                    # recompute the tile scores in backward instead of keeping them
+                    tile_max, tile_sum, tile_context = torch.utils.checkpoint.checkpoint(
+                        _attention_tile, *tile_inputs, use_reentrant=False
+                    )
+                else:
+                    tile_max, tile_sum, tile_context = _attention_tile(*tile_inputs)
+                if context is None:
+                    context, running_max, running_sum = tile_context, tile_max, tile_sum
+                else:
+                    new_max = torch.maximum(running_max, tile_max)
+                    old_weight, new_weight = torch.exp(running_max - new_max), torch.exp(tile_max - new_max)
+                    context = context * old_weight + tile_context * new_weight
+                    running_sum = running_sum * old_weight + tile_sum * new_weight
+                    running_max = new_max
+            context_chunks.append((context / running_sum).to(query_chunk.dtype))
+        context_layer = torch.cat(context_chunks, dim=2)
+
+    # [b, np, sq, hn] --> [sq, b, np, hn]
+    return context_layer.permute(2, 0, 1, 3)
+
+
 def attention_fn(
         self,
         query_layer,
@@ -548,8 +1082,20 @@ def attention_fn(
         layer_past=None,
         scaling_attention_score=True,
         use_cache=False,
+        output_attentions=False,
 ):
-    if layer_past is not None:
+    if isinstance(layer_past, PagedLayerCache) and scaling_attention_score and not output_attentions:
+        # the paged cache attends through its block tables, the read slots are shared by all layers
+        context_layer = layer_past.attention(
+            query_layer, key_layer, value_layer, attention_mask, float(layer_id + 1)
+        )
+        context_layer = context_layer.reshape(*context_layer.size()[:-2], hidden_size_per_partition)
+        return context_layer, layer_past, None
+
+    if isinstance(layer_past, LayerCache):
+        # write through the cache object, which itself is the present
+        key_layer, value_layer = layer_past.update(key_layer, value_layer)
+    elif layer_past is not None:
         past_key, past_value = layer_past
         key_layer = torch.cat((past_key, key_layer), dim=0)
         value_layer = torch.cat((past_value, value_layer), dim=0)
@@ -557,12 +1103,28 @@ def attention_fn(
     # seqlen, batch, num_attention_heads, hidden_size_per_attention_head
     seq_len, b, nh, hidden_size = key_layer.shape
 
-    if use_cache:
+    if isinstance(layer_past, LayerCache):
+        present = layer_past
+    elif use_cache:
         present = (key_layer, value_layer)
     else:
         present = None
 
     query_key_layer_scaling_coeff = float(layer_id + 1)
+    if self.attention_implementation != "eager" and scaling_attention_score and not output_attentions:
+        context_layer = memory_efficient_attention_fn(
+            query_layer,
+            key_layer,
+            value_layer,
+            attention_mask,
+            query_key_layer_scaling_coeff,
+            implementation=self.attention_implementation,
+            chunk_size=self.attention_chunk_size,
+        )
+        # [sq, b, np, hn] --> [sq, b, hp]
+        context_layer = context_layer.reshape(*context_layer.size()[:-2], hidden_size_per_partition)
+        return context_layer, present, None
+
     if scaling_attention_score:
         query_layer = query_layer / (math.sqrt(hidden_size) * query_key_layer_scaling_coeff)
 
@@ -601,9 +1163,8 @@ def attention_fn(
         self.scale_mask_softmax.scale = query_key_layer_scaling_coeff
         attention_probs = self.scale_mask_softmax(attention_scores, attention_mask.contiguous())
     else:
-        if not (attention_mask == 0).all():
-            # if auto-regressive, skip
-            attention_scores.masked_fill_(attention_mask, -10000.0)
+        # an all-False mask is a no-op, filling unconditionally avoids a data-dependent branch
+        attention_scores.masked_fill_(attention_mask, -10000.0)
         dtype = attention_scores.type()
         attention_scores = attention_scores.float()
         attention_scores = attention_scores * query_key_layer_scaling_coeff
@@ -641,6 +1202,8 @@ def attention_fn(
     new_context_layer_shape = context_layer.size()[:-2] + (hidden_size_per_partition,)
     context_layer = context_layer.view(*new_context_layer_shape)
 
+    if not output_attentions:
+        attention_probs = None
     outputs = (context_layer, present, attention_probs)
 
     return outputs
@@ -649,7 +1212,8 @@ def attention_fn(
 class SelfAttention(torch.nn.Module):
     def __init__(self, hidden_size, num_attention_heads,
                  layer_id, hidden_size_per_attention_head=None, bias=True,
-                 params_dtype=torch.float, position_encoding_2d=True):
+                 params_dtype=torch.float, position_encoding_2d=True, attention_implementation="eager",
+                 attention_chunk_size=512):
         super(SelfAttention, self).__init__()
 
         self.layer_id = layer_id
@@ -658,6 +1222,8 @@ class SelfAttention(torch.nn.Module):
         self.num_attention_heads = num_attention_heads
         self.num_attention_heads_per_partition = num_attention_heads
         self.position_encoding_2d = position_encoding_2d
+        self.attention_implementation = attention_implementation
+        self.attention_chunk_size = attention_chunk_size
         self.rotary_emb = RotaryEmbedding(
             self.hidden_size // (self.num_attention_heads * 2)
             if position_encoding_2d
@@ -727,10 +1293,12 @@ class SelfAttention(torch.nn.Module):
             layer_past: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
             use_cache: bool = False,
             output_attentions: bool = False,
+            rotary_pos_emb: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
     ):
         """
         hidden_states: [seq_len, batch, hidden_size]
         attention_mask: [(1, 1), seq_len, seq_len]
+        rotary_pos_emb: cos, sin from `get_rotary_pos_emb`, gathered once for all layers
         """
 
         # [seq_len, batch, 3 * hidden_size]
@@ -746,7 +1314,11 @@ class SelfAttention(torch.nn.Module):
         # [seq_len, batch, num_attention_heads, hidden_size_per_attention_head]
         (query_layer, key_layer, value_layer) = self.split_tensor_along_last_dim(mixed_raw_layer, 3)
 
-        if self.position_encoding_2d:
+        if rotary_pos_emb is not None:
+            query_layer, key_layer = apply_rotary_pos_emb_fused(
+                query_layer, key_layer, *rotary_pos_emb, num_streams=2 if self.position_encoding_2d else 1
+            )
+        elif self.position_encoding_2d:
             q1, q2 = query_layer.chunk(2, dim=(query_layer.ndim - 1))
             k1, k2 = key_layer.chunk(2, dim=(key_layer.ndim - 1))
             cos, sin = self.rotary_emb(q1, seq_len=position_ids.max() + 1)
@@ -772,7 +1344,8 @@ class SelfAttention(torch.nn.Module):
             hidden_size_per_partition=self.hidden_size_per_partition,
             layer_id=layer_id,
             layer_past=layer_past,
-            use_cache=use_cache
+            use_cache=use_cache,
+            output_attentions=output_attentions,
         )
 
         output = self.dense(context_layer)
@@ -852,7 +1425,9 @@ class GLMBlock(torch.nn.Module):
             use_bias=True,
             params_dtype=torch.float,
             num_layers=28,
-            position_encoding_2d=True
+            position_encoding_2d=True,
+            attention_implementation="eager",
+            attention_chunk_size=512,
     ):
         super(GLMBlock, self).__init__()
         # Set output layer initialization if not provided.
@@ -872,7 +1447,9 @@ class GLMBlock(torch.nn.Module):
             hidden_size_per_attention_head=hidden_size_per_attention_head,
             bias=use_bias,
             params_dtype=params_dtype,
-            position_encoding_2d=self.position_encoding_2d
+            position_encoding_2d=self.position_encoding_2d,
+            attention_implementation=attention_implementation,
+            attention_chunk_size=attention_chunk_size,
         )
 
         # Layernorm on the input data.
@@ -898,6 +1475,7 @@ class GLMBlock(torch.nn.Module):
             layer_past: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
             use_cache: bool = False,
             output_attentions: bool = False,
+            rotary_pos_emb: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
     ):
         """
         hidden_states: [seq_len, batch, hidden_size]
@@ -916,7 +1494,8 @@ class GLMBlock(torch.nn.Module):
             layer_id=layer_id,
             layer_past=layer_past,
             use_cache=use_cache,
-            output_attentions=output_attentions
+            output_attentions=output_attentions,
+            rotary_pos_emb=rotary_pos_emb,
         )
 
         attention_output = attention_outputs[0]
@@ -1081,6 +1660,8 @@ class ChatGLMModel(ChatGLMPreTrainedModel):
                 use_bias=True,
                 params_dtype=self.params_dtype,
                 position_encoding_2d=self.position_encoding_2d,
+                attention_implementation=config.attention_implementation,
+                attention_chunk_size=config.attention_chunk_size,
             )
 
         self.layers = torch.nn.ModuleList(
@@ -1096,39 +1677,6 @@ class ChatGLMModel(ChatGLMPreTrainedModel):
     def set_input_embeddings(self, new_embeddings: torch.Tensor):
         self.word_embeddings = new_embeddings
 
-    @staticmethod
-    def get_masks(seq, device):
-        context_length = seq.index(150004) + 1
-
-        attention_mask = torch.ones((1, len(seq), len(seq)), device=device)
-        attention_mask.tril_()
-        attention_mask[..., :context_length - 1] = 1
-        attention_mask.unsqueeze_(1)
-        attention_mask = (attention_mask < 0.5).bool()
-
-        return attention_mask
-
-    def get_position_ids(self, seq, mask_position, device, gmask=False):
-        context_length = len(seq)
-        if self.position_encoding_2d:
-            seq_length = seq.index(150004)
-            position_ids = torch.arange(context_length, dtype=torch.long, device=device)
-            if not gmask:
-                position_ids[seq_length:] = mask_position
-            block_position_ids = torch.cat((
-                torch.zeros(seq_length, dtype=torch.long, device=device),
-                torch.arange(context_length - seq_length, dtype=torch.long, device=device) + 1
-            ))
-            position_ids = torch.stack((position_ids, block_position_ids), dim=0)
-        else:
-            position_ids = torch.arange(context_length, dtype=torch.long, device=device)
-            if not gmask:
-                position_ids[context_length - 1:] = mask_position
-
-        position_ids = position_ids.unsqueeze(0)
-
-        return position_ids
-
     @add_start_docstrings_to_model_forward(CHATGLM_6B_INPUTS_DOCSTRING.format("batch_size, sequence_length"))
     @add_code_sample_docstrings(
         checkpoint=_CHECKPOINT_FOR_DOC,
@@ -1146,6 +1694,7 @@ class ChatGLMModel(ChatGLMPreTrainedModel):
             output_attentions: Optional[bool] = None,
             output_hidden_states: Optional[bool] = None,
             return_dict: Optional[bool] = None,
+            prefix_lengths: Optional[torch.LongTensor] = None,
     ) -> Union[Tuple[torch.Tensor, ...], BaseModelOutputWithPast]:
 
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
@@ -1164,28 +1713,32 @@ class ChatGLMModel(ChatGLMPreTrainedModel):
         else:
             raise ValueError("You have to specify either input_ids or inputs_embeds")
 
-        if past_key_values is None:
-            past_key_values = tuple([None] * len(self.layers))
+        if attention_mask is None and prefix_lengths is not None:
+            # compact masks from the data collator, expanded on the model device
+            attention_mask = get_prefix_lm_masks(prefix_lengths.to(self.word_embeddings.weight.device), seq_length)
 
-            MASK, gMASK = 150000, 150001
-            mask_token = MASK if MASK in input_ids else gMASK
-            use_gmask = False if MASK in input_ids else gMASK
-            seq = input_ids[0].tolist()
+        kv_cache = isinstance(past_key_values, KVCache)
+        if kv_cache:
+            # a cache object is written in place, so it is always used
+            use_cache = True
 
-            mask_position = seq.index(mask_token)
+        # with masks and positions given, a cache object is not asked for its length, which may need a host sync
+        if past_key_values is None or (
+                kv_cache and (attention_mask is None or position_ids is None) and past_key_values.get_seq_length() == 0
+        ):
+            if not kv_cache:
+                past_key_values = tuple([None] * len(self.layers))
+
+            if attention_mask is None or position_ids is None:
+                mask_positions, context_lengths, use_gmasks = get_mask_positions(input_ids)
 
             if attention_mask is None:
-                attention_mask = self.get_masks(
-                    seq=seq,
-                    device=input_ids.device
-                )
+                # everything before the bos token is visible to every query
+                attention_mask = get_prefix_lm_masks(context_lengths, seq_length)
 
             if position_ids is None:
-                position_ids = self.get_position_ids(
-                    seq=seq,
-                    mask_position=mask_position,
-                    device=input_ids.device,
-                    gmask=use_gmask
+                position_ids = get_batch_position_ids(
+                    seq_length, mask_positions, context_lengths, use_gmasks, self.position_encoding_2d
                 )
 
         if inputs_embeds is None:
@@ -1198,16 +1751,22 @@ class ChatGLMModel(ChatGLMPreTrainedModel):
         all_self_attentions = () if output_attentions else None
         all_hidden_states = () if output_hidden_states else None
 
-        seq_length_with_past = seq_length
-        past_key_values_length = 0
-        if past_key_values[0] is not None:
-            past_key_values_length = past_key_values[0][0].shape[0]
-            seq_length_with_past = seq_length_with_past + past_key_values_length
+        if kv_cache:
+            past_key_values.begin_forward(batch_size, seq_length)
         if attention_mask is None:
             attention_mask = torch.zeros(1, 1, device=input_ids.device).bool()
 
         else:
             attention_mask = attention_mask.to(input_ids.device)
+        if kv_cache:
+            # mask the slots of the cache the new tokens must not see, e.g. padding of shorter rows
+            attention_mask = past_key_values.get_attention_mask(attention_mask)
+
+        # the rotary tables of all layers are the same, gather them once
+        rotary_pos_emb = get_rotary_pos_emb(
+            self.layers[0].attention.rotary_emb, position_ids, position_encoding_2d=self.position_encoding_2d,
+            max_length=past_key_values.max_length if kv_cache else None,
+        )
 
         for i, layer in enumerate(self.layers):
 
@@ -1218,20 +1777,24 @@ class ChatGLMModel(ChatGLMPreTrainedModel):
                 hidden_states,
                 position_ids=position_ids,
                 attention_mask=attention_mask,
-                layer_id=torch.tensor(i),
-                layer_past=past_key_values[i],
+                layer_id=i,
+                layer_past=past_key_values.layer(i) if kv_cache else past_key_values[i],
                 use_cache=use_cache,
-                output_attentions=output_attentions
+                output_attentions=output_attentions,
+                rotary_pos_emb=rotary_pos_emb,
             )
 
             hidden_states = layer_ret[0]
 
-            if use_cache:
+            if use_cache and not kv_cache:
                 presents = presents + (layer_ret[1],)
 
             if output_attentions:
                 all_self_attentions = all_self_attentions + (layer_ret[2 if use_cache else 1],)
 
+        if kv_cache:
+            presents = past_key_values
+
         # Final layer norm.
         hidden_states = self.final_layernorm(hidden_states)
 
@@ -1275,7 +1838,8 @@ class ChatGLMForConditionalGeneration(ChatGLMPreTrainedModel):
 
         if self.config.quantization_bit:
             self.quantize(self.config.quantization_bit, self.config.quantization_embeddings,
-                          use_quantization_cache=True, empty_init=True)
+                          use_quantization_cache=True, empty_init=True,
+                          group_size=getattr(self.config, "quantization_group_size", 0))
 
     def get_output_embeddings(self):
         return self.lm_head
@@ -1283,83 +1847,107 @@ class ChatGLMForConditionalGeneration(ChatGLMPreTrainedModel):
     def set_output_embeddings(self, new_embeddings):
         self.lm_head = new_embeddings
 
-    def get_masks_and_position_ids(self, seq, mask_position, context_length, device, gmask=False):
-        attention_mask = torch.ones((1, context_length, context_length), device=device)
-        attention_mask.tril_()
-        attention_mask[..., :mask_position - 1] = 1
-        attention_mask.unsqueeze_(1)
-        attention_mask = (attention_mask < 0.5).bool()
-
-        if self.position_encoding_2d:
-            seq_length = seq.index(150004)
-            position_ids = torch.arange(context_length, dtype=torch.long, device=device)
-            if not gmask:
-                position_ids[seq_length:] = mask_position
-            block_position_ids = torch.cat((
-                torch.zeros(seq_length, dtype=torch.long, device=device),
-                torch.arange(context_length - seq_length, dtype=torch.long, device=device) + 1
-            ))
-            position_ids = torch.stack((position_ids, block_position_ids), dim=0)
-        else:
-            position_ids = torch.arange(context_length, dtype=torch.long, device=device)
-            if not gmask:
-                position_ids[context_length - 1:] = mask_position
-
-        position_ids = position_ids.unsqueeze(0)
-
+    def get_masks_and_position_ids(self, input_ids, mask_positions, context_lengths, use_gmasks, pad_lengths=None):
+        """
+        Per row prompt masks and position ids, for the [b] values of `get_mask_positions`.
+        The first `pad_lengths` tokens of left padded rows are masked for every query.
+        """
+        seq_length = input_ids.size(1)
+        # columns `[:mask_position - 1]` of a row are visible to every query, a negative end counts from the back
+        row_lengths = seq_length if pad_lengths is None else seq_length - pad_lengths
+        prefix_lengths = mask_positions - 1 if pad_lengths is None else mask_positions - pad_lengths - 1
+        prefix_lengths = torch.where(prefix_lengths < 0, prefix_lengths + row_lengths, prefix_lengths)
+        if pad_lengths is not None:
+            prefix_lengths = prefix_lengths + pad_lengths
+        attention_mask = get_prefix_lm_masks(prefix_lengths, seq_length)
+        if pad_lengths is not None:
+            attention_mask = attention_mask | self.get_padding_mask(pad_lengths, seq_length)
+        position_ids = get_batch_position_ids(
+            seq_length, mask_positions, context_lengths, use_gmasks, self.position_encoding_2d, pad_lengths
+        )
         return attention_mask, position_ids
 
+    @staticmethod
+    def get_padding_mask(pad_lengths: torch.LongTensor, seq_length: int):
+        """[b, 1, 1, seq_length] mask of the left padding of every row."""
+        positions = torch.arange(seq_length, device=pad_lengths.device)
+        return (positions[None, :] < pad_lengths[:, None])[:, None, None, :]
+
     def prepare_inputs_for_generation(
             self,
             input_ids: torch.LongTensor,
             past: Optional[torch.Tensor] = None,
             past_key_values: Optional[torch.Tensor] = None,
             attention_mask: Optional[torch.Tensor] = None,
+            mask_positions: Optional[torch.LongTensor] = None,
+            context_lengths: Optional[torch.LongTensor] = None,
+            use_gmasks: Optional[torch.BoolTensor] = None,
+            pad_lengths: Optional[torch.LongTensor] = None,
             **kwargs
     ) -> dict:
-
-        MASK, gMASK = 150000, 150001
-        mask_token = MASK if MASK in input_ids else gMASK
-        use_gmask = False if MASK in input_ids else gMASK
-        seq = input_ids[0].tolist()
-        mask_position = seq.index(mask_token)
-
-        if mask_token not in seq:
-            raise ValueError("You have to add either [MASK] or [gMASK] in your input")
+        # an empty cache object is filled by the prefill forward
+        is_prefill = past is None and (
+                past_key_values is None
+                or (isinstance(past_key_values, KVCache) and past_key_values.get_seq_length() == 0)
+        )
+        if mask_positions is None:
+            # not carried in `model_kwargs` by `generate`, scan the ids on the device
+            mask_positions, context_lengths, use_gmasks = get_mask_positions(input_ids, check=is_prefill)
+            if attention_mask is not None and attention_mask.dim() == 2:
+                pad_lengths = get_pad_lengths(attention_mask)
 
         # only last token for input_ids if past is not None
-        if past is not None or past_key_values is not None:
-            context_length = seq.index(150004)
-            last_token = input_ids[:, -1].unsqueeze(-1)
+        if not is_prefill:
+            last_token = input_ids[:, -1:]
+            if pad_lengths is not None:
+                mask_positions = mask_positions - pad_lengths
             if self.position_encoding_2d:
-                position_ids = torch.tensor([[[mask_position], [len(seq) - context_length]]], dtype=torch.long,
-                                            device=input_ids.device)
+                position_ids = torch.stack((mask_positions, input_ids.size(1) - context_lengths), dim=1).unsqueeze(-1)
             else:
-                position_ids = torch.tensor([[mask_position]], dtype=torch.long, device=input_ids.device)
+                position_ids = mask_positions.unsqueeze(-1)
 
             if past is None:
                 past = past_key_values
-            return {
+            inputs = {
                 "input_ids": last_token,
                 "past_key_values": past,
                 "position_ids": position_ids,
             }
+            if pad_lengths is not None:
+                inputs["attention_mask"] = self.get_padding_mask(pad_lengths, input_ids.size(1))
+            return inputs
         else:
             attention_mask, position_ids = self.get_masks_and_position_ids(
-                seq=seq,
-                mask_position=mask_position,
-                context_length=len(seq),
-                device=input_ids.device,
-                gmask=use_gmask
+                input_ids, mask_positions, context_lengths, use_gmasks, pad_lengths
             )
 
             return {
                 "input_ids": input_ids,
-                "past_key_values": past,
+                "past_key_values": past_key_values,
                 "position_ids": position_ids,
                 "attention_mask": attention_mask
             }
 
+    def _add_mask_positions(self, input_ids: torch.LongTensor, model_kwargs: dict) -> dict:
+        """
+        Scan the prompts once, the decode steps read the per row positions from `model_kwargs`.
+        Left padding is read from the [b, L] `attention_mask` of the tokenizer.
+        """
+        if model_kwargs.get("mask_positions") is None:
+            mask_positions, context_lengths, use_gmasks = get_mask_positions(input_ids)
+            model_kwargs.update(mask_positions=mask_positions, context_lengths=context_lengths, use_gmasks=use_gmasks)
+            attention_mask = model_kwargs.get("attention_mask")
+            if attention_mask is not None and attention_mask.dim() == 2:
+                model_kwargs["pad_lengths"] = get_pad_lengths(attention_mask)
+        return model_kwargs
+
+    @torch.no_grad()
+    def generate(self, inputs: Optional[torch.Tensor] = None, **kwargs):
+        input_ids = inputs if inputs is not None else kwargs.get("input_ids")
+        if input_ids is not None:
+            kwargs = self._add_mask_positions(input_ids, kwargs)
+        return super().generate(inputs, **kwargs)
+
     def forward(
             self,
             input_ids: Optional[torch.Tensor] = None,
@@ -1372,6 +1960,7 @@ class ChatGLMForConditionalGeneration(ChatGLMPreTrainedModel):
             output_attentions: Optional[bool] = None,
             output_hidden_states: Optional[bool] = None,
             return_dict: Optional[bool] = None,
+            prefix_lengths: Optional[torch.LongTensor] = None,
     ):
         use_cache = use_cache if use_cache is not None else self.config.use_cache
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
@@ -1386,6 +1975,7 @@ class ChatGLMForConditionalGeneration(ChatGLMPreTrainedModel):
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
+            prefix_lengths=prefix_lengths,
         )
 
         hidden_states = transformer_outputs[0]
@@ -1429,6 +2019,8 @@ class ChatGLMForConditionalGeneration(ChatGLMPreTrainedModel):
 
         Output shares the same memory storage as `past`.
         """
+        if isinstance(past, KVCache):
+            return past.reorder(beam_idx)
         return tuple(
             (
                 layer_past[0].index_select(1, beam_idx.to(layer_past[0].device)),
@@ -1439,7 +2031,8 @@ class ChatGLMForConditionalGeneration(ChatGLMPreTrainedModel):
 
     @torch.no_grad()
     def chat(self, tokenizer, query: str, history: List[Tuple[str, str]] = None, max_length: int = 2048, num_beams=1,
-             do_sample=True, top_p=0.7, temperature=0.95, logits_processor=None, **kwargs):
+             do_sample=True, top_p=0.7, temperature=0.95, logits_processor=None,
+             prefix_cache: Optional[PrefixCache] = None, session_id=None, **kwargs):
         if history is None:
             history = []
         if logits_processor is None:
@@ -1454,10 +2047,20 @@ class ChatGLMForConditionalGeneration(ChatGLMPreTrainedModel):
             for i, (old_query, response) in enumerate(history):
                 prompt += "[Round {}]\n问：{}\n答：{}\n".format(i, old_query, response)
             prompt += "[Round {}]\n问：{}\n答：".format(len(history), query)
-        input_ids = tokenizer([prompt], return_tensors="pt", padding=True)
-        input_ids = input_ids.to(self.device)
-        outputs = self.generate(**input_ids, **gen_kwargs)
-        outputs = outputs.tolist()[0][len(input_ids["input_ids"][0]):]
+        # the prefix cache goes through the engine, which only implements the sampling arguments
+        use_engine = all(k in ContinuousBatchingEngine.generation_kwargs or k == "num_beams" for k in gen_kwargs)
+        if prefix_cache is not None and session_id is not None and use_engine:
+            # a resampled round reuses the cached prompt of the session, a new round is encoded in full
+            if num_beams != 1:
+                raise ValueError("Prefix cache only supports `num_beams=1`, got {}.".format(num_beams))
+            gen_kwargs.pop("num_beams")
+            engine = ContinuousBatchingEngine(self, max_batch_size=1, prefix_cache=prefix_cache, **gen_kwargs)
+            outputs = engine.generate([tokenizer(prompt)["input_ids"]], session_ids=[session_id])[0]
+        else:
+            input_ids = tokenizer([prompt], return_tensors="pt", padding=True)
+            input_ids = input_ids.to(self.device)
+            outputs = self.generate(**input_ids, **gen_kwargs)
+            outputs = outputs.tolist()[0][len(input_ids["input_ids"][0]):]
         response = tokenizer.decode(outputs)
         response = response.strip()
         response = response.replace("[[训练时间]]", "2023年")
@@ -1479,7 +2082,7 @@ class ChatGLMForConditionalGeneration(ChatGLMPreTrainedModel):
         if generation_config is None:
             generation_config = self.generation_config
         generation_config = copy.deepcopy(generation_config)
-        model_kwargs = generation_config.update(**kwargs)
+        model_kwargs = self._add_mask_positions(input_ids, generation_config.update(**kwargs))
         bos_token_id, eos_token_id = generation_config.bos_token_id, generation_config.eos_token_id
 
         if isinstance(eos_token_id, int):
@@ -1560,13 +2163,14 @@ class ChatGLMForConditionalGeneration(ChatGLMPreTrainedModel):
                 outputs, model_kwargs, is_encoder_decoder=self.config.is_encoder_decoder
             )
             unfinished_sequences = unfinished_sequences.mul((sum(next_tokens != i for i in eos_token_id)).long())
+            yield input_ids
 
             # stop when each sentence is finished, or if we exceed the maximum length
             if unfinished_sequences.max() == 0 or stopping_criteria(input_ids, scores):
                 break
-            yield input_ids
 
-    def quantize(self, bits: int, quantize_embeddings=False, use_quantization_cache=False, empty_init=False, **kwargs):
+    def quantize(self, bits: int, quantize_embeddings=False, use_quantization_cache=False, empty_init=False,
+                 group_size=0, input_scales=None, **kwargs):
         if bits == 0:
             return
 
@@ -1584,9 +2188,11 @@ class ChatGLMForConditionalGeneration(ChatGLMPreTrainedModel):
 
         self.config.quantization_bit = bits
         self.config.quantization_embeddings = quantize_embeddings
+        self.config.quantization_group_size = group_size
 
         self.transformer = quantize(self.transformer, bits, use_quantization_cache=use_quantization_cache,
-                                    empty_init=empty_init, **kwargs)
+                                    empty_init=empty_init, group_size=group_size, input_scales=input_scales,
+                                    **kwargs)
 
         if quantize_embeddings:
             logger.info("Applying quantization to embeddings")
@@ -1614,3 +2220,67 @@ class ChatGLMForConditionalGeneration(ChatGLMPreTrainedModel):
             )
 
         return self
+
+    def save_quantized(self, save_directory: str):
+        """
+        Saves the config and the quantized state dict (packed int8/int4 `weight` and `weight_scale` of
+        every QuantizedLinear) to `save_directory`, `from_quantized` loads it without re-quantizing.
+        """
+        if not self.quantized:
+            raise ValueError("The model is not quantized, call `quantize(bits)` before `save_quantized`.")
+        os.makedirs(save_directory, exist_ok=True)
+        self.config.save_pretrained(save_directory)
+        state_dict = {k: v.detach().to("cpu").contiguous() for k, v in self.state_dict().items()}
+        torch.save(state_dict, os.path.join(save_directory, QUANTIZED_WEIGHTS_NAME))
+
+    @classmethod
+    def from_quantized(cls, model_path: str, mmap: bool = True, **kwargs):
+        """
+        Loads a model saved by `save_quantized`. The quantized layers are created empty from the config and
+        take the saved tensors as they are, with `mmap` the tensors stay memory mapped and are only read
+        from disk when used. kwargs are passed to `ChatGLMConfig.from_pretrained`.
+        """
+        config = ChatGLMConfig.from_pretrained(model_path, **kwargs)
+        if not config.quantization_bit:
+            raise ValueError(f"{model_path} is not a quantized checkpoint, `quantization_bit` is not set.")
+        model = cls(config)
+        weights_file = os.path.join(model_path, QUANTIZED_WEIGHTS_NAME)
+        state_dict = None
+        if mmap:
+            try:
+                state_dict = torch.load(weights_file, map_location="cpu", mmap=True, weights_only=True)
+            except TypeError:
+                # torch < 2.1 has no mmap loading
+                logger.warning("torch.load does not support mmap, loading the quantized weights into memory")
+        if state_dict is None:
+            state_dict = torch.load(weights_file, map_location="cpu")
+        if "assign" in inspect.signature(model.load_state_dict).parameters:
+            model.load_state_dict(state_dict, assign=True)
+        else:
+            # torch < 2.1 copies into the existing tensors, take the saved ones (and their dtypes) as they are
+            missing = set(model.state_dict()) - set(state_dict)
+            unexpected = set(state_dict) - set(model.state_dict())
+            if missing or unexpected:
+                raise RuntimeError(f"Error loading {weights_file}, missing keys: {sorted(missing)}, "
+                                   f"unexpected keys: {sorted(unexpected)}")
+            for key, tensor in state_dict.items():
+                module_name, _, name = key.rpartition(".")
+                module = model.get_submodule(module_name)
+                if name in module._parameters:
+                    param = module._parameters[name]
+                    module._parameters[name] = nn.Parameter(tensor, requires_grad=param.requires_grad)
+                else:
+                    module._buffers[name] = tensor
+        return model.eval()
+
+    def set_dequantized_weight_cache(self, max_memory: int, prefetch: bool = True):
+        """
+        Keeps the dequantized float weights of the first layers resident up to `max_memory` bytes for cpu
+        inference, the other layers are dequantized on the fly, with `prefetch` in a background thread while
+        the previous linear computes. Returns the `DequantizedWeightCache`, `get_stats()` reports its hits.
+        """
+        from .quantization import set_dequantized_weight_cache
+
+        if not self.quantized:
+            raise ValueError("The model is not quantized, call `quantize(bits)` first.")
+        return set_dequantized_weight_cache(self.transformer, max_memory, prefetch=prefetch)
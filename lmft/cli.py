@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description: Command line entry point, `lmft serve --model_name THUDM/chatglm-6b`
+    and `lmft merge --model_name THUDM/chatglm-6b --lora_name lora.pt --save_dir ./merged/`
+"""
+import argparse
+import sys
+
+from loguru import logger
+
+
+def serve(args):
+    from lmft.chatglm_model import ChatGLMTune
+    from lmft.server import ChatGLMServer
+
+    model_args = {
+        "use_lora": args.lora_name is not None,
+        "output_dir": args.output_dir,
+        "max_length": args.max_length,
+        "eval_batch_size": args.batch_size,
+        "use_continuous_batching": True,
+        "use_paged_kv_cache": args.use_paged_kv_cache,
+        "use_int8_kv_cache": args.use_int8_kv_cache,
+        "use_prefix_cache": args.use_prefix_cache,
+        "silent": True,
+    }
+    if args.lora_name is not None:
+        model_args["lora_name"] = args.lora_name
+    model = ChatGLMTune(args.model_type, args.model_name, args=model_args, use_cuda=args.use_cuda)
+    server = ChatGLMServer(model, host=args.host, port=args.port, max_batch_size=args.batch_size,
+                           batch_wait_ms=args.batch_wait_ms)
+    server.run()
+
+
+def merge(args):
+    from lmft.chatglm_model import ChatGLMTune
+
+    model_args = {
+        "use_lora": True,
+        "output_dir": args.output_dir,
+        "lora_name": args.lora_name,
+        "silent": True,
+    }
+    model = ChatGLMTune(args.model_type, args.model_name, args=model_args, use_cuda=args.use_cuda)
+    model.merge_lora(args.save_dir, quantization_bit=args.quantization_bit,
+                     quantization_group_size=args.quantization_group_size)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="lmft", description="Language Model Fine-tuning Toolkit")
+    subparsers = parser.add_subparsers(dest="command")
+    serve_parser = subparsers.add_parser("serve", help="Serve a ChatGLM model over HTTP")
+    serve_parser.add_argument('--model_type', default='chatglm', type=str, help='Transformers model type')
+    serve_parser.add_argument('--model_name', default='THUDM/chatglm-6b', type=str, help='Transformers model or path')
+    serve_parser.add_argument('--output_dir', default='./outputs/', type=str, help='Directory of the lora weights')
+    serve_parser.add_argument('--lora_name', default=None, type=str, help='Lora weights file in output_dir')
+    serve_parser.add_argument('--use_cuda', action='store_true', help='Whether to run on GPU')
+    serve_parser.add_argument('--max_length', default=2048, type=int, help='Output max sequence length')
+    serve_parser.add_argument('--batch_size', default=8, type=int, help='Max micro-batch size')
+    serve_parser.add_argument('--batch_wait_ms', default=10, type=float,
+                              help='How long a request waits for others to join its micro-batch')
+    serve_parser.add_argument('--use_paged_kv_cache', action='store_true', help='Whether to use the paged kv cache')
+    serve_parser.add_argument('--use_int8_kv_cache', action='store_true',
+                              help='Whether to store the paged kv cache in int8')
+    serve_parser.add_argument('--use_prefix_cache', action='store_true', help='Whether to cache the last prompt of every session, to resample a round')
+    serve_parser.add_argument('--host', default='0.0.0.0', type=str, help='Address to listen on')
+    serve_parser.add_argument('--port', default=8000, type=int, help='Port to listen on')
+    merge_parser = subparsers.add_parser("merge", help="Merge lora weights into the model and save it")
+    merge_parser.add_argument('--model_type', default='chatglm', type=str, help='Transformers model type')
+    merge_parser.add_argument('--model_name', default='THUDM/chatglm-6b', type=str, help='Transformers model or path')
+    merge_parser.add_argument('--output_dir', default='./outputs/', type=str, help='Directory of the lora weights')
+    merge_parser.add_argument('--lora_name', default='lora.pt', type=str, help='Lora weights file in output_dir')
+    merge_parser.add_argument('--save_dir', default='./merged/', type=str, help='Directory to save the merged model')
+    merge_parser.add_argument('--quantization_bit', default=0, type=int, choices=[0, 4, 8],
+                              help='Quantize the merged model, 0 to keep it unquantized')
+    merge_parser.add_argument('--quantization_group_size', default=0, type=int,
+                              help='Input channels sharing a quantization scale, 0 for one scale per row')
+    merge_parser.add_argument('--use_cuda', action='store_true', help='Whether to run on GPU')
+    args = parser.parse_args(argv)
+    logger.info(args)
+
+    if args.command == "serve":
+        serve(args)
+    elif args.command == "merge":
+        merge(args)
+    else:
+        parser.print_help()
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
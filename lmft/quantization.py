@@ -4,12 +4,14 @@ import torch.nn.functional as F
 
 import os
 import bz2
+import hashlib
 import torch
 import base64
 import ctypes
 
 from typing import List
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 
 try:
     from cpm_kernels.kernels.base import LazyKernelCModule, KernelFunction, round_up
@@ -64,6 +66,12 @@ class W8A16Linear(torch.autograd.Function):
 
 
 class W8A16LinearCPU(torch.autograd.Function):
+    """
+    Quantized linear on cpu. Up to `CPU_FUSED_GEMM_MAX_ROWS` float32 input rows (decode) go through the fused
+    gemm kernel, which reads the packed weight directly. Larger inputs (prefill) still dequantize the full weight
+    into a float matrix for a BLAS matmul, there is no cache blocking of the fused kernel for them.
+    """
+
     @staticmethod
     def forward(ctx, inp: torch.Tensor, quant_w: torch.Tensor, scale_w: torch.Tensor, weight_bit_width, quantization_cache=None):
         ctx.inp_shape = inp.size()
@@ -71,8 +79,13 @@ class W8A16LinearCPU(torch.autograd.Function):
         ctx.weight_bit_width = weight_bit_width
         out_features = quant_w.size(0)
         inp = inp.contiguous().view(-1, inp.size(-1))
-        weight = extract_weight_to_float(quant_w, scale_w, weight_bit_width, quantization_cache=quantization_cache)
-        output = inp.mm(weight.t())
+        if use_fused_gemm(inp, scale_w):
+            output = fused_gemm(inp, quant_w, scale_w, weight_bit_width)
+        elif isinstance(quantization_cache, CachedWeight):
+            output = inp.mm(quantization_cache.get().t())
+        else:
+            weight = extract_weight_to_float(quant_w, scale_w, weight_bit_width, quantization_cache=quantization_cache)
+            output = inp.mm(weight.t())
         ctx.save_for_backward(inp, quant_w, scale_w)
         return output.view(*(ctx.inp_shape[:-1] + (out_features,)))
 
@@ -91,6 +104,168 @@ default_cpu_kernel_code = "QlpoOTFBWSZTWXLbSoQAAgzbgERwQXxmTwAAr/ff3kABt0Q2oRVT0
 default_cpu_parallel_kernel_code_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "quantization_kernels_parallel.c")
 default_cpu_parallel_kernel_code = "QlpoOTFBWSZTWZzWK2UAALXbgERwSX1mTwAAr/ff3kACNyXSbZYwBpoaNGIyAaADQwRRFT/UKDINANqAD1NABFQlPUzaaJHppGRmoAG01ARKKaaMp4gmgaNAaDQDIKVKfZ/g6v1Kem5ZsWZmZtSXS5ZwRAzKmjr1E1lKMEoQNCPkEYPACgcR5I9w/0k6JrJYHqFuHnChcD7N+DHeOQ0ajF83Tc40jgmQbOB5wt3TEHyTObDBLoxrJGBuJmNbxYZwAoKTjbIcI7GsbuVRERAR8wqwhXQjQOxiHQlgSnHjQjddXERojNmQYJJVoM2xxawMeI9asi6E1rfd7GO8S0S5vacCNGry4F1nyZbcTvSBXEMipuPfM7i0Y8kjirpbxb05jpIQjCGE8DYBNCAZyHz9EoOpDRST/I1aFCNpcjoXgyc3NjVsUvYIaYq7xopYJqcxg2g4qXofm7AaGNTzJSNguOQw4utKcEl0F1UOgI+T1hk5LusbGZ9udC1CiBeGwwFxR/QdbZDndehRPxyGt3Me1DBW45MXIY24ZD30aFNuSEUdu5LWx1sSJWLGgsmqUIFTgWhU0gfxXpzhghr2AYpV3hE06mGk1I2JyuZiFgkiz/i7kinChITmsVso"
 
+# Fused dequantize-and-multiply. With a scale per row, a tile of 4 quantized weight rows stays in L1 while every input
+# row is multiplied with it, the weights are converted to float in registers and the row scale is applied to the sums.
+# With group-wise scales a row is dequantized into an L1 float buffer first.
+default_cpu_gemm_kernel_code = r"""
+#include <omp.h>
+#include <stdint.h>
+#include <stdlib.h>
+
+void set_num_threads(int n_threads)
+{
+    omp_set_num_threads(n_threads);
+}
+
+/* one scale per row: out[b][i] = scale[i] * sum_j inp[b][j] * weight[i][j], weight: int8 [n][k] */
+static void gemm_int8_row_scale(const float *inp, const int8_t *weight, const float *scale, float *out, int batch,
+                                int n, int k)
+{
+    #pragma omp parallel for schedule(static)
+    for (int i = 0; i < n; i += 4)
+    {
+        int rows = n - i < 4 ? n - i : 4;
+        const int8_t *w0 = weight + (int64_t)i * k;
+        const int8_t *w1 = rows > 1 ? w0 + k : w0;
+        const int8_t *w2 = rows > 2 ? w0 + 2 * (int64_t)k : w0;
+        const int8_t *w3 = rows > 3 ? w0 + 3 * (int64_t)k : w0;
+        for (int b = 0; b < batch; b++)
+        {
+            const float *x = inp + (int64_t)b * k;
+            float a0 = 0.f, a1 = 0.f, a2 = 0.f, a3 = 0.f;
+            #pragma omp simd reduction(+:a0,a1,a2,a3)
+            for (int j = 0; j < k; j++)
+            {
+                float xj = x[j];
+                a0 += xj * w0[j];
+                a1 += xj * w1[j];
+                a2 += xj * w2[j];
+                a3 += xj * w3[j];
+            }
+            float acc[4] = {a0, a1, a2, a3};
+            float *o = out + (int64_t)b * n + i;
+            for (int r = 0; r < rows; r++)
+                o[r] = acc[r] * scale[i + r];
+        }
+    }
+}
+
+/* weight: int4 packed [n][k / 2], the high nibble of a byte is column 2j, the low nibble column 2j + 1 */
+static void gemm_int4_row_scale(const float *inp, const int8_t *weight, const float *scale, float *out, int batch,
+                                int n, int k)
+{
+    int m = k >> 1;
+    #pragma omp parallel for schedule(static)
+    for (int i = 0; i < n; i += 4)
+    {
+        int rows = n - i < 4 ? n - i : 4;
+        const int8_t *w0 = weight + (int64_t)i * m;
+        const int8_t *w1 = rows > 1 ? w0 + m : w0;
+        const int8_t *w2 = rows > 2 ? w0 + 2 * (int64_t)m : w0;
+        const int8_t *w3 = rows > 3 ? w0 + 3 * (int64_t)m : w0;
+        for (int b = 0; b < batch; b++)
+        {
+            const float *x = inp + (int64_t)b * k;
+            float a0 = 0.f, a1 = 0.f, a2 = 0.f, a3 = 0.f;
+            #pragma omp simd reduction(+:a0,a1,a2,a3)
+            for (int j = 0; j < m; j++)
+            {
+                float xh = x[2 * j], xl = x[2 * j + 1];
+                a0 += xh * (w0[j] >> 4) + xl * ((int8_t)((uint8_t)w0[j] << 4) >> 4);
+                a1 += xh * (w1[j] >> 4) + xl * ((int8_t)((uint8_t)w1[j] << 4) >> 4);
+                a2 += xh * (w2[j] >> 4) + xl * ((int8_t)((uint8_t)w2[j] << 4) >> 4);
+                a3 += xh * (w3[j] >> 4) + xl * ((int8_t)((uint8_t)w3[j] << 4) >> 4);
+            }
+            float acc[4] = {a0, a1, a2, a3};
+            float *o = out + (int64_t)b * n + i;
+            for (int r = 0; r < rows; r++)
+                o[r] = acc[r] * scale[i + r];
+        }
+    }
+}
+
+/*
+ * group-wise scales, scale: [n][k / group_size]. A row is dequantized with its group scales into a float buffer
+ * that stays in L1, then multiplied with every input row.
+ */
+static void gemm_group_scale(const float *inp, const int8_t *weight, const float *scale, float *out, int batch,
+                             int n, int k, int group_size, int bit_width)
+{
+    int groups = k / group_size;
+    int64_t row_bytes = bit_width == 4 ? k >> 1 : k;
+    #pragma omp parallel
+    {
+        float *buffer = (float *)malloc(sizeof(float) * k);
+        #pragma omp for schedule(static)
+        for (int i = 0; i < n; i++)
+        {
+            const int8_t *w = weight + (int64_t)i * row_bytes;
+            const float *s = scale + (int64_t)i * groups;
+            if (bit_width == 4)
+            {
+                int packed_group_size = group_size >> 1;
+                for (int g = 0; g < groups; g++)
+                {
+                    float sg = s[g];
+                    #pragma omp simd
+                    for (int j = g * packed_group_size; j < (g + 1) * packed_group_size; j++)
+                    {
+                        buffer[2 * j] = sg * (w[j] >> 4);
+                        buffer[2 * j + 1] = sg * ((int8_t)((uint8_t)w[j] << 4) >> 4);
+                    }
+                }
+            }
+            else
+            {
+                for (int g = 0; g < groups; g++)
+                {
+                    float sg = s[g];
+                    #pragma omp simd
+                    for (int j = g * group_size; j < (g + 1) * group_size; j++)
+                        buffer[j] = sg * w[j];
+                }
+            }
+            for (int b = 0; b < batch; b++)
+            {
+                const float *x = inp + (int64_t)b * k;
+                float acc = 0.f;
+                #pragma omp simd reduction(+:acc)
+                for (int j = 0; j < k; j++)
+                    acc += x[j] * buffer[j];
+                out[(int64_t)b * n + i] = acc;
+            }
+        }
+        free(buffer);
+    }
+}
+
+/* out[b][i] = sum_j inp[b][j] * scale[i][j / group_size] * weight[i][j], group_size = k for one scale per row */
+void gemm_int8_float(const float *inp, const int8_t *weight, const float *scale, float *out, int batch, int n, int k,
+                     int group_size)
+{
+    if (group_size == k)
+        gemm_int8_row_scale(inp, weight, scale, out, batch, n, k);
+    else
+        gemm_group_scale(inp, weight, scale, out, batch, n, k, group_size, 8);
+}
+
+void gemm_int4_float(const float *inp, const int8_t *weight, const float *scale, float *out, int batch, int n, int k,
+                     int group_size)
+{
+    if (group_size == k)
+        gemm_int4_row_scale(inp, weight, scale, out, batch, n, k);
+    else
+        gemm_group_scale(inp, weight, scale, out, batch, n, k, group_size, 4);
+}
+"""
+# named after the source, a kernel compiled from an older version is never loaded
+default_cpu_gemm_kernel_code_path = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "quantization_kernels_gemm_{}.c".format(hashlib.md5(default_cpu_gemm_kernel_code.encode()).hexdigest()[:8]),
+)
+# inputs with more rows (prefill) are faster with the dequantized weight and a BLAS matmul
+CPU_FUSED_GEMM_MAX_ROWS = 16
+
 cpu_kernels = None
 
 
@@ -178,6 +353,31 @@ class CPUKernel:
             self.SetNumThreads(parallel_num)
         
         self.parallel_num = parallel_num
+        self.int8GemmFloat = None
+        self.int4GemmFloat = None
+        self.load_gemm_kernel(parallel_num)
+
+    def load_gemm_kernel(self, parallel_num=None):
+        """Compiles and loads the fused int8/int4 gemm, the dequantizing kernels are used if it fails."""
+        source_code = default_cpu_gemm_kernel_code_path
+        kernel_file = source_code[:-2] + ".so"
+        try:
+            if not os.path.exists(kernel_file):
+                with open(source_code, "w", encoding="utf-8") as file:
+                    file.write(default_cpu_gemm_kernel_code)
+                for flags in ("-O3 -march=native", "-O3"):
+                    compile_command = "gcc {} -fPIC -fopenmp -std=c99 {} -shared -o {}".format(flags, source_code, kernel_file)
+                    print("Compiling", compile_command)
+                    if not os.system(compile_command):
+                        break
+            kernels = ctypes.cdll.LoadLibrary(kernel_file)
+        except Exception:
+            print("Failed to load the fused gemm kernel, dequantizing the weights instead.")
+            return
+        self.int8GemmFloat = kernels.gemm_int8_float
+        self.int4GemmFloat = kernels.gemm_int4_float
+        if parallel_num is not None:
+            kernels.set_num_threads(parallel_num)
 
 
 def compress_int4_weight(weight: torch.Tensor):  # (n, m)
@@ -187,7 +387,8 @@ def compress_int4_weight(weight: torch.Tensor):  # (n, m)
         n, m = weight.size(0), weight.size(1)
         assert m % 2 == 0
         m = m // 2
-        out = torch.empty(n, m, dtype=torch.int8, device="cpu")
+        # the kernel ORs the nibbles into the output
+        out = torch.zeros(n, m, dtype=torch.int8, device="cpu")
         cpu_kernels.int4WeightCompression(
             ctypes.c_void_p(weight.data_ptr()),
             ctypes.c_void_p(out.data_ptr()),
@@ -216,7 +417,54 @@ def compress_int4_weight(weight: torch.Tensor):  # (n, m)
             return out
 
 
+def get_group_size(scale_list: torch.Tensor, in_features: int) -> int:
+    """Input channels per scale, scales are [n] (one per row) or [n, in_features // group_size]"""
+    if scale_list.dim() == 1:
+        return in_features
+    return in_features // scale_list.size(1)
+
+
+def use_fused_gemm(inp: torch.Tensor, scale_list: torch.Tensor) -> bool:
+    return (
+        cpu_kernels is not None
+        and cpu_kernels.int8GemmFloat is not None
+        and inp.size(0) <= CPU_FUSED_GEMM_MAX_ROWS
+        and inp.dtype == torch.float
+        and scale_list.dtype == torch.float
+    )
+
+
+def fused_gemm(inp: torch.Tensor, weight: torch.Tensor, scale_list: torch.Tensor, source_bit_width: int):
+    """inp @ dequantized(weight).t() on cpu without materializing the float weight, inp: [b, k] float32"""
+    if source_bit_width == 8:
+        func = cpu_kernels.int8GemmFloat
+    elif source_bit_width == 4:
+        func = cpu_kernels.int4GemmFloat
+    else:
+        assert False, "Unsupported bit-width"
+
+    batch, k = inp.size(0), inp.size(1)
+    n = weight.size(0)
+    out = torch.empty(batch, n, dtype=torch.float, device="cpu")
+    func(
+        ctypes.c_void_p(inp.data_ptr()),
+        ctypes.c_void_p(weight.data_ptr()),
+        ctypes.c_void_p(scale_list.data_ptr()),
+        ctypes.c_void_p(out.data_ptr()),
+        ctypes.c_int32(batch),
+        ctypes.c_int32(n),
+        ctypes.c_int32(k),
+        ctypes.c_int32(get_group_size(scale_list, k))
+    )
+    return out
+
+
 def extract_weight_to_half(weight: torch.Tensor, scale_list: torch.Tensor, source_bit_width: int):
+    group_scale_list = None
+    if scale_list.dim() == 2:
+        # the kernels scale whole rows, the group scales are applied to the output
+        group_scale_list = scale_list
+        scale_list = torch.ones(weight.size(0), dtype=torch.half, device=weight.device)
     if source_bit_width == 8:
         func = kernels.int8WeightExtractionHalf
     elif source_bit_width == 4:
@@ -245,11 +493,18 @@ def extract_weight_to_half(weight: torch.Tensor, scale_list: torch.Tensor, sourc
                 ctypes.c_int32(m),
             ],
         )
+        if group_scale_list is not None:
+            out.view(n, group_scale_list.size(1), -1).mul_(group_scale_list[:, :, None])
         return out
 
 
 def extract_weight_to_float(weight: torch.Tensor, scale_list: torch.Tensor, source_bit_width: int, quantization_cache=None):
     """extract weight on cpu to float32"""
+    group_scale_list = None
+    if scale_list.dim() == 2:
+        # the kernels scale whole rows, the group scales are applied to the output
+        group_scale_list = scale_list
+        scale_list = torch.ones(weight.size(0), dtype=torch.float, device="cpu")
     if source_bit_width == 8:
         func = cpu_kernels.int8WeightExtractionFloat
     elif source_bit_width == 4:
@@ -268,7 +523,7 @@ def extract_weight_to_float(weight: torch.Tensor, scale_list: torch.Tensor, sour
             ctypes.c_int32(n),
             ctypes.c_int32(m)
         )
-        return out.tensor
+        out = out.tensor
     else:
         out = torch.empty(n, m * (8 // source_bit_width), dtype=torch.float, device="cpu")
         func(
@@ -278,7 +533,9 @@ def extract_weight_to_float(weight: torch.Tensor, scale_list: torch.Tensor, sour
             ctypes.c_int32(n),
             ctypes.c_int32(m)
         )
-        return out
+    if group_scale_list is not None:
+        out.view(n, group_scale_list.size(1), -1).mul_(group_scale_list[:, :, None])
+    return out
 
 
 class CacheTensor():
@@ -292,11 +549,125 @@ class CacheTensor():
         return self.tensor.data_ptr()
 
 
+class DequantizedWeightCache:
+    """
+    Float weights of the quantized linears of a model on cpu, within `max_memory` bytes.
+
+    Linears are registered in execution order. The layers whose float weights fit in the budget keep them resident
+    after their first use, every layer runs once per forward so the first ones are as hot as any. The weights of the
+    other layers are dequantized on the fly: with `prefetch`, a background thread dequantizes the next of them while
+    the current linear computes, the extraction kernels and matmuls release the GIL.
+    """
+
+    def __init__(self, max_memory: int, prefetch: bool = True):
+        self.max_memory = max_memory
+        self.prefetch = prefetch
+        self.linears = []
+        self.resident_indices = set()
+        self.resident = {}  # index -> float weight
+        self.pending = {}  # index -> future of the float weight
+        self.memory = 0
+        self._executor = None
+        self.hits = 0
+        self.prefetched = 0
+        self.misses = 0
+
+    def add_layer(self, linears) -> List["CachedWeight"]:
+        """Registers the quantized linears of one layer, resident if all of them fit in the remaining budget"""
+        sizes = [linear.out_features * linear.in_features * 4 for linear in linears]
+        resident = len(self.resident_indices) == len(self.linears) and self.memory + sum(sizes) <= self.max_memory
+        handles = []
+        for linear, size in zip(linears, sizes):
+            index = len(self.linears)
+            self.linears.append(linear)
+            if resident:
+                self.resident_indices.add(index)
+                self.memory += size
+            handles.append(CachedWeight(self, index))
+        return handles
+
+    @property
+    def num_resident_linears(self):
+        return len(self.resident_indices)
+
+    def _dequantize(self, index):
+        linear = self.linears[index]
+        return extract_weight_to_float(linear.weight, linear.weight_scale, linear.weight_bit_width)
+
+    def _prefetch_after(self, index):
+        if not self.prefetch or len(self.resident_indices) == len(self.linears):
+            return
+        # the next linear to dequantize, the last one of a forward prefetches the first one of the next forward
+        next_index = (index + 1) % len(self.linears)
+        while next_index in self.resident_indices:
+            next_index = (next_index + 1) % len(self.linears)
+        if next_index != index and next_index not in self.pending:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dequantize")
+            self.pending[next_index] = self._executor.submit(self._dequantize, next_index)
+
+    def get(self, index) -> torch.Tensor:
+        weight = self.resident.get(index)
+        if weight is not None:
+            self.hits += 1
+        else:
+            future = self.pending.pop(index, None)
+            if future is not None:
+                weight = future.result()
+                self.prefetched += 1
+            else:
+                weight = self._dequantize(index)
+                self.misses += 1
+            if index in self.resident_indices:
+                self.resident[index] = weight
+        self._prefetch_after(index)
+        return weight
+
+    def clear(self):
+        """Drops the float weights, e.g. after the quantized weights moved"""
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+        self.resident.clear()
+
+    def get_stats(self):
+        return {
+            "resident_linears": self.num_resident_linears,
+            "linears": len(self.linears),
+            "resident_memory": sum(weight.numel() * weight.element_size() for weight in self.resident.values()),
+            "hits": self.hits,
+            "prefetched": self.prefetched,
+            "misses": self.misses,
+        }
+
+
+class CachedWeight:
+    """Handle of one linear in a `DequantizedWeightCache`, used as its `quantization_cache`"""
+
+    def __init__(self, cache: DequantizedWeightCache, index: int):
+        self.cache = cache
+        self.index = index
+
+    def get(self) -> torch.Tensor:
+        return self.cache.get(self.index)
+
+    def to(self, *args, **kwargs):
+        self.cache.clear()
+
+
 class QuantizedLinear(Linear):
-    def __init__(self, weight_bit_width: int, weight_tensor=None, bias_tensor=None, quantized_weight=None, quantized_weight_scale=None, quantization_cache=None, empty_init=False, *args, **kwargs):
+    """
+    Linear layer with int8/int4 weights. With `group_size` every `group_size` input channels of a row have their
+    own scale, `weight_scale` is [out_features, in_features // group_size], else it is one scale per row.
+    An activation-aware `input_scale` [in_features] divides the input, the weight was multiplied by it before rounding.
+    """
+
+    def __init__(self, weight_bit_width: int, weight_tensor=None, bias_tensor=None, quantized_weight=None, quantized_weight_scale=None, quantization_cache=None, empty_init=False, group_size=0, *args, **kwargs):
         super(QuantizedLinear, self).__init__(*args, **kwargs)
         self.weight_bit_width = weight_bit_width
         self.quantization_cache = quantization_cache
+        self.group_size = group_size
+        self.register_parameter("input_scale", None)
 
         if (quantized_weight is not None) and (quantized_weight_scale is not None):
             del self.weight
@@ -306,11 +677,22 @@ class QuantizedLinear(Linear):
             shape = self.weight.shape
             del self.weight
 
+            if group_size and (shape[1] % group_size or group_size % 2):
+                raise ValueError(f"group_size {group_size} must be even and divide in_features {shape[1]}.")
             if weight_tensor is None or empty_init:
                 self.weight = torch.empty(
                     shape[0], shape[1] * weight_bit_width // 8, dtype=torch.int8, device=kwargs["device"]
                 )
-                self.weight_scale = torch.empty(shape[0], dtype=kwargs["dtype"], device=kwargs["device"])
+                scale_shape = (shape[0], shape[1] // group_size) if group_size else (shape[0],)
+                self.weight_scale = torch.empty(scale_shape, dtype=kwargs["dtype"], device=kwargs["device"])
+            elif group_size:
+                groups = weight_tensor.reshape(shape[0], shape[1] // group_size, group_size)
+                self.weight_scale = (groups.abs().max(dim=-1).values / ((2 ** (weight_bit_width - 1)) - 1)).to(kwargs["dtype"])
+                # an all-zero group has scale 0, clamp like fake_quantize_weight so it rounds to 0, not NaN
+                scale = self.weight_scale.float().clamp(min=1e-10)
+                self.weight = torch.round(groups.float() / scale[:, :, None]).reshape(shape).to(torch.int8)
+                if weight_bit_width == 4:
+                    self.weight = compress_int4_weight(self.weight)
             else:
                 self.weight_scale = (weight_tensor.abs().max(dim=-1).values / ((2 ** (weight_bit_width - 1)) - 1)).to(kwargs["dtype"])
                 self.weight = torch.round(weight_tensor / self.weight_scale[:, None]).to(torch.int8)
@@ -330,6 +712,8 @@ class QuantizedLinear(Linear):
         pass
 
     def forward(self, input):
+        if self.input_scale is not None:
+            input = input / self.input_scale.to(input.dtype)
         if self.weight.device == torch.device("cpu"):
             output = W8A16LinearCPU.apply(input, self.weight, self.weight_scale, self.weight_bit_width, self.quantization_cache)
         else:
@@ -338,6 +722,16 @@ class QuantizedLinear(Linear):
             output = output + self.bias
         return output
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        key = prefix + "input_scale"
+        if key in state_dict and self.input_scale is None:
+            # calibrated checkpoints are loaded into layers created without input scales
+            self.input_scale = Parameter(
+                torch.empty_like(state_dict[key], dtype=self.weight_scale.dtype, device=self.weight.device),
+                requires_grad=False,
+            )
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def _apply(self, fn):
         self_obj = super()._apply(fn)
         if self.quantization_cache is not None:
@@ -391,8 +785,12 @@ def load_cpu_kernel(**kwargs):
     assert cpu_kernels.load
 
 
-def quantize(model, weight_bit_width, use_quantization_cache=False, empty_init=False, **kwargs):
-    """Replace fp16 linear with quantized linear"""
+def quantize(model, weight_bit_width, use_quantization_cache=False, empty_init=False, group_size=0, input_scales=None,
+             **kwargs):
+    """
+    Replace fp16 linear with quantized linear, `group_size` input channels share a scale, 0 for a scale per row.
+    `input_scales` from `get_activation_aware_scales`, keyed by linear name, e.g. `layers.0.attention.dense`.
+    """
     
     query_key_value_quantization_cache = None
     dense_quantization_cache = None
@@ -419,7 +817,8 @@ def quantize(model, weight_bit_width, use_quantization_cache=False, empty_init=F
         weight_bit_width=weight_bit_width,
         bias=True,
         dtype=dtype,
-        empty_init=empty_init
+        empty_init=empty_init,
+        group_size=group_size,
     )
 
     if use_quantization_cache:
@@ -440,37 +839,162 @@ def quantize(model, weight_bit_width, use_quantization_cache=False, empty_init=F
 
     print("Applying quantization to glm layers")
 
-    for layer in model.layers:
-        layer.attention.query_key_value = QuantizedLinearWithPara(
-            weight_tensor=layer.attention.query_key_value.weight.to(current_device),
-            bias_tensor=layer.attention.query_key_value.bias,
-            in_features=layer.attention.query_key_value.in_features,
-            out_features=layer.attention.query_key_value.out_features,
-            device=layer.attention.query_key_value.weight.device,
-            quantization_cache=query_key_value_quantization_cache
+    def quantize_linear(linear, name, quantization_cache):
+        weight_tensor = linear.weight.to(current_device)
+        input_scale = input_scales.get(name) if input_scales else None
+        if input_scale is not None:
+            # salient input channels are scaled up before rounding, the layer divides its input back
+            weight_tensor = weight_tensor * input_scale.to(weight_tensor)[None, :]
+        quantized_linear = QuantizedLinearWithPara(
+            weight_tensor=weight_tensor,
+            bias_tensor=linear.bias,
+            in_features=linear.in_features,
+            out_features=linear.out_features,
+            device=linear.weight.device,
+            quantization_cache=quantization_cache
+        )
+        if input_scale is not None:
+            quantized_linear.input_scale = Parameter(
+                input_scale.to(device=linear.weight.device, dtype=dtype), requires_grad=False
+            )
+        return quantized_linear
+
+    for i, layer in enumerate(model.layers):
+        layer.attention.query_key_value = quantize_linear(
+            layer.attention.query_key_value, f"layers.{i}.attention.query_key_value",
+            query_key_value_quantization_cache
         )
-        layer.attention.dense = QuantizedLinearWithPara(
-            weight_tensor=layer.attention.dense.weight.to(current_device),
-            bias_tensor=layer.attention.dense.bias,
-            in_features=layer.attention.dense.in_features,
-            out_features=layer.attention.dense.out_features,
-            device=layer.attention.dense.weight.device,
-            quantization_cache=dense_quantization_cache
+        layer.attention.dense = quantize_linear(
+            layer.attention.dense, f"layers.{i}.attention.dense", dense_quantization_cache
         )
-        layer.mlp.dense_h_to_4h = QuantizedLinearWithPara(
-            weight_tensor=layer.mlp.dense_h_to_4h.weight.to(current_device),
-            bias_tensor=layer.mlp.dense_h_to_4h.bias,
-            in_features=layer.mlp.dense_h_to_4h.in_features,
-            out_features=layer.mlp.dense_h_to_4h.out_features,
-            device=layer.mlp.dense_h_to_4h.weight.device,
-            quantization_cache=dense_h_to_4h_quantization_cache
+        layer.mlp.dense_h_to_4h = quantize_linear(
+            layer.mlp.dense_h_to_4h, f"layers.{i}.mlp.dense_h_to_4h", dense_h_to_4h_quantization_cache
         )
-        layer.mlp.dense_4h_to_h = QuantizedLinearWithPara(
-            weight_tensor=layer.mlp.dense_4h_to_h.weight.to(current_device),
-            bias_tensor=layer.mlp.dense_4h_to_h.bias,
-            in_features=layer.mlp.dense_4h_to_h.in_features,
-            out_features=layer.mlp.dense_4h_to_h.out_features,
-            device=layer.mlp.dense_4h_to_h.weight.device,
-            quantization_cache=dense_4h_to_h_quantization_cache
+        layer.mlp.dense_4h_to_h = quantize_linear(
+            layer.mlp.dense_4h_to_h, f"layers.{i}.mlp.dense_4h_to_h", dense_4h_to_h_quantization_cache
         )
     return model
+
+
+QUANTIZED_LINEAR_NAMES = ("attention.query_key_value", "attention.dense", "mlp.dense_h_to_4h", "mlp.dense_4h_to_h")
+
+
+class _StopForward(Exception):
+    pass
+
+
+def fake_quantize_weight(weight: torch.Tensor, weight_bit_width: int, group_size=0):
+    """Float weight rounded to `weight_bit_width` bits the way `QuantizedLinear` does it"""
+    n, k = weight.shape
+    groups = weight.float().reshape(n, k // group_size if group_size else 1, -1)
+    scale = groups.abs().amax(dim=-1, keepdim=True) / ((2 ** (weight_bit_width - 1)) - 1)
+    scale = scale.clamp(min=1e-10)
+    return (torch.round(groups / scale) * scale).reshape(n, k)
+
+
+def search_input_scale(weight: torch.Tensor, inputs: torch.Tensor, activation_scale: torch.Tensor,
+                       weight_bit_width: int, group_size=0, grid_size=20):
+    """
+    Activation-aware scale of one linear: `s = activation_scale ** alpha` for the alpha on a grid over [0, 1)
+    minimizing `|| x W^T - (x / s) Q(W * s)^T ||` on the sampled `inputs` [rows, in_features].
+    Returns None when plain rounding (alpha 0) is best.
+    """
+    weight = weight.float()
+    inputs = inputs.float()
+    expected = inputs @ weight.t()
+    best_error, best_scale = float("inf"), None
+    for step in range(grid_size):
+        alpha = step / grid_size
+        scale = activation_scale.float().pow(alpha).clamp(min=1e-4)
+        scale = scale / (scale.max() * scale.min()).sqrt()
+        quantized_weight = fake_quantize_weight(weight * scale[None, :], weight_bit_width, group_size)
+        error = float((expected - (inputs / scale) @ quantized_weight.t()).pow(2).mean())
+        if error < best_error:
+            best_error, best_scale = error, (scale if step else None)
+    return best_scale
+
+
+@torch.no_grad()
+def get_activation_aware_scales(model, batches, weight_bit_width, group_size=0, grid_size=20, max_rows=512):
+    """
+    Activation-aware input scales of the quantized linears of every layer (AWQ style), to pass to `quantize`.
+
+    The calibration `batches` (model inputs) run through the float `model` once up to the first layer, then
+    the captured hidden states go through one layer at a time, the output of a layer is the input of the next.
+    The mean absolute input of every channel marks the salient ones, scaling them up before rounding
+    keeps more of their precision. Up to `max_rows` input rows per linear are kept to search the scale.
+    """
+    batches = list(batches)
+    layers = model.transformer.layers
+    rows_per_batch = max(1, max_rows // max(1, len(batches)))
+    generator = torch.Generator().manual_seed(0)
+
+    # inputs of the first layer, the other arguments (masks, positions) are the same for every layer
+    layer_inputs = []
+
+    def capture(*args, **kwargs):
+        layer_inputs.append((args, kwargs))
+        raise _StopForward
+
+    # shadow the forward of the first layer instead of a pre hook, kwargs hooks need torch >= 2.0
+    layers[0].forward = capture
+    try:
+        for batch in batches:
+            try:
+                model(**batch)
+            except _StopForward:
+                pass
+    finally:
+        del layers[0].forward
+
+    input_scales = {}
+    for i, layer in enumerate(layers):
+        linears = {name: layer.get_submodule(name) for name in QUANTIZED_LINEAR_NAMES}
+        abs_sums = {name: 0 for name in linears}
+        counts = {name: 0 for name in linears}
+        samples = {name: [] for name in linears}
+
+        def record(name):
+            def hook(module, args):
+                x = args[0].reshape(-1, args[0].size(-1)).float()
+                abs_sums[name] = abs_sums[name] + x.abs().sum(dim=0)
+                counts[name] += x.size(0)
+                rows = torch.randperm(x.size(0), generator=generator)[:rows_per_batch]
+                samples[name].append(x[rows.to(x.device)])
+
+            return hook
+
+        handles = [linear.register_forward_pre_hook(record(name)) for name, linear in linears.items()]
+        try:
+            for j, (args, kwargs) in enumerate(layer_inputs):
+                kwargs = dict(kwargs, layer_id=i, layer_past=None, use_cache=False, output_attentions=False)
+                layer_inputs[j] = ((layer(*args, **kwargs)[0],) + tuple(args[1:]), kwargs)
+        finally:
+            for handle in handles:
+                handle.remove()
+
+        for name, linear in linears.items():
+            if not counts[name]:
+                continue
+            scale = search_input_scale(
+                linear.weight, torch.cat(samples[name]), abs_sums[name] / counts[name],
+                weight_bit_width, group_size=group_size, grid_size=grid_size,
+            )
+            if scale is not None:
+                input_scales[f"layers.{i}.{name}"] = scale.cpu()
+    return input_scales
+
+
+def set_dequantized_weight_cache(model, max_memory: int, prefetch: bool = True):
+    """
+    Gives the quantized linears of the glm layers of `model` (a ChatGLMModel) a `DequantizedWeightCache` of
+    `max_memory` bytes, in place of the buffers `use_quantization_cache` shares between layers.
+    """
+    cache = DequantizedWeightCache(max_memory, prefetch=prefetch)
+    for layer in model.layers:
+        linears = [layer.get_submodule(name) for name in QUANTIZED_LINEAR_NAMES]
+        if not all(isinstance(linear, QuantizedLinear) for linear in linears):
+            raise ValueError("The model is not quantized, call `quantize(bits)` first.")
+        for linear, handle in zip(linears, cache.add_layer(linears)):
+            linear.quantization_cache = handle
+    return cache
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description: Asyncio HTTP server for ChatGLMTune.
+
+Requests are queued and coalesced into micro-batches, every micro-batch runs through
+`ChatGLMTune.stream_predict` in a worker thread and the text deltas are streamed back.
+
+Endpoints:
+    POST /generate  {"prompt": str, "stream": bool, "session_id": str}
+    POST /chat      {"query": str, "history": [[query, response], ...], "stream": bool, "session_id": str}
+    GET  /metrics   queue depth, batch sizes and latency percentiles
+    GET  /health
+
+Streaming responses use chunked transfer encoding, one json object per line:
+{"delta": str} for every piece of text, then {"response": str, ...} when done.
+"""
+import asyncio
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+import numpy as np
+from loguru import logger
+
+HTTP_STATUS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+               500: "Internal Server Error"}
+
+
+class ServerRequest:
+    """A queued generation request, the worker thread pushes text deltas to `queue`, None when done."""
+
+    def __init__(self, prompt: str, session_id=None):
+        self.prompt = prompt
+        self.session_id = session_id
+        self.queue = asyncio.Queue()
+        self.arrival_time = time.perf_counter()
+        self.first_token_time = None
+        self.error = None
+
+
+class ChatGLMServer:
+    """
+    HTTP front-end with request coalescing for a `ChatGLMTune` model.
+
+    Args:
+        model: A ChatGLMTune model.
+        host: Address to listen on.
+        port: Port to listen on, 0 picks a free port.
+        max_batch_size: Largest micro-batch, defaults to `model.args.eval_batch_size`.
+        batch_wait_ms: How long the first request of a micro-batch waits for others to join it.
+        max_latency_samples: Number of recent requests the latency percentiles are computed over.
+    """
+
+    def __init__(
+            self,
+            model,
+            host: str = "0.0.0.0",
+            port: int = 8000,
+            max_batch_size: Optional[int] = None,
+            batch_wait_ms: float = 10,
+            max_latency_samples: int = 1000,
+    ):
+        self.model = model
+        self.host = host
+        self.port = port
+        self.max_batch_size = max_batch_size or model.args.eval_batch_size
+        self.batch_wait = batch_wait_ms / 1000
+        # the model runs in one thread, the event loop keeps accepting and streaming meanwhile
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+        self.server = None
+        self._batch_task = None
+        self.num_running = 0
+        self.num_requests = 0
+        self.num_batches = 0
+        self.num_batched_requests = 0
+        self.latencies = deque(maxlen=max_latency_samples)
+        self.first_token_latencies = deque(maxlen=max_latency_samples)
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self._batch_task = asyncio.ensure_future(self._batch_loop())
+        self.server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logger.info(f"Serving on http://{self.host}:{self.port}")
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        if self._batch_task is not None:
+            self._batch_task.cancel()
+            try:
+                await self._batch_task
+            except asyncio.CancelledError:
+                pass
+        self.executor.shutdown(wait=True)
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self.close()
+
+    def run(self):
+        asyncio.run(self.serve_forever())
+
+    def get_metrics(self):
+        def percentiles(values):
+            if not values:
+                return {"p50": None, "p90": None, "p99": None}
+            p50, p90, p99 = np.percentile(np.array(values), [50, 90, 99])
+            return {"p50": float(p50), "p90": float(p90), "p99": float(p99)}
+
+        return {
+            "queue_depth": self.queue.qsize() if self.queue is not None else 0,
+            "running": self.num_running,
+            "num_requests": self.num_requests,
+            "num_batches": self.num_batches,
+            "avg_batch_size": self.num_batched_requests / self.num_batches if self.num_batches else 0.0,
+            "latency_seconds": percentiles(self.latencies),
+            "first_token_latency_seconds": percentiles(self.first_token_latencies),
+        }
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.batch_wait
+            while len(batch) < self.max_batch_size:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            self.num_running = len(batch)
+            self.num_batches += 1
+            self.num_batched_requests += len(batch)
+            await loop.run_in_executor(self.executor, self._run_batch, batch, loop)
+            self.num_running = 0
+
+    def _run_batch(self, batch: List[ServerRequest], loop):
+        """Runs in the worker thread."""
+        session_ids = [req.session_id for req in batch]
+        try:
+            for deltas in self.model.stream_predict(
+                    [req.prompt for req in batch],
+                    session_ids=session_ids if any(s is not None for s in session_ids) else None,
+            ):
+                now = time.perf_counter()
+                for req, delta in zip(batch, deltas):
+                    if delta:
+                        if req.first_token_time is None:
+                            req.first_token_time = now
+                        loop.call_soon_threadsafe(req.queue.put_nowait, delta)
+        except Exception as e:
+            logger.exception("Generation failed")
+            for req in batch:
+                req.error = str(e)
+        for req in batch:
+            loop.call_soon_threadsafe(req.queue.put_nowait, None)
+
+    async def _submit(self, prompt: str, session_id=None):
+        """Queue a prompt, yields its text deltas."""
+        req = ServerRequest(prompt, session_id=session_id)
+        await self.queue.put(req)
+        while True:
+            delta = await req.queue.get()
+            if delta is None:
+                break
+            yield delta
+        if req.error is not None:
+            raise RuntimeError(req.error)
+        self.num_requests += 1
+        self.latencies.append(time.perf_counter() - req.arrival_time)
+        if req.first_token_time is not None:
+            self.first_token_latencies.append(req.first_token_time - req.arrival_time)
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            if not request_line:
+                return
+            method, path, _ = request_line.decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+            await self._dispatch(method, path.split("?", 1)[0], body, writer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            logger.exception("Request failed")
+            try:
+                await self._send_json(writer, {"error": str(e)}, status=500)
+            except ConnectionError:
+                pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method: str, path: str, body: bytes, writer: asyncio.StreamWriter):
+        if path == "/health":
+            return await self._send_json(writer, {"status": "ok"})
+        if path == "/metrics":
+            return await self._send_json(writer, self.get_metrics())
+        if path not in ("/generate", "/chat"):
+            return await self._send_json(writer, {"error": f"Unknown path {path}"}, status=404)
+        if method != "POST":
+            return await self._send_json(writer, {"error": "Use POST"}, status=405)
+        try:
+            data = json.loads(body or b"{}")
+        except ValueError:
+            return await self._send_json(writer, {"error": "Body is not valid json"}, status=400)
+
+        if path == "/chat":
+            if "query" not in data:
+                return await self._send_json(writer, {"error": "Missing `query`"}, status=400)
+            query = data["query"]
+            history = [tuple(turn) for turn in data.get("history") or []]
+            prompt = self.model.build_chat_prompt(query, history)
+        else:
+            if "prompt" not in data:
+                return await self._send_json(writer, {"error": "Missing `prompt`"}, status=400)
+            prompt = data["prompt"]
+        deltas = self._submit(prompt, session_id=data.get("session_id"))
+
+        def result(response):
+            if path == "/chat":
+                response = response.strip()
+                return {"response": response, "history": history + [(query, response)]}
+            return {"response": response}
+
+        if not data.get("stream", False):
+            response = "".join([delta async for delta in deltas])
+            return await self._send_json(writer, result(response))
+
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson; charset=utf-8\r\n"
+            b"Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n"
+        )
+        pieces = []
+        try:
+            async for delta in deltas:
+                pieces.append(delta)
+                await self._send_chunk(writer, {"delta": delta})
+        except RuntimeError as e:
+            await self._send_chunk(writer, {"error": str(e)})
+        else:
+            await self._send_chunk(writer, result("".join(pieces)))
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    @staticmethod
+    async def _send_chunk(writer: asyncio.StreamWriter, data):
+        line = (json.dumps(data, ensure_ascii=False) + "\n").encode("utf-8")
+        writer.write(b"%x\r\n%s\r\n" % (len(line), line))
+        await writer.drain()
+
+    @staticmethod
+    async def _send_json(writer: asyncio.StreamWriter, data, status: int = 200):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        writer.write(
+            f"HTTP/1.1 {status} {HTTP_STATUS[status]}\r\nContent-Type: application/json; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
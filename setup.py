@@ -28,7 +28,11 @@ setup(
     zip_safe=False,
     packages=find_packages(),
     include_package_data=True,
-    entry_points={},
+    entry_points={
+        "console_scripts": [
+            "lmft = lmft.cli:main",
+        ],
+    },
     python_requires=">=3.7.0",
     keywords='lmft,GPT2,transformers,pytorch,language model',
     install_requires=[
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description: shared test fixtures
+"""
+import copy
+import sys
+
+import pytest
+import torch
+from peft import get_peft_model, LoraConfig, TaskType
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, processors
+from transformers import PreTrainedTokenizerFast
+
+sys.path.append('..')
+from lmft.chatglm_model import ChatGLMTune, save_tunable_parameters
+from lmft.chatglm_utils import ChatGLMConfig, ChatGLMForConditionalGeneration
+
+
+def get_tiny_model():
+    config = ChatGLMConfig(hidden_size=64, num_layers=2, num_attention_heads=4, inner_hidden_size=256,
+                           max_sequence_length=512, use_cache=True)
+    torch.manual_seed(0)
+    model = ChatGLMForConditionalGeneration(config).float()
+    with torch.no_grad():
+        for name, param in model.named_parameters():
+            if 'layernorm' in name and name.endswith('weight'):
+                param.fill_(1.0)
+            else:
+                param.normal_(0, 0.05 if 'embeddings' in name or 'lm_head' in name else 0.3)
+    return model.eval()
+
+
+def get_prompt(length, seed):
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randint(5, 20000, (length,), generator=generator).tolist() + [150001, 150004]
+
+
+def get_char_tokenizer():
+    vocab = {"<unk>": 0, "<pad>": 3, "[gMASK]": 150001, "<sop>": 150004, "</s>": 150005}
+    vocab.update({c: i + 5 for i, c in enumerate("abcdefghijklmnopqrstuvwxyz ,.?!你好问答：[]0123456789\n")})
+    ids = set(vocab.values())
+    vocab.update({"<unused_{}>".format(i): i for i in range(150006) if i not in ids})
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Split("", "isolated")
+    tokenizer.post_processor = processors.TemplateProcessing(
+        single="$A [gMASK] <sop>", special_tokens=[("[gMASK]", 150001), ("<sop>", 150004)]
+    )
+    tokenizer.decoder = decoders.Fuse()
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, bos_token="<sop>", eos_token="</s>", pad_token="<pad>",
+                                   unk_token="<unk>",
+                                   additional_special_tokens=["[gMASK]", "<sop>"], padding_side="left",
+                                   model_input_names=["input_ids", "attention_mask"])
+
+
+def get_tiny_chatglm_tune(tmp_path):
+    get_tiny_model().save_pretrained(tmp_path)
+    get_char_tokenizer().save_pretrained(tmp_path)
+    return ChatGLMTune('chatglm', str(tmp_path), args={
+        'use_lora': False, 'max_length': 40, 'do_sample': False, 'eval_batch_size': 4, 'silent': True,
+    }, use_cuda=False)
+
+
+def save_random_adapter(model, path, rank, seed):
+    peft_config = LoraConfig(task_type=TaskType.CAUSAL_LM, inference_mode=False, r=rank, lora_alpha=32)
+    peft_model = get_peft_model(copy.deepcopy(model), peft_config)
+    torch.manual_seed(seed)
+    with torch.no_grad():
+        for name, param in peft_model.named_parameters():
+            if 'lora_' in name:
+                param.normal_(0, 0.1)
+    save_tunable_parameters(peft_model, path)
+    return peft_model.eval()
+
+
+@pytest.fixture
+def tiny_model():
+    """A 2 layer ChatGLM with random weights, in eval mode"""
+    return get_tiny_model()
+
+
+@pytest.fixture
+def make_prompt():
+    """`make_prompt(length, seed)`: `length` random token ids followed by [gMASK] and bos"""
+    return get_prompt
+
+
+@pytest.fixture
+def char_tokenizer():
+    """Word level tokenizer of single characters, prompts end with [gMASK] and <sop> like the ChatGLM tokenizer"""
+    return get_char_tokenizer()
+
+
+@pytest.fixture
+def tiny_chatglm_tune(tmp_path):
+    """`ChatGLMTune` of the tiny model and the char tokenizer saved in `tmp_path / 'base'`, greedy, on cpu"""
+    return get_tiny_chatglm_tune(tmp_path / 'base')
+
+
+@pytest.fixture(name="save_random_adapter")
+def save_random_adapter_fixture():
+    """`save_random_adapter(model, path, rank, seed)`: saves a random LoRA of `model`, returns its peft model"""
+    return save_random_adapter
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description:
+"""
+import math
+import sys
+
+import pandas as pd
+import torch
+
+sys.path.append('..')
+from lmft.chatglm_utils import ChatGLMForConditionalGeneration
+from lmft.quantization import QuantizedLinear, fake_quantize_weight, load_cpu_kernel, search_input_scale
+
+
+def test_input_scale_reduces_int4_error():
+    generator = torch.Generator().manual_seed(0)
+    weight = torch.randn(64, 128, generator=generator)
+    inputs = torch.randn(256, 128, generator=generator)
+    # a few salient channels with large activations, as after the layer norms of real models
+    inputs[:, :4] *= 30
+    activation_scale = inputs.abs().mean(dim=0)
+    expected = inputs @ weight.t()
+    plain_error = (expected - inputs @ fake_quantize_weight(weight, 4).t()).pow(2).mean()
+
+    load_cpu_kernel()
+    scale = search_input_scale(weight, inputs, activation_scale, 4)
+    assert scale is not None
+    layer = QuantizedLinear(4, weight * scale, None, in_features=128, out_features=64, bias=False,
+                            dtype=torch.float, device='cpu')
+    layer.input_scale = torch.nn.Parameter(scale, requires_grad=False)
+    with torch.no_grad():
+        calibrated_error = (expected - layer(inputs)).pow(2).mean()
+    assert calibrated_error < plain_error * 0.8
+
+
+def test_calibrated_quantization(tmp_path, make_prompt, tiny_chatglm_tune):
+    m = tiny_chatglm_tune
+    m.args.no_cache = True
+    data = pd.DataFrame({
+        'instruction': ['hello', 'how are you?', '你好', 'abc', 'what is 1 2 3?'],
+        'input': ['', '', '', 'def', ''],
+        'output': ['hi there.', 'fine, thanks!', '你好', 'ghi jkl', '4 5 6'],
+    })
+    results = m.quantize(4, group_size=32, calibration_data=data)
+    assert set(results) == {'perplexity', 'quantized_perplexity', 'perplexity_delta'}
+    assert math.isfinite(results['quantized_perplexity'])
+    layer = m.model.transformer.layers[0].mlp.dense_4h_to_h
+    assert layer.input_scale is not None
+
+    # the input scales are saved with the quantized weights and loaded into empty layers
+    m.model.save_quantized(str(tmp_path / 'int4'))
+    loaded = ChatGLMForConditionalGeneration.from_quantized(str(tmp_path / 'int4')).float()
+    input_ids = torch.tensor([make_prompt(6, seed=0)])
+    with torch.no_grad():
+        assert torch.equal(loaded(input_ids=input_ids).logits, m.model(input_ids=input_ids).logits)
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description:
+"""
+import sys
+
+import torch
+
+sys.path.append('..')
+from lmft.chatglm_model import ChatGLMTune
+
+
+def set_attention_implementation(model, implementation, chunk_size=512):
+    for layer in model.transformer.layers:
+        layer.attention.attention_implementation = implementation
+        layer.attention.attention_chunk_size = chunk_size
+
+
+def test_attention_implementations_match_eager(tiny_model, make_prompt):
+    model = tiny_model
+    prompts = [make_prompt(length, seed=length) for length in (30, 12)]
+    max_len = max(len(prompt) for prompt in prompts)
+    input_ids = torch.tensor([[3] * (max_len - len(prompt)) + prompt for prompt in prompts])
+    attention_mask, position_ids, _ = ChatGLMTune.get_batch_masks_and_position_ids(input_ids, 150004)
+    expected = model(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids).logits
+    for implementation in ("sdpa", "chunked"):
+        set_attention_implementation(model, implementation, chunk_size=7)
+        outputs = model(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids)
+        assert torch.allclose(outputs.logits, expected, atol=1e-4)
+        assert outputs.attentions is None
+        set_attention_implementation(model, "eager")
+
+
+def test_sdpa_generate_matches_eager(tiny_model, make_prompt):
+    model = tiny_model
+    prompts = [make_prompt(length, seed=length) for length in (3, 10)]
+    longest = max(len(prompt) for prompt in prompts)
+    input_ids = torch.tensor([[0] * (longest - len(prompt)) + prompt for prompt in prompts])
+    attention_mask = torch.tensor([[0] * (longest - len(prompt)) + [1] * len(prompt) for prompt in prompts])
+    # left padded rows decode with a padding mask, a single row with the unmasked [1, 1] mask
+    for kwargs in ({"input_ids": input_ids, "attention_mask": attention_mask}, {"input_ids": input_ids[1:]}):
+        expected = model.generate(**kwargs, max_new_tokens=8, do_sample=False)
+        set_attention_implementation(model, "sdpa")
+        outputs = model.generate(**kwargs, max_new_tokens=8, do_sample=False)
+        set_attention_implementation(model, "eager")
+        assert torch.equal(outputs, expected)
+
+
+def test_chunked_attention_gradients_match_eager(tiny_model, make_prompt):
+    model = tiny_model.train()
+    input_ids = torch.tensor([make_prompt(20, seed=0)])
+    grads = {}
+    for implementation in ("eager", "chunked"):
+        set_attention_implementation(model, implementation, chunk_size=6)
+        model.zero_grad()
+        model(input_ids=input_ids, labels=input_ids).loss.backward()
+        grads[implementation] = model.transformer.layers[0].attention.query_key_value.weight.grad.clone()
+    set_attention_implementation(model, "eager")
+    assert torch.allclose(grads["chunked"], grads["eager"], atol=1e-4)
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description:
+"""
+import sys
+
+import torch
+from transformers import BatchEncoding
+
+sys.path.append('..')
+from lmft.chatglm_cache import Int8PagedKVCache, PagedKVCache, PrefixCache
+from lmft.chatglm_engine import ContinuousBatchingEngine
+
+
+class CharTokenizer:
+    """One id per character, prompts end with [gMASK] and bos like the ChatGLM tokenizer."""
+
+    def __call__(self, text, return_tensors=None, padding=False):
+        texts = [text] if isinstance(text, str) else text
+        input_ids = [[5 + ord(c) % 20000 for c in t] + [150001, 150004] for t in texts]
+        input_ids = input_ids[0] if isinstance(text, str) else input_ids
+        return BatchEncoding({"input_ids": input_ids}, tensor_type=return_tensors)
+
+    def decode(self, ids):
+        return "".join(chr(0x4e00 + i % 20000) for i in ids if i < 150000)
+
+
+def test_continuous_batching_matches_generate(tiny_model, make_prompt):
+    model = tiny_model
+    prompts = [make_prompt(length, seed=length) for length in (3, 9, 5, 12, 4)]
+    expected = []
+    for prompt in prompts:
+        outputs = model.generate(input_ids=torch.tensor([prompt]), max_length=len(prompt) + 8, do_sample=False)
+        expected.append(outputs[0, len(prompt):].tolist())
+
+    engine = ContinuousBatchingEngine(model, max_batch_size=2, max_new_tokens=8, do_sample=False)
+    assert engine.generate(prompts) == expected
+    assert not engine.has_unfinished_requests()
+
+
+def test_paged_kv_cache_matches_generate(tiny_model, make_prompt):
+    model = tiny_model
+    prompt = make_prompt(7, seed=3)
+    input_ids = torch.tensor([prompt])
+    expected = model.generate(input_ids=input_ids, max_length=len(prompt) + 12, do_sample=False, num_beams=2)
+    kv_cache = PagedKVCache.from_config(model.config, batch_size=2, max_length=64, block_size=4)
+    outputs = model.generate(input_ids=input_ids, max_length=len(prompt) + 12, do_sample=False, num_beams=2,
+                             past_key_values=kv_cache)
+    assert torch.equal(outputs, expected)
+
+
+def test_paged_kv_cache_reorder_shares_blocks(tiny_model, make_prompt):
+    model = tiny_model
+    prompts = torch.tensor([make_prompt(9, seed=1), make_prompt(9, seed=2)])
+    kv_cache = PagedKVCache.from_config(model.config, batch_size=2, max_length=32, block_size=4)
+    with torch.no_grad():
+        model(**model.prepare_inputs_for_generation(prompts, past_key_values=kv_cache))
+        past_key_values = model(**model.prepare_inputs_for_generation(prompts), use_cache=True).past_key_values
+    key_pool = kv_cache.key_pool.clone()
+    num_free_blocks = len(kv_cache.free_blocks)
+    # both beams continue the first row: the block tables are swapped, no key/value is copied
+    kv_cache.reorder_cache(torch.tensor([0, 0]))
+    assert kv_cache.block_tables[0] == kv_cache.block_tables[1]
+    assert len(kv_cache.free_blocks) == num_free_blocks + 3
+    assert torch.equal(kv_cache.key_pool, key_pool)
+    # the shared, partially filled last block is copied before the second row writes to it
+    next_ids = torch.cat((prompts[[0, 0]], torch.tensor([[5], [6]])), dim=1)
+    with torch.no_grad():
+        outputs = model(**model.prepare_inputs_for_generation(next_ids, past_key_values=kv_cache))
+        past_key_values = model._reorder_cache(past_key_values, torch.tensor([0, 0]))
+        inputs = model.prepare_inputs_for_generation(next_ids, past_key_values=past_key_values)
+        expected = model(**inputs).logits[:, -1]
+    assert kv_cache.block_tables[0][:2] == kv_cache.block_tables[1][:2]
+    assert kv_cache.block_tables[0][2] != kv_cache.block_tables[1][2]
+    assert torch.allclose(outputs.logits[:, -1], expected, atol=1e-4)
+
+
+def test_int8_kv_cache(tiny_model, make_prompt):
+    model = tiny_model
+    prompt = make_prompt(7, seed=3)
+    input_ids = torch.tensor([prompt])
+    expected = model(input_ids=input_ids, use_cache=True)
+    kv_cache = Int8PagedKVCache.from_config(model.config, batch_size=1, max_length=64, block_size=4)
+    outputs = model(input_ids=input_ids, past_key_values=kv_cache)
+    assert kv_cache.key_pool.dtype == torch.int8
+    assert torch.allclose(outputs.logits, expected.logits, atol=5e-2)
+    # the decode step reads the keys/values of the prompt back from int8
+    next_input_ids = torch.cat((input_ids, outputs.logits[:, -1:].argmax(-1)), dim=1)
+    inputs = model.prepare_inputs_for_generation(next_input_ids, past_key_values=expected.past_key_values)
+    expected = model(**inputs)
+    inputs = model.prepare_inputs_for_generation(next_input_ids, past_key_values=kv_cache)
+    assert torch.allclose(model(**inputs).logits, expected.logits, atol=5e-2)
+
+    # beam search reorders the int8 values and their scales
+    expected = model.generate(input_ids=input_ids, max_length=len(prompt) + 12, do_sample=False, num_beams=2)
+    kv_cache = Int8PagedKVCache.from_config(model.config, batch_size=2, max_length=64, block_size=4)
+    outputs = model.generate(input_ids=input_ids, max_length=len(prompt) + 12, do_sample=False, num_beams=2,
+                             past_key_values=kv_cache)
+    assert torch.equal(outputs, expected)
+
+
+def test_continuous_batching_with_paged_kv_cache(tiny_model, make_prompt):
+    model = tiny_model
+    prompts = [make_prompt(length, seed=length) for length in (3, 9, 5, 12, 4)]
+    engine = ContinuousBatchingEngine(model, max_batch_size=2, max_new_tokens=8, do_sample=False)
+    expected = engine.generate(prompts)
+
+    kv_cache = PagedKVCache.from_config(model.config, batch_size=2, max_length=32, block_size=4)
+    engine = ContinuousBatchingEngine(model, max_batch_size=2, max_new_tokens=8, do_sample=False, kv_cache=kv_cache)
+    assert engine.generate(prompts) == expected
+    assert len(kv_cache.free_blocks) == kv_cache.num_blocks - 1
+
+
+def test_batched_generate_per_row_positions(tiny_model, make_prompt):
+    model = tiny_model
+    prompts = [make_prompt(8, seed=1), make_prompt(8, seed=2), make_prompt(7, seed=3) + [77]]
+    prompts[1][2] = 150000  # [MASK] inside the prompt
+    batch = model.generate(input_ids=torch.tensor(prompts), max_length=20, do_sample=False)
+    for prompt, outputs in zip(prompts, batch):
+        expected = model.generate(input_ids=torch.tensor([prompt]), max_length=20, do_sample=False)
+        assert torch.equal(outputs, expected[0])
+
+
+def test_left_padded_batched_generate(tiny_model, make_prompt):
+    model = tiny_model
+    prompts = [make_prompt(length, seed=length) for length in (3, 10, 6)]
+    prompts[2][1] = 150000
+    longest = max(len(prompt) for prompt in prompts)
+    input_ids = torch.tensor([[0] * (longest - len(prompt)) + prompt for prompt in prompts])
+    attention_mask = (torch.arange(longest)[None, :] >= longest - torch.tensor([len(p) for p in prompts])[:, None])
+    for num_beams in (1, 2):
+        batch = model.generate(input_ids=input_ids, attention_mask=attention_mask.long(), max_new_tokens=10,
+                               do_sample=False, num_beams=num_beams)
+        for prompt, outputs in zip(prompts, batch):
+            expected = model.generate(input_ids=torch.tensor([prompt]), max_new_tokens=10, do_sample=False,
+                                      num_beams=num_beams)
+            assert outputs[longest:].tolist() == expected[0, len(prompt):].tolist()
+
+
+def test_chat_prefix_cache_matches_uncached(tiny_model):
+    model = tiny_model
+    tokenizer = CharTokenizer()
+    prefix_cache = PrefixCache()
+    history, cached_history = [], []
+    for query in ("你好", "今天天气怎么样", "谢谢"):
+        response, history = model.chat(tokenizer, query, history, max_new_tokens=12, do_sample=False)
+        cached_response, cached_history = model.chat(tokenizer, query, cached_history, max_new_tokens=12,
+                                                     do_sample=False, prefix_cache=prefix_cache, session_id=0)
+        assert cached_response == response
+        assert cached_history == history
+    # asking the last round again keeps the context, everything but the bos token is reused
+    response, _ = model.chat(tokenizer, "谢谢", history[:-1], max_new_tokens=12, do_sample=False,
+                             prefix_cache=prefix_cache, session_id=0)
+    assert response == history[-1][1]
+    prompt_ids = prefix_cache.entries[0][0]
+    prefix_length, _ = prefix_cache.get(0, prompt_ids, len(prompt_ids) - 1)
+    assert prefix_length == len(prompt_ids) - 1
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description:
+"""
+import sys
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+sys.path.append('..')
+from lmft.chatglm_model import ChatGLMTune
+from lmft.chatglm_utils import (
+    ChatGLMArgs, PROMPT_TEMPLATE, LengthGroupedBatchSampler, PackedDataset, get_prefix_lm_masks, preprocess_batch,
+)
+
+
+def test_batch_masks_and_position_ids():
+    bos_token_id = 150004
+    torch.manual_seed(0)
+    examples = []
+    for prompt_len, answer_len in [(1, 3), (7, 12), (20, 1), (4, 30)]:
+        examples.append(
+            torch.randint(5, 100, (prompt_len,)).tolist() + [150001, bos_token_id]
+            + torch.randint(5, 100, (answer_len,)).tolist()
+        )
+    longest = max(len(example) for example in examples)
+    input_ids = torch.tensor([example + [0] * (longest - len(example)) for example in examples])
+
+    attention_mask, position_ids, _ = ChatGLMTune.get_batch_masks_and_position_ids(input_ids, bos_token_id)
+    prefix_lengths, _, _ = ChatGLMTune.get_batch_masks_and_position_ids(input_ids, bos_token_id, compact_mask=True)
+    for i, example in enumerate(examples):
+        seq_len = example.index(bos_token_id) + 1
+        expected_mask, expected_position_ids = ChatGLMTune.get_masks_and_position_ids(seq_len, longest, 'cpu')
+        assert torch.equal(attention_mask[i], expected_mask)
+        assert torch.equal(position_ids[i], expected_position_ids)
+    assert torch.equal(get_prefix_lm_masks(prefix_lengths, longest), attention_mask)
+    # like `seq.index(150004)`, a row without bos is an error instead of a prefix of length 0
+    input_ids[1][input_ids[1] == bos_token_id] = 0
+    with pytest.raises(ValueError):
+        ChatGLMTune.get_batch_masks_and_position_ids(input_ids, bos_token_id)
+
+
+def test_preprocess_batch(char_tokenizer):
+    tokenizer = char_tokenizer
+    args = ChatGLMArgs()
+    args.max_seq_length, args.max_length = 12, 6
+    rows = [("hello", "", "abc"), ("a long instruction", "and input", "a long answer text"), ("你好", None, "")]
+    outputs = preprocess_batch(*zip(*rows), tokenizer, args)
+    for (instruction, input_text, target_text), output in zip(rows, outputs):
+        prompt = PROMPT_TEMPLATE.format(instruction=instruction, input=f"{input_text}\n" if input_text else "")
+        prompt_ids = tokenizer.encode(prompt, max_length=args.max_seq_length, truncation=True)
+        target_ids = tokenizer.encode(target_text, max_length=args.max_length, truncation=True,
+                                      add_special_tokens=False)
+        assert output.tolist() == prompt_ids + target_ids + [tokenizer.eos_token_id]
+
+
+def test_packed_data_collator(tiny_model):
+    tune = object.__new__(ChatGLMTune)
+    tune.args = ChatGLMArgs()
+    tune.tokenizer = SimpleNamespace(pad_token_id=3, bos_token_id=150004)
+    torch.manual_seed(0)
+    examples = [
+        torch.randint(5, 100, (prompt_len,)).tolist() + [150001, 150004] + torch.randint(5, 100, (answer_len,)).tolist()
+        for prompt_len, answer_len in [(3, 5), (6, 2), (1, 9), (4, 4)]
+    ]
+    model = tiny_model
+    with torch.no_grad():
+        expected = model(**tune.data_collator(examples)).loss
+        tune.args.use_packing, tune.args.packing_length = True, 32
+        dataset = PackedDataset(examples, 32)
+        assert len(dataset) == 2
+        packed = tune.data_collator([dataset[i] for i in range(len(dataset))])
+        assert packed["input_ids"].shape == (2, 32)
+        loss = model(**packed).loss
+    assert torch.allclose(loss, expected, atol=1e-5)
+
+
+def test_length_grouped_batch_sampler():
+    lengths = torch.randint(1, 500, (1000,), generator=torch.Generator().manual_seed(0)).numpy()
+    sampler = LengthGroupedBatchSampler(lengths, max_tokens=2048, bucket_size=200)
+    batches = list(sampler)
+    assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))
+    assert all(len(batch) * max(lengths[batch]) <= 2048 for batch in batches)
+    padded = sum(len(batch) * max(lengths[batch]) for batch in batches)
+    assert padded < 1.2 * lengths.sum()
+    assert list(sampler) == batches
+    sampler.set_epoch(1)
+    assert list(sampler) != batches  # reshuffled every epoch
+
+
+def test_length_grouped_batch_sampler_replicas():
+    lengths = torch.randint(1, 500, (1000,), generator=torch.Generator().manual_seed(0)).numpy()
+    samplers = [LengthGroupedBatchSampler(lengths, max_tokens=2048, num_replicas=3, rank=rank) for rank in range(3)]
+    batches = [list(sampler) for sampler in samplers]
+    assert len(set(len(sampler) for sampler in samplers)) == 1
+    assert all(len(rank_batches) == len(samplers[0]) for rank_batches in batches)
+    assert sorted(set(i for rank_batches in batches for batch in rank_batches for i in batch)) == list(range(1000))
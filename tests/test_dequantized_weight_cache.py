@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description:
+"""
+import sys
+
+import torch
+
+sys.path.append('..')
+
+
+def test_dequantized_weight_cache_matches_on_the_fly(tiny_model, make_prompt):
+    model = tiny_model.quantize(4, group_size=32)
+    # longer than CPU_FUSED_GEMM_MAX_ROWS, the linears multiply dequantized float weights
+    input_ids = torch.tensor([make_prompt(30, seed=0)])
+    with torch.no_grad():
+        expected = model(input_ids=input_ids).logits
+        # the float weights of one layer (4 linears) fit in the budget
+        cache = model.set_dequantized_weight_cache(200000)
+        for _ in range(3):
+            assert torch.equal(model(input_ids=input_ids).logits, expected)
+    stats = cache.get_stats()
+    assert stats['resident_linears'] == 4 and stats['linears'] == 8
+    assert stats['resident_memory'] <= 200000
+    assert stats['hits'] == 8
+    # the resident layer is dequantized on its first forward, the other one always by the prefetch thread
+    assert stats['misses'] == 4 and stats['prefetched'] == 12
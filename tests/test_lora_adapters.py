@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description:
+"""
+import os
+import sys
+
+import pytest
+import torch
+
+sys.path.append('..')
+from lmft.chatglm_lora import LoraAdapterRegistry
+
+
+def test_mixed_adapter_batch_matches_peft(tmp_path, tiny_model, make_prompt, save_random_adapter):
+    model = tiny_model
+    peft_models = {}
+    registry = LoraAdapterRegistry(model, max_loaded_adapters=2)
+    for name, rank in (('a', 4), ('b', 8)):
+        path = os.path.join(tmp_path, f'{name}.pt')
+        peft_models[name] = save_random_adapter(model, path, rank, seed=rank)
+        registry.register(name, path)
+    adapter_names = ['b', None, 'a', 'b']
+    input_ids = torch.tensor([make_prompt(6, seed=i) for i in range(len(adapter_names))])
+    with torch.no_grad():
+        with registry.activate(adapter_names):
+            logits = model(input_ids=input_ids).logits
+        for i, name in enumerate(adapter_names):
+            expected = (peft_models[name] if name else model)(input_ids=input_ids[i:i + 1]).logits
+            assert torch.allclose(logits[i:i + 1], expected, atol=1e-4)
+        # the adapters are only applied inside `activate`
+        assert torch.allclose(model(input_ids=input_ids[1:2]).logits, logits[1:2], atol=1e-4)
+
+    # 'b' is the least recently used adapter and is evicted, then reloaded when requested again
+    registry.register('c', os.path.join(tmp_path, 'a.pt'))
+    with registry.activate(['c']):
+        pass
+    assert registry.loaded_adapters == ['a', 'c']
+    with registry.activate(['b', 'c']):
+        pass
+    assert registry.loaded_adapters == ['b', 'c']
+
+
+def test_add_lora_adapter_with_peft_lora(tmp_path, tiny_chatglm_tune, save_random_adapter):
+    m = tiny_chatglm_tune
+    output_dir = str(tmp_path / 'outputs')
+    os.makedirs(output_dir)
+    save_random_adapter(m.model, os.path.join(output_dir, 'lora.pt'), rank=8, seed=0)
+    adapter_path = os.path.join(tmp_path, 'a.pt')
+    save_random_adapter(m.model, adapter_path, rank=4, seed=1)
+    m.args.use_lora = True
+    m.args.output_dir = output_dir
+    # the peft LoRA of `output_dir` would be wrapped again by the registry
+    with pytest.raises(ValueError):
+        m.add_lora_adapter('a', adapter_path)
+    m.merge_lora()
+    m.add_lora_adapter('a', adapter_path)
+    assert m.predict(['hello'], adapter_names=['a']) == m.predict(['hello'], adapter_names=['a'])
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description:
+"""
+import pickle
+import sys
+
+import numpy as np
+from torch.utils.data import DataLoader
+
+sys.path.append('..')
+from lmft.chatglm_utils import MemmapTokens, get_cache_shards
+
+
+def test_memmap_tokens(tmp_path):
+    rng = np.random.default_rng(0)
+    examples = [rng.integers(0, 150528, size=rng.integers(0, 50)).tolist() for _ in range(100)]
+    path = str(tmp_path / "cached")
+    tokens = MemmapTokens.write(path, examples)
+    assert MemmapTokens.exists(path)
+    assert len(tokens) == len(examples)
+    assert all(tokens[i].tolist() == example for i, example in enumerate(examples))
+    # only the path is pickled, workers open their own memmap
+    assert len(pickle.dumps(tokens)) < 200
+    loader = DataLoader(tokens, batch_size=8, num_workers=2, collate_fn=list)
+    assert [example.tolist() for batch in loader for example in batch] == examples
+
+
+def test_cache_shards_reuse():
+    rows = [("instruction {}".format(i), "", "output {}".format(i)) for i in range(1000)]
+    shards = get_cache_shards(rows, shard_size=20)
+    assert [i for indices, _ in shards for i in indices] == list(range(len(rows)))
+    # inserting rows only changes the shard they land in
+    new_rows = rows[:500] + [("new", None, "row")] * 10 + rows[500:]
+    new_shards = get_cache_shards(new_rows, shard_size=20)
+    changed = {digest for _, digest in new_shards} - {digest for _, digest in shards}
+    assert len(changed) == 1
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description:
+"""
+import os
+import sys
+
+import torch
+
+sys.path.append('..')
+from lmft.chatglm_model import ChatGLMTune
+
+
+def test_merge_lora_matches_lora_model(tmp_path, tiny_chatglm_tune, save_random_adapter):
+    m = tiny_chatglm_tune
+    output_dir = str(tmp_path / 'outputs')
+    os.makedirs(output_dir)
+    lora_model = save_random_adapter(m.model, os.path.join(output_dir, 'lora.pt'), rank=8, seed=0)
+    m.args.use_lora = True
+    m.args.output_dir = output_dir
+    input_ids = torch.tensor([[5, 6, 7, 8, 150001, 150004]])
+    with torch.no_grad():
+        expected = lora_model(input_ids=input_ids).logits
+        merged = m.merge_lora(str(tmp_path / 'merged'))
+        assert not any('lora' in name for name, _ in merged.named_parameters())
+        assert torch.allclose(merged(input_ids=input_ids).logits, expected, atol=1e-4)
+
+        # the layers are created in half precision, the merged weights are reloaded rounded to it
+        reloaded = ChatGLMTune('chatglm', str(tmp_path / 'merged'), use_cuda=False)
+        assert not reloaded.args.use_lora
+        weight = reloaded.model.transformer.layers[0].attention.query_key_value.weight
+        expected_weight = merged.transformer.layers[0].attention.query_key_value.weight
+        assert torch.equal(weight, expected_weight.half().float())
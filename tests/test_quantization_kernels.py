@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description:
+"""
+import sys
+
+import pytest
+import torch
+
+sys.path.append('..')
+from lmft import quantization
+from lmft.quantization import QuantizedLinear, extract_weight_to_float, fused_gemm, load_cpu_kernel
+
+
+def test_fused_gemm_matches_dequantized_matmul():
+    load_cpu_kernel()
+    if quantization.cpu_kernels is None or quantization.cpu_kernels.int8GemmFloat is None:
+        pytest.skip("fused gemm kernel unavailable")
+    torch.manual_seed(0)
+    # 10 output rows leave a partial tile of 4 rows
+    weight = torch.randn(10, 64)
+    for bits, group_size in ((8, 0), (4, 0), (8, 16), (4, 16)):
+        layer = QuantizedLinear(bits, weight_tensor=weight, bias_tensor=None, in_features=64, out_features=10,
+                                bias=False, dtype=torch.float, device='cpu', group_size=group_size)
+        for batch in (1, 3):
+            inp = torch.randn(batch, 64)
+            expected = inp.mm(extract_weight_to_float(layer.weight, layer.weight_scale, bits).t())
+            assert torch.allclose(fused_gemm(inp, layer.weight, layer.weight_scale, bits), expected, atol=1e-4)
+            assert torch.allclose(layer(inp), expected, atol=1e-4)
+
+
+def test_group_scales_reduce_int4_error():
+    load_cpu_kernel()
+    torch.manual_seed(0)
+    weight = torch.randn(8, 256)
+    weight[:, ::50] *= 10
+    errors = []
+    for group_size in (0, 32):
+        layer = QuantizedLinear(4, weight_tensor=weight, bias_tensor=None, in_features=256, out_features=8,
+                                bias=False, dtype=torch.float, device='cpu', group_size=group_size)
+        assert layer.weight_scale.shape == ((8, 256 // group_size) if group_size else (8,))
+        errors.append((extract_weight_to_float(layer.weight, layer.weight_scale, 4) - weight).norm())
+    assert errors[1] < errors[0] * 0.6
+
+
+def test_group_quantize_zero_group():
+    load_cpu_kernel()
+    weight = torch.randn(4, 32)
+    weight[1, 16:] = 0
+    layer = QuantizedLinear(8, weight_tensor=weight, bias_tensor=None, in_features=32, out_features=4,
+                            bias=False, dtype=torch.half, device='cpu', group_size=16)
+    restored = extract_weight_to_float(layer.weight, layer.weight_scale, 8)
+    assert torch.isfinite(restored).all()
+    assert (restored[1, 16:] == 0).all()
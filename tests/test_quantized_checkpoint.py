@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description:
+"""
+import copy
+import sys
+
+import torch
+
+sys.path.append('..')
+from lmft.chatglm_utils import ChatGLMForConditionalGeneration
+
+
+def test_quantized_checkpoint_round_trip(tmp_path, tiny_model, make_prompt):
+    input_ids = torch.tensor([make_prompt(6, seed=0)])
+    for bits, group_size in ((8, 0), (4, 0), (4, 32)):
+        path = str(tmp_path / f'{bits}_{group_size}')
+        model = copy.deepcopy(tiny_model).quantize(bits, group_size=group_size)
+        model.save_quantized(path)
+        # the rotary inv_freq is not loaded, like `from_pretrained` it is half until `.float()`
+        loaded = ChatGLMForConditionalGeneration.from_quantized(path).float()
+        for name, param in model.state_dict().items():
+            assert torch.equal(loaded.state_dict()[name], param)
+        with torch.no_grad():
+            assert torch.equal(loaded(input_ids=input_ids).logits, model(input_ids=input_ids).logits)
+
+
+def test_quantized_checkpoint_without_mmap(tmp_path, monkeypatch, tiny_model):
+    path = str(tmp_path / 'quantized')
+    model = copy.deepcopy(tiny_model).quantize(8)
+    model.save_quantized(path)
+    torch_load = torch.load
+
+    def load(*args, **kwargs):
+        # torch < 2.1 rejects the mmap argument
+        if 'mmap' in kwargs:
+            raise TypeError("load() got an unexpected keyword argument 'mmap'")
+        return torch_load(*args, **kwargs)
+
+    monkeypatch.setattr(torch, 'load', load)
+    loaded = ChatGLMForConditionalGeneration.from_quantized(path).float()
+    for name, param in model.state_dict().items():
+        assert torch.equal(loaded.state_dict()[name], param)
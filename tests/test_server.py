@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description:
+"""
+import asyncio
+import json
+import sys
+
+import pytest
+
+sys.path.append('..')
+from lmft.server import ChatGLMServer
+
+
+async def http_request(port, method, path, data=None):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    body = json.dumps(data).encode("utf-8") if data is not None else b""
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    headers, _, body = response.partition(b"\r\n\r\n")
+    if b"Transfer-Encoding: chunked" in headers:
+        lines, rest = [], body
+        while True:
+            size, _, rest = rest.partition(b"\r\n")
+            if int(size, 16) == 0:
+                break
+            lines.append(json.loads(rest[:int(size, 16)]))
+            rest = rest[int(size, 16) + 2:]
+        return lines
+    return json.loads(body)
+
+
+def test_server(tiny_chatglm_tune):
+    model = tiny_chatglm_tune
+    prompts = ["hello", "how are you?", "你好", "abc"]
+    expected = [model.predict([prompt])[0] for prompt in prompts]
+
+    async def run():
+        server = ChatGLMServer(model, host="127.0.0.1", port=0, batch_wait_ms=50)
+        await server.start()
+        try:
+            responses = await asyncio.gather(*[
+                http_request(server.port, "POST", "/generate", {"prompt": prompt}) for prompt in prompts
+            ])
+            assert [r["response"] for r in responses] == expected
+            lines = await http_request(server.port, "POST", "/generate", {"prompt": "hello", "stream": True})
+            assert "".join(line["delta"] for line in lines[:-1]) == lines[-1]["response"] == expected[0]
+            chat = await http_request(server.port, "POST", "/chat", {"query": "你好", "history": []})
+            assert chat["history"] == [["你好", chat["response"]]]
+            metrics = await http_request(server.port, "GET", "/metrics")
+            assert metrics["num_requests"] == 6 and metrics["queue_depth"] == 0
+            assert metrics["num_batches"] < metrics["num_requests"]
+            assert metrics["latency_seconds"]["p99"] is not None
+        finally:
+            await server.close()
+
+    asyncio.run(run())
+
+
+def test_predict_keeps_padding_side(tiny_chatglm_tune):
+    model = tiny_chatglm_tune
+    model.tokenizer.padding_side = "right"
+    model.predict(["hello", "how are you?"])
+    assert model.tokenizer.padding_side == "right"
+
+
+def test_continuous_batching_unsupported_kwargs(tiny_chatglm_tune):
+    model = tiny_chatglm_tune
+    expected = model.predict(["hello", "abc"], repetition_penalty=1.1)
+    model.args.use_continuous_batching = True
+    # arguments the engine does not implement go through `generate`
+    assert model.predict(["hello", "abc"], repetition_penalty=1.1) == expected
+    with pytest.raises(ValueError):
+        next(model.stream_predict(["hello"], repetition_penalty=1.1))
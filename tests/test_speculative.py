@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description:
+"""
+import sys
+
+import torch
+
+sys.path.append('..')
+from lmft.chatglm_speculative import SpeculativeDecoder, accept_draft_tokens, get_truncated_draft_model
+
+
+def test_speculative_greedy_matches_generate(tiny_model, make_prompt):
+    model = tiny_model
+    for draft_model, acceptance_rate in ((get_truncated_draft_model(model, 1), None), (model, 1.0)):
+        decoder = SpeculativeDecoder(model, draft_model, num_speculative_tokens=3, max_new_tokens=16, do_sample=False)
+        for length in (3, 9):
+            prompt = make_prompt(length, seed=length)
+            expected = model.generate(input_ids=torch.tensor([prompt]), max_new_tokens=16, do_sample=False)
+            assert decoder.generate(prompt) == expected[0, len(prompt):].tolist()
+        metrics = decoder.get_metrics()
+        assert metrics["num_generated_tokens"] == 32
+        if acceptance_rate is not None:
+            assert metrics["acceptance_rate"] == acceptance_rate
+
+
+def test_accept_draft_tokens_keeps_target_distribution():
+    generator = torch.Generator().manual_seed(0)
+    p = torch.softmax(torch.randn(6, generator=generator) * 2, dim=-1)
+    q = torch.softmax(torch.randn(6, generator=generator) * 2, dim=-1)
+    torch.manual_seed(0)
+    num_samples = 20000
+    counts = torch.zeros(6)
+    for token in torch.multinomial(q, num_samples, replacement=True).tolist():
+        num_accepted, next_token = accept_draft_tokens(torch.stack((p, p)), q[None], [token])
+        counts[token if num_accepted else next_token] += 1
+    assert torch.allclose(counts / num_samples, p, atol=0.015)
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description:
+"""
+import sys
+
+import torch
+
+sys.path.append('..')
+from lmft.chatglm_decode import StaticDecoder
+
+
+def test_static_decoder_matches_generate(tiny_model, make_prompt):
+    model = tiny_model
+    decoder = StaticDecoder(model, max_length=64)
+    for length in (3, 12):
+        input_ids = torch.tensor([make_prompt(length, seed=length)])
+        expected = model.generate(input_ids=input_ids, max_length=len(input_ids[0]) + 20, do_sample=False)
+        assert torch.equal(decoder.generate(input_ids, max_new_tokens=20), expected)
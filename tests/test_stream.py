@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description:
+"""
+import sys
+
+from tokenizers import ByteLevelBPETokenizer
+from transformers import PreTrainedTokenizerFast
+
+sys.path.append('..')
+from lmft.chatglm_engine import ContinuousBatchingEngine, IncrementalDetokenizer
+
+
+def test_incremental_detokenizer():
+    texts = ["你好，很高兴认识你。", "Hello world, streaming 中文 text!", "😀 emoji and 汉字"]
+    bpe = ByteLevelBPETokenizer()
+    bpe.train_from_iterator(texts[:1], vocab_size=260, min_frequency=1, show_progress=False)
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=bpe)
+    for text in texts:
+        token_ids = tokenizer(text)["input_ids"]
+        detokenizer = IncrementalDetokenizer(tokenizer)
+        deltas = [detokenizer.add_tokens([token_id]) for token_id in token_ids] + [detokenizer.flush()]
+        assert "".join(deltas) == text
+        assert not any("�" in delta for delta in deltas)
+
+
+def test_engine_stream_matches_generate(tiny_model, make_prompt):
+    model = tiny_model
+    prompts = [make_prompt(length, seed=length) for length in (3, 9, 5)]
+    engine = ContinuousBatchingEngine(model, max_batch_size=2, max_new_tokens=8, do_sample=False)
+    expected = engine.generate(prompts)
+    outputs = [[] for _ in prompts]
+    for new_token_ids in engine.stream(prompts):
+        for output_ids, token_ids in zip(outputs, new_token_ids):
+            output_ids.extend(token_ids)
+    assert outputs == expected